@@ -1,4 +1,5 @@
 import logging
+import collections
 from string import Template
 from time import strftime
 from datetime import datetime, timedelta
@@ -12,12 +13,27 @@ except ImportError:
     from PyQt5.QtWidgets import QAction, QShortcut
 
 from dataobjs import PesterHistory
-from parsetools import convertTags, lexMessage, mecmd, colorBegin, colorEnd, smiledict
+from parsetools import (
+    convertTags,
+    lexMessage,
+    mecmd,
+    colorBegin,
+    colorEnd,
+    imageSources,
+)
 import parsetools
 import embeds
+import imagecache
 
 PchumLog = logging.getLogger("pchumLogger")
 
+SCROLLBACK_PAGE = 200  # Messages evicted, or shown again when scrolling up, at once.
+SCROLLBACK_KEPT = 10  # Evicted messages are kept up to this times the scrollback limit.
+# The document is rebuilt after this times the scrollback limit of messages were
+# evicted, a QTextDocument never frees the formats of removed text.
+SCROLLBACK_REBUILD = 10
+APPEND_INTERVAL = 16  # ms appended messages are collected for, a frame at 60Hz.
+
 
 class PesterTabWindow(QtWidgets.QFrame):
     def __init__(self, mainwindow, parent=None, convo="convo"):
@@ -313,6 +329,7 @@ class PesterTabWindow(QtWidgets.QFrame):
             self.layout.removeWidget(self.currentConvo)
         self.currentConvo = convo
         self.layout.addWidget(convo)
+        imagecache.cache.resumeMovies(convo.textArea)
         self.setWindowIcon(convo.icon())
         self.setWindowTitle(convo.title())
         self.activateWindow()
@@ -322,43 +339,6 @@ class PesterTabWindow(QtWidgets.QFrame):
     windowClosed = QtCore.pyqtSignal()
 
 
-class PesterMovie(QtGui.QMovie):
-    def __init__(self, parent):
-        super().__init__(parent)
-        self.textwindow = parent
-
-    @QtCore.pyqtSlot(int)
-    def animate(self, frame):
-        text = self.textwindow
-        if text.mainwindow.config.animations():
-            movie = self
-            url = text.urls[movie].toString()
-            html = text.toHtml()
-            if html.find(url) != -1:
-                try:
-                    # PyQt6
-                    resource_type = QtGui.QTextDocument.ResourceType.ImageResource.value
-                except AttributeError:
-                    # PyQt5
-                    resource_type = QtGui.QTextDocument.ResourceType.ImageResource
-                if text.hasTabs:
-                    i = text.tabobject.tabIndices[text.parent().title()]
-                    if text.tabobject.tabs.currentIndex() == i:
-                        text.document().addResource(
-                            resource_type,
-                            text.urls[movie],
-                            movie.currentPixmap(),
-                        )
-                        text.setLineWrapColumnOrWidth(text.lineWrapColumnOrWidth())
-                else:
-                    text.document().addResource(
-                        resource_type,
-                        text.urls[movie],
-                        movie.currentPixmap(),
-                    )
-                    text.setLineWrapColumnOrWidth(text.lineWrapColumnOrWidth())
-
-
 class PesterText(QtWidgets.QTextEdit):
     def __init__(self, theme, parent=None):
         super().__init__(parent)
@@ -366,7 +346,7 @@ class PesterText(QtWidgets.QTextEdit):
             self.mainwindow = self.parent().mainwindow
         else:
             self.mainwindow = self.parent()
-        if isinstance(parent.parent, PesterTabWindow):
+        if isinstance(parent.parent(), PesterTabWindow):
             self.tabobject = parent.parent()
             self.hasTabs = True
         else:
@@ -376,13 +356,29 @@ class PesterText(QtWidgets.QTextEdit):
         self.setMouseTracking(True)
         self.textSelected = False
         self.copyAvailable.connect(self.textReady)  # (bool yes)
-        self.urls = {}
         self.lastmsg = None
-        for k in smiledict:
-            self.addAnimation(
-                QtCore.QUrl("smilies/%s" % (smiledict[k])),
-                "smilies/%s" % (smiledict[k]),
-            )
+        self.images = set()  # Shared images added to the document already.
+        # src -> pixmap of every image resource, added again when it's rebuilt.
+        self.resources = {}
+        # Messages appended, the ones before shownFrom were evicted from the document
+        # and the oldest of those are dropped, see SCROLLBACK_KEPT. shownBlocks has
+        # the number of blocks of each one that's shown.
+        self.scrollback = []
+        self.shownFrom = 0
+        self.shownBlocks = collections.deque()
+        self.evicted = 0  # Messages evicted since the document was last rebuilt.
+        # Appended messages that aren't in the document yet.
+        self.pendingMessages = []
+        self.appendTimer = QtCore.QTimer(self)
+        self.appendTimer.setSingleShot(True)
+        self.appendTimer.setInterval(APPEND_INTERVAL)
+        self.appendTimer.timeout.connect(self.flushMessages)
+        # Nothing to undo in a read-only text area, and evicted text would be kept.
+        self.setUndoRedoEnabled(False)
+        # Whether the scrollbar is kept at the bottom as messages are added.
+        self.following = True
+        self.verticalScrollBar().valueChanged.connect(self.scrolled)
+        self.verticalScrollBar().rangeChanged.connect(self.scrollRangeChanged)
 
         embeds.manager.embed_loading.connect(self.registerEmbed)
         embeds.manager.embed_loaded.connect(self.showEmbed)
@@ -391,31 +387,42 @@ class PesterText(QtWidgets.QTextEdit):
             self.showEmbed(embed)
         # self.mainwindow.animationSetting[bool].connect(self.animateChanged)
 
-    def addAnimation(self, url, fileName):
-        # We don't need to treat images formats like .png as animation,
-        # this always opens a file handler otherwise, "movie.frameCount() > 1" isn't sufficient.
-        # Might be useful to use QImageReader's supportsAnimation function for this?
-        # As long as we're only using gifs there's no advantage to that though.
-        if not fileName.endswith(".gif"):
-            return
+    def addImages(self, lexmsg):
+        """Add the shared images of the smilies in a message to the document, so
+        it doesn't load its own, and animate the animated ones."""
+        animations = self.mainwindow.config.animations()
+        for src in imageSources(lexmsg):
+            if src not in self.images:
+                pixmap = imagecache.cache.pixmap(src)
+                if pixmap is not None:
+                    self.addImageResource(src, pixmap)
+                self.images.add(src)
+            if animations:
+                imagecache.cache.startMovie(src, self)
+
+    def showFrame(self, src, pixmap):
+        """Show a new frame of an animation, called by imagecache.cache.
+
+        Returns False if the text area can't be seen, so the animation pauses."""
+        if not self.mainwindow.config.animations() or not self.isVisible():
+            return False
+        if self.hasTabs and self.tabobject.currentConvo is not self.parent():
+            return False
+        # Frames are the same size, so repainting is enough.
+        self.addImageResource(src, pixmap)
+        self.viewport().update()
+        return True
+
+    def showEvent(self, event):
+        imagecache.cache.resumeMovies(self)
+        super().showEvent(event)
 
-        movie = PesterMovie(self)
-        movie.setFileName(fileName)
-        self.urls[movie] = url
-        movie.frameChanged.connect(movie.animate)  # (int frameNumber)
+    def addImageResource(self, src, pixmap):
+        self.document().addResource(imagecache.IMAGE_RESOURCE, QtCore.QUrl(src), pixmap)
+        self.resources[src] = pixmap
 
     def setResource(self, uri, pixmap):
-        try:
-            # PyQt6
-            resource_type = QtGui.QTextDocument.ResourceType.ImageResource.value
-        except AttributeError:
-            # PyQt5
-            resource_type = QtGui.QTextDocument.ResourceType.ImageResource
-        self.document().addResource(
-            resource_type,
-            QtCore.QUrl(uri),
-            pixmap,
-        )
+        self.addImageResource(uri, pixmap)
         self.setLineWrapColumnOrWidth(self.lineWrapColumnOrWidth())
 
     def registerEmbed(self, url):
@@ -454,6 +461,157 @@ class PesterText(QtWidgets.QTextEdit):
     def textReady(self, ready):
         self.textSelected = ready
 
+    def append(self, text):
+        """Append a message, like QTextEdit.append() but not right away.
+
+        Messages appended within APPEND_INTERVAL ms of each other are added to
+        the document in one edit, so a burst of them is only laid out and
+        painted once."""
+        self.scrollback.append(text)
+        self.pendingMessages.append(text)
+        if not self.appendTimer.isActive():
+            self.appendTimer.start()
+
+    @QtCore.pyqtSlot()
+    def flushMessages(self):
+        """Add appended messages to the document, and evict the oldest ones past
+        the scrollback limit."""
+        self.appendTimer.stop()
+        if not self.pendingMessages:
+            return
+        pending, self.pendingMessages = self.pendingMessages, []
+        self.shownBlocks.extend(self.insertMessages(pending))
+        self.evictScrollback(self.following)
+
+    def insertMessages(self, messages):
+        """Add messages at the end of the document, returns their numbers of blocks."""
+        document = self.document()
+        textCursor = self.textCursor()
+        cursor = QtGui.QTextCursor(document)
+        cursor.movePosition(QtGui.QTextCursor.MoveOperation.End)
+        counts = []
+        cursor.beginEditBlock()
+        for text in messages:
+            if document.isEmpty():
+                blocks = 0
+                cursor.setCharFormat(textCursor.charFormat())
+            else:
+                blocks = document.blockCount()
+                cursor.insertBlock(textCursor.blockFormat(), textCursor.charFormat())
+            self.insertMessage(cursor, text)
+            counts.append(document.blockCount() - blocks)
+        cursor.endEditBlock()
+        return counts
+
+    def clear(self):
+        """Remove every message, including evicted and pending ones."""
+        self.appendTimer.stop()
+        self.pendingMessages = []
+        self.scrollback = []
+        self.shownFrom = 0
+        self.shownBlocks.clear()
+        self.evicted = 0
+        # Clearing the document drops its resources too.
+        self.images = set()
+        self.resources = {}
+        self.following = True
+        super().clear()
+
+    def insertMessage(self, cursor, text):
+        """Insert a message at 'cursor', as html if it looks like html."""
+        if QtCore.Qt.mightBeRichText(text):
+            cursor.insertFragment(
+                QtGui.QTextDocumentFragment.fromHtml(text, self.document())
+            )
+        else:
+            cursor.insertText(text)
+
+    def evictScrollback(self, following):
+        """Remove the oldest messages from the document if there are too many.
+
+        Removing text from the top lays out the whole document again, so
+        messages are removed SCROLLBACK_PAGE at a time. They aren't removed
+        while scrolled up to read them, unless the document got twice as long
+        as the limit. Up to SCROLLBACK_KEPT times the limit of them can be
+        shown again by scrolling up, older ones are only in the logs."""
+        limit = self.mainwindow.config.scrollback_lines()
+        excess = len(self.shownBlocks) - limit
+        if limit <= 0 or excess < (SCROLLBACK_PAGE if following else limit):
+            return
+        scrollbar = self.verticalScrollBar()
+        position = scrollbar.value()
+        maximum = scrollbar.maximum()
+        blocks = sum(self.shownBlocks.popleft() for _ in range(excess))
+        cursor = QtGui.QTextCursor(self.document())
+        cursor.movePosition(QtGui.QTextCursor.MoveOperation.Start)
+        cursor.movePosition(
+            QtGui.QTextCursor.MoveOperation.NextBlock,
+            QtGui.QTextCursor.MoveMode.KeepAnchor,
+            blocks,
+        )
+        cursor.removeSelectedText()
+        self.shownFrom += excess
+        self.evicted += excess
+        # Evicted messages would otherwise pile up in here for the whole session.
+        dropped = self.shownFrom - limit * SCROLLBACK_KEPT
+        if dropped >= SCROLLBACK_PAGE:
+            del self.scrollback[:dropped]
+            self.shownFrom -= dropped
+        if not following:
+            # Keep showing the same text.
+            scrollbar.setValue(position - (maximum - scrollbar.maximum()))
+        elif self.evicted >= limit * SCROLLBACK_REBUILD:
+            self.rebuildDocument()
+
+    def rebuildDocument(self):
+        """Clear the document and add the messages that are shown again.
+
+        Removing text leaves its formats behind, every image adds one, so
+        without this the document keeps growing however much is evicted."""
+        document = self.document()
+        document.clear()
+        for src, pixmap in self.resources.items():
+            document.addResource(imagecache.IMAGE_RESOURCE, QtCore.QUrl(src), pixmap)
+        self.shownBlocks = collections.deque(
+            self.insertMessages(self.scrollback[self.shownFrom :])
+        )
+        self.evicted = 0
+
+    def restoreScrollback(self, count):
+        """Show up to 'count' evicted messages again, above the ones shown."""
+        start = max(0, self.shownFrom - count)
+        document = self.document()
+        scrollbar = self.verticalScrollBar()
+        position = scrollbar.value()
+        maximum = scrollbar.maximum()
+        cursor = QtGui.QTextCursor(document)
+        cursor.movePosition(QtGui.QTextCursor.MoveOperation.Start)
+        block_format = cursor.blockFormat()
+        counts = []
+        cursor.beginEditBlock()
+        for text in self.scrollback[start : self.shownFrom]:
+            blocks = document.blockCount()
+            self.insertMessage(cursor, text)
+            cursor.insertBlock(block_format)
+            counts.append(document.blockCount() - blocks)
+        cursor.endEditBlock()
+        self.shownBlocks.extendleft(reversed(counts))
+        self.shownFrom = start
+        scrollbar.setValue(position + scrollbar.maximum() - maximum)
+
+    @QtCore.pyqtSlot(int, int)
+    def scrollRangeChanged(self, minimum, maximum):
+        # The document is laid out bit by bit after big changes, follow it.
+        if self.following:
+            self.verticalScrollBar().setValue(maximum)
+
+    @QtCore.pyqtSlot(int)
+    def scrolled(self, value):
+        scrollbar = self.verticalScrollBar()
+        self.following = value >= scrollbar.maximum()
+        if self.shownFrom > 0 and value == scrollbar.minimum() < scrollbar.maximum():
+            self.restoreScrollback(SCROLLBACK_PAGE)
+
     def initTheme(self, theme):
         if "convo/scrollbar" in theme:
             self.setStyleSheet(
@@ -488,11 +646,7 @@ class PesterText(QtWidgets.QTextEdit):
         parent = self.parent()
         window = parent.mainwindow
         me = window.profile()
-        if self.mainwindow.config.animations():
-            for m in self.urls:
-                if convertTags(lexmsg).find(self.urls[m].toString()) != -1:
-                    if m.state() == QtGui.QMovie.MovieState.NotRunning:
-                        m.start()
+        self.addImages(lexmsg)
         if self.parent().mainwindow.config.showTimeStamps():
             if self.parent().mainwindow.config.time12Format():
                 time = strftime("[%I:%M")
@@ -552,8 +706,12 @@ class PesterText(QtWidgets.QTextEdit):
                 window.chatlog.log(chum.handle, beginmsg)
                 self.append(convertTags(beginmsg))
 
-            lexmsg[0:0] = [colorBegin("<c=%s>" % (color), color), "%s: " % (initials)]
-            lexmsg.append(colorEnd("</c>"))
+            lexmsg = [
+                colorBegin("<c=%s>" % (color), color),
+                "%s: " % (initials),
+                *lexmsg,
+                colorEnd("</c>"),
+            ]
             self.append(
                 '<span style="color:#000000">' + time + convertTags(lexmsg) + "</span>"
             )
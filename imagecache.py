@@ -0,0 +1,94 @@
+import weakref
+import logging
+
+try:
+    from PyQt6 import QtCore, QtGui
+except ImportError:
+    print("PyQt5 fallback (imagecache.py)")
+    from PyQt5 import QtCore, QtGui
+
+PchumLog = logging.getLogger("pchumLogger")
+
+## imagecache.py
+# smilies shared by every text area, so each image and GIF is only decoded once
+# has a single instance (singleton) called `cache` at the bottom of this file
+
+try:
+    # PyQt6
+    IMAGE_RESOURCE = QtGui.QTextDocument.ResourceType.ImageResource.value
+except AttributeError:
+    # PyQt5
+    IMAGE_RESOURCE = QtGui.QTextDocument.ResourceType.ImageResource
+
+
+class ImageCache(QtCore.QObject):
+    def __init__(self):
+        super().__init__()
+        self.pixmaps = {}  # src -> QPixmap, for documents to share.
+        self.movies = {}  # src -> QMovie
+        # src -> text areas showing it, see startMovie().
+        self.viewers = {}
+
+    def preload(self, sources):
+        """Load the images at 'sources', they're shared with pixmap()."""
+        for src in sources:
+            if src not in self.pixmaps:
+                pixmap = QtGui.QPixmap(src)
+                if pixmap.isNull():
+                    PchumLog.warning("Couldn't load %s", src)
+                    continue
+                self.pixmaps[src] = pixmap
+
+    def pixmap(self, src):
+        """The shared QPixmap of 'src' if it was preloaded, otherwise None."""
+        return self.pixmaps.get(src)
+
+    def startMovie(self, src, viewer):
+        """Animate the image 'src' in 'viewer', if it's an animated GIF.
+
+        The movie keeps running while any of its viewers exist, and is paused
+        while none of them can be seen. Viewers' showFrame(src, pixmap) returns
+        whether they could, resumeMovies() continues it."""
+        # We don't need to treat images formats like .png as animation,
+        # this always opens a file handler otherwise, "movie.frameCount() > 1" isn't sufficient.
+        if not src.endswith(".gif"):
+            return
+        movie = self.movies.get(src)
+        if movie is None:
+            movie = QtGui.QMovie(src, parent=self)
+            if not movie.isValid():
+                PchumLog.debug("Can't animate %s", src)
+            movie.frameChanged.connect(lambda _frame, src=src: self.animate(src))
+            self.movies[src] = movie
+            self.viewers[src] = weakref.WeakSet()
+        self.viewers[src].add(viewer)
+        if movie.state() == QtGui.QMovie.MovieState.NotRunning:
+            movie.start()
+        elif movie.state() == QtGui.QMovie.MovieState.Paused:
+            movie.setPaused(False)
+
+    def resumeMovies(self, viewer):
+        """Continue the paused animations 'viewer' shows, once it can be seen."""
+        for src, viewers in self.viewers.items():
+            movie = self.movies[src]
+            if viewer in viewers and movie.state() == QtGui.QMovie.MovieState.Paused:
+                movie.setPaused(False)
+
+    def animate(self, src):
+        """Show the current frame of 'src' in every text area showing it."""
+        movie = self.movies[src]
+        pixmap = movie.currentPixmap()
+        shown = False
+        for viewer in list(self.viewers[src]):
+            try:
+                shown = viewer.showFrame(src, pixmap) or shown
+            except RuntimeError:
+                # The text area was closed and deleted.
+                self.viewers[src].discard(viewer)
+        if not self.viewers[src]:
+            movie.stop()
+        elif not shown:
+            movie.setPaused(True)
+
+
+cache = ImageCache()
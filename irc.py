@@ -30,6 +30,7 @@ the license notice included with oyoyo source files is indented here:
 
 import socket
 import random
+import selectors
 import logging
 import ssl
 from ssl import SSLCertVerificationError
@@ -44,13 +45,17 @@ from mood import Mood
 from dataobjs import PesterProfile
 from generic import PesterList
 from version import _pcVersion
-from scripts.irc_protocol import SendIRC, parse_irc_line
+from scripts.irc_protocol import SendIRC, LineBuffer, parse_irc_message
+from scripts.irc_asyncio import AsyncIRCConnection, IRCEventLoop
+from scripts.reconnect import SessionSnapshot
 from scripts.ssl_context import get_ssl_context
 from scripts.input_validation import is_valid_mood, is_valid_rgb_color
 
 PchumLog = logging.getLogger("pchumLogger")
 from scripts.services import SERVICES
 
+RECV_SIZE = 65536  # Bytes read per recv, big enough for a NAMES/LIST burst.
+
 
 class PesterIRC(QtCore.QThread):
     """Class for making a thread that manages the connection to server."""
@@ -63,6 +68,7 @@ class PesterIRC(QtCore.QThread):
         ssl: bool,
         password="",
         verify_hostname=True,
+        session=None,
     ):
         QtCore.QThread.__init__(self)
         self.mainwindow = window
@@ -74,9 +80,19 @@ class PesterIRC(QtCore.QThread):
         self.verify_hostname = verify_hostname  # SSL cert validation toggle
 
         self._send_irc = SendIRC()
+        self._send_irc.broken_callback = self._send_failed
+        # State of the previous connection when reconnecting.
+        self.session = session or SessionSnapshot()
+        self.mood_sync = self.session.mood_sync
+        self.mood_sync.reset_connection()
+        # Channels rejoined by us right after registering, main thread can skip them.
+        self.rejoined_channels = {
+            channel.casefold() for channel in self.session.channels
+        }
 
         self.unresponsive = False
         self.registered_irc = False
+        self.dropped = False  # Set when an established connection was lost.
         self.metadata_supported = False
         self.stop_irc = None
         self._conn = None
@@ -134,6 +150,9 @@ class PesterIRC(QtCore.QThread):
 
         This function reimplements QThread::run() and is ran after self.irc.start()
         is called on the main thread. Returning from this method ends the thread."""
+        if self.mainwindow.config.asyncio_transport():
+            self._run_asyncio()
+            return
         try:
             self.irc_connect()
         except OSError as socket_exception:
@@ -149,9 +168,11 @@ class PesterIRC(QtCore.QThread):
                 PchumLog.debug("timeout in thread %s", self)
                 self._close()
                 self.stop_irc = f"{type(timeout)}, {timeout}"
+                self.dropped = self.registered_irc
                 return
             except (OSError, IndexError, ValueError) as exception:
                 self.stop_irc = f"{type(exception)}, {exception}"
+                self.dropped = self.registered_irc
                 PchumLog.debug("Socket error, exiting thread.")
                 return
             else:
@@ -159,6 +180,49 @@ class PesterIRC(QtCore.QThread):
                     PchumLog.debug("False Yield: %s, returning", res)
                     return
 
+    def _run_asyncio(self):
+        """Run the connection on the shared asyncio event loop instead of polling a socket.
+
+        The thread only waits for the connection to end, reading, writing and
+        keepalive pings are handled by the loop."""
+        context = None
+        if self.ssl:
+            context = get_ssl_context()
+            if not self.verify_hostname:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+        connection = AsyncIRCConnection(
+            self.server, self.port, context, self._handle_async_line
+        )
+        self.socket = connection
+        self._send_irc.socket = connection
+        future = IRCEventLoop.shared().submit(connection.run(self._register))
+        try:
+            future.result()
+        except SSLCertVerificationError as ssl_cert_fail:
+            # Ask if users wants to connect anyway
+            self.askToConnect.emit(ssl_cert_fail)
+            self.stop_irc = ssl_cert_fail
+        except OSError as exception:
+            if connection.connected:
+                self.stop_irc = f"{type(exception)}, {exception}"
+                self.dropped = self.registered_irc
+            else:
+                self.stop_irc = exception
+            PchumLog.debug("Connection error, exiting thread.")
+        else:
+            # The server closed the connection, unless we did.
+            self.dropped = self.registered_irc and not self._end
+        finally:
+            self._end = True
+            self._send_irc.socket = None
+            self._send_irc.stop()
+
+    def _handle_async_line(self, line: bytes):
+        """Called on the event loop for every line received."""
+        self.mainwindow.sincerecv = 0
+        self._handle_line(line)
+
     def is_connected(self):
         return not self._end
 
@@ -193,7 +257,16 @@ class PesterIRC(QtCore.QThread):
 
         self.socket.settimeout(90)
         self._send_irc.socket = self.socket
+        self._register()
+
+    def _register(self):
+        """Send PASS, capability requests, NICK and USER to register the connection.
+
+        These are pipelined so they go out in a single write."""
+        with self._send_irc.pipeline():
+            self._send_registration()
 
+    def _send_registration(self):
         if self.password:
             self._send_irc.pass_(self.password)
 
@@ -224,19 +297,44 @@ class PesterIRC(QtCore.QThread):
         self._send_irc.user("pcc31", "pcc31")
 
     def _get_stuffs_from_socket(self):
-        """:3"""
-        return self.socket.recv(1024)
+        """Wait until the socket is readable, then read up to RECV_SIZE bytes.
+
+        The socket keeps its timeout so other threads can still use sendall() on it,
+        the selector only decides when a recv() won't block. Returns the number of bytes
+        read, 0 meaning EOF. Raises socket.timeout when nothing arrives in time."""
+        # Decrypted SSL data can be pending without the raw socket being readable.
+        if not (self.ssl and self.socket.pending()):
+            if not self._selector.select(timeout=self.socket.gettimeout()):
+                raise socket.timeout("timed out")
+        return self.socket.recv_into(self._recv_view)
+
+    def _handle_line(self, line: bytes):
+        """Parse a single raw line from the server and run its command."""
+        message = parse_irc_message(line.decode(encoding="utf-8", errors="replace"))
+        if message is None:
+            return
+        # Only need tags with tagmsg
+        if message.command == "tagmsg":
+            self._run_command(
+                message.command, message.prefix, message.tags, *message.params
+            )
+        else:
+            self._run_command(message.command, message.prefix, *message.params)
 
     def _conn_generator(self):
         """Returns a generator object."""
+        self._selector = selectors.DefaultSelector()
+        if self.socket:
+            self._selector.register(self.socket, selectors.EVENT_READ)
+        self._line_buffer = LineBuffer()
+        self._recv_view = memoryview(bytearray(RECV_SIZE))
         try:
-            buffer = b""
             while not self._end:
                 if not self.socket or self.socket.fileno() == -1:
                     self._end = True
                     break
                 try:
-                    buffer += self._get_stuffs_from_socket()
+                    received = self._get_stuffs_from_socket()
                 except OSError as socket_exception:
                     PchumLog.warning(
                         "Socket exception in conn_generator: '%s'.", socket_exception
@@ -247,23 +345,12 @@ class PesterIRC(QtCore.QThread):
                 else:
                     if self._end:
                         break
-                    if not buffer:  # EOF?
+                    if not received:  # EOF?
+                        self.dropped = self.registered_irc
                         self._close()
                         yield False
-                    split_buffer = buffer.split(b"\r\n")
-                    buffer = b""
-                    if split_buffer[-1]:
-                        # Incomplete line, add it back to the buffer.
-                        buffer = split_buffer.pop()
-                    for line in split_buffer:
-                        line = line.decode(encoding="utf-8", errors="replace")
-                        tags, prefix, command, args = parse_irc_line(line)
-                        if command:
-                            # Only need tags with tagmsg
-                            if command.casefold() == "tagmsg":
-                                self._run_command(command, prefix, tags, *args)
-                            else:
-                                self._run_command(command, prefix, *args)
+                    for line in self._line_buffer.feed(self._recv_view[:received]):
+                        self._handle_line(line)
                 yield True
         except OSError as socket_exception:
             PchumLog.warning(
@@ -278,6 +365,8 @@ class PesterIRC(QtCore.QThread):
             PchumLog.debug("Ending _conn while loop, end is %s.", self._end)
             self._close()
             yield False
+        finally:
+            self._selector.close()
 
     def _run_command(self, command, *args):
         """Finds and runs a command if it has a matching function in the self.commands dict."""
@@ -299,6 +388,7 @@ class PesterIRC(QtCore.QThread):
     def _close(self):
         """Kill the socket 'with extreme prejudice'."""
         self._end = True
+        self._send_irc.stop()
         if not self.socket or self.socket.fileno() == -1:
             return
         PchumLog.info("_close() was called, shutting down socket.")
@@ -331,6 +421,26 @@ class PesterIRC(QtCore.QThread):
         PchumLog.critical("set_connection_broken() got called, disconnecting.")
         self.disconnect_irc()
 
+    def _send_failed(self, exception):
+        """Called from SendIRC's writer thread when writing to the socket fails.
+
+        Like set_connection_broken(), but only shuts the socket down: the reader
+        then sees the connection drop and it's reconnected. disconnect_irc()
+        would wait for the writer thread that's calling this."""
+        if self._end:
+            return
+        PchumLog.critical("Sending failed, dropping the connection: %s", exception)
+        connection = self.socket
+        if not connection:
+            return
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
+        except OSError as shutdown_exception:
+            PchumLog.info(
+                "Error while shutting down socket, already broken? %s",
+                shutdown_exception,
+            )
+
     def end_cap_negotiation(self):
         """Send CAP END to end capability negotation.
 
@@ -357,34 +467,44 @@ class PesterIRC(QtCore.QThread):
 
     @QtCore.pyqtSlot(PesterProfile)
     def get_mood(self, *chums):
-        """Get mood via metadata if supported"""
+        """Get mood via metadata if supported
+
+        Moods that are still cached are emitted right away, lookups that are
+        already waiting for a reply aren't sent again."""
+        # No point in GETMOOD-ing services
+        known, query = self.mood_sync.plan(
+            [chum.handle for chum in chums if chum.handle.casefold() not in SERVICES]
+        )
+        for handle, mood in known:
+            self.moodUpdated.emit(handle, Mood(mood))
+        if not query:
+            return
 
         # Get via metadata or via legacy method
         if self.metadata_supported:
-            # Metadata
-            for chum in chums:
+            # Metadata, one target per command. The send queue writes them in batches.
+            for handle in query:
                 try:
-                    self._send_irc.metadata(chum.handle, "get", "mood")
+                    self._send_irc.metadata(handle, "get", "mood")
                 except OSError as socket_exception:
                     PchumLog.warning(socket_exception)
                     self.set_connection_broken()
+                    return
         else:
             # Legacy
             PchumLog.warning(
                 "Server doesn't seem to support metadata, using legacy GETMOOD."
             )
             chumglub = "GETMOOD "
-            for chum in chums:
-                if len(chumglub + chum.handle) >= 350:
+            for handle in query:
+                if len(chumglub + handle) >= 350:
                     try:
                         self._send_irc.privmsg("#pesterchum", chumglub)
                     except OSError as e:
                         PchumLog.warning(e)
                         self.set_connection_broken()
                     chumglub = "GETMOOD "
-                # No point in GETMOOD-ing services
-                if chum.handle.casefold() not in SERVICES:
-                    chumglub += chum.handle
+                chumglub += handle
             if chumglub != "GETMOOD ":
                 try:
                     self._send_irc.privmsg("#pesterchum", chumglub)
@@ -559,6 +679,8 @@ class PesterIRC(QtCore.QThread):
     def disconnect_irc(self):
         """Send QUIT and close connection, slot is called from main thread."""
         self._send_irc.quit(f"{_pcVersion} <3")
+        # Give the send queue a moment to get QUIT out before closing.
+        self._send_irc.flush(timeout=1)
         self._close()
 
     @QtCore.pyqtSlot(str)
@@ -595,6 +717,7 @@ class PesterIRC(QtCore.QThread):
             else:
                 PchumLog.warning("Mood index '%s' from '%s' is not valid.", value, nick)
                 mood = Mood(0)
+            self.mood_sync.update(nick, mood.value())
             self.moodUpdated.emit(nick, mood)
         elif key.casefold() == "color":
             try:
@@ -614,13 +737,10 @@ class PesterIRC(QtCore.QThread):
         https://ircv3.net/specs/extensions/message-tags.html#the-tagmsg-tag-only-message
         """
         PchumLog.info("TAGMSG: %s %s %s", prefix, tags, args)
-        message_tags = tags[1:].split(";")
-        for tag in message_tags:
-            if tag.startswith("+pesterchum"):
+        for key, value in tags.items():
+            if key.startswith("+pesterchum"):
                 # Pesterchum tag
-                try:
-                    key, value = tag.split("=")
-                except ValueError:
+                if not value:
                     return
                 PchumLog.info("Pesterchum tag: %s=%s", key, value)
                 # PESTERCHUM: syntax check
@@ -723,6 +843,7 @@ class PesterIRC(QtCore.QThread):
                             "Mood index '%s' from '%s' is not valid.", msg[6:], handle
                         )
                         mood = Mood(0)
+                    self.mood_sync.update(handle, mood.value())
                     self.moodUpdated.emit(handle, mood)
                 elif msg.startswith("GETMOOD"):
                     mychumhandle = self.mainwindow.profile().handle
@@ -762,6 +883,7 @@ class PesterIRC(QtCore.QThread):
             self.userPresentUpdate.emit(handle, "", "netsplit")
         else:
             self.userPresentUpdate.emit(handle, "", "quit")
+        self.mood_sync.forget(handle)
         self.moodUpdated.emit(handle, Mood("offline"))
 
     def _kick(self, channel_operator, channel, handle, reason):
@@ -778,6 +900,7 @@ class PesterIRC(QtCore.QThread):
         PchumLog.info('---> recv "PART %s: %s"', handle, channel)
         self.userPresentUpdate.emit(handle, channel, "left")
         if channel == "#pesterchum":
+            self.mood_sync.forget(handle)
             self.moodUpdated.emit(handle, Mood("offline"))
 
     def _join(self, nick, channel):
@@ -789,6 +912,7 @@ class PesterIRC(QtCore.QThread):
             if handle == self.mainwindow.randhandler.randNick:
                 self.mainwindow.randhandler.setRunning(True)
                 self.updateRandomEncounter.emit()
+            self.mood_sync.forget(handle)
             self.moodUpdated.emit(handle, Mood("chummy"))
 
     def _mode(self, op, channel, mode_msg, *handles):
@@ -870,6 +994,7 @@ class PesterIRC(QtCore.QThread):
         if self.mainwindow.profile().handle in [newnick, oldhandle]:
             self.myHandleChanged.emit(newnick)
         newchum = PesterProfile(newnick, chumdb=self.mainwindow.chumdb)
+        self.mood_sync.forget(oldhandle)
         self.moodUpdated.emit(oldhandle, Mood("offline"))
         self.userPresentUpdate.emit(f"{oldhandle}:{newnick}", "", "nick")
         if newnick in self.mainwindow.chumList.chums:
@@ -890,17 +1015,25 @@ class PesterIRC(QtCore.QThread):
         profile = self.mainwindow.profile()
         # Get mood
         mood = profile.mood.value_str()
-        # Moods via metadata
-        self._send_irc.metadata("*", "sub", "mood")
-        self._send_irc.metadata("*", "set", "mood", mood)
-        # Color via metadata
-        self._send_irc.metadata("*", "sub", "color")
-        self._send_irc.metadata("*", "set", "color", profile.color.name())
-        # Backwards compatible moods
-        if self.mainwindow.config.irc_compatibility_mode():
-            return
-        self._send_irc.join("#pesterchum")
-        self._send_irc.privmsg("#pesterchum", f"MOOD >{mood}")
+        compatibility_mode = self.mainwindow.config.irc_compatibility_mode()
+        with self._send_irc.pipeline():
+            # Moods via metadata
+            self._send_irc.metadata("*", "sub", "mood")
+            self._send_irc.metadata("*", "set", "mood", mood)
+            # Color via metadata
+            self._send_irc.metadata("*", "sub", "color")
+            self._send_irc.metadata("*", "set", "color", profile.color.name())
+            # Rejoin everything in one go when reconnecting,
+            # channels can't be joined before 001 so this is as early as it gets.
+            channels = list(self.session.channels)
+            if not compatibility_mode:
+                channels.insert(0, "#pesterchum")
+            self._send_irc.join_channels(channels)
+            for channel in self.session.channels:
+                self._send_irc.mode(channel)
+            # Backwards compatible moods
+            if not compatibility_mode:
+                self._send_irc.privmsg("#pesterchum", f"MOOD >{mood}")
 
     def _featurelist(self, _target, _handle, *params):
         """Numerical reply 005 RPL_ISUPPORT to communicate supported server features.
@@ -993,6 +1126,11 @@ class PesterIRC(QtCore.QThread):
             for chum in chums:
                 if chum.handle in namelist:
                     lesschums.append(chum)
+            # Conversations that were open before reconnecting need moods too,
+            # chums are deduplicated by get_mood.
+            for handle in self.session.convos:
+                if handle in namelist:
+                    lesschums.append(PesterProfile(handle))
             self.get_mood(*lesschums)
 
     def _cannotsendtochan(self, _server, _handle, channel, msg):
@@ -1046,11 +1184,13 @@ class PesterIRC(QtCore.QThread):
                     "Mood index '%s' from '%s' is not valid.", value[0], handle_owner
                 )
                 mood = Mood(0)
+            self.mood_sync.update(handle_owner, mood.value())
             self.moodUpdated.emit(handle_owner, mood)
 
     def _nomatchingkey(self, _target, _our_handle, failed_handle, _key, *_error):
         """METADATA DRAFT numeric reply 766 ERR_NOMATCHINGKEY, no matching key."""
         PchumLog.info("_nomatchingkey: %s", failed_handle)
+        self.mood_sync.failed(failed_handle)
         # No point in GETMOOD-ing services
         # Fallback to the normal GETMOOD method if getting mood via metadata fails.
         if failed_handle.casefold() not in SERVICES:
@@ -1059,6 +1199,7 @@ class PesterIRC(QtCore.QThread):
     def _keynotset(self, _target, _our_handle, failed_handle, _key, *_error):
         """METADATA DRAFT numeric reply 768 ERR_KEYNOTSET, key isn't set."""
         PchumLog.info("_keynotset: %s", failed_handle)
+        self.mood_sync.failed(failed_handle)
         # Fallback to the normal GETMOOD method if getting mood via metadata fails.
         if failed_handle.casefold() not in SERVICES:
             self._send_irc.privmsg("#pesterchum", f"GETMOOD {failed_handle}")
@@ -1066,6 +1207,7 @@ class PesterIRC(QtCore.QThread):
     def _keynopermission(self, _target, _our_handle, failed_handle, _key, *_error):
         """METADATA DRAFT numeric reply 769 ERR_KEYNOPERMISSION, no permission for key."""
         PchumLog.info("_keynopermission: %s", failed_handle)
+        self.mood_sync.failed(failed_handle)
         # Fallback to the normal GETMOOD method if getting mood via metadata fails.
         if failed_handle.casefold() not in SERVICES:
             self._send_irc.privmsg("#pesterchum", f"GETMOOD {failed_handle}")
@@ -1073,6 +1215,9 @@ class PesterIRC(QtCore.QThread):
     def _metadatasubok(self, *params):
         """ "METADATA DRAFT numeric reply 770 RPL_METADATASUBOK, we subbed to a key."""
         PchumLog.info("_metadatasubok: %s", params)
+        if any(param.casefold() == "mood" for param in params[2:]):
+            # Mood changes get pushed to us, cached moods stay valid for longer.
+            self.mood_sync.subscribed = True
 
     def _authenticate(self, _, token):
         """Handle IRCv3 SASL authneticate command from server."""
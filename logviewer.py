@@ -1,8 +1,7 @@
 import os
-import codecs
-import re
+import logging
 import ostools
-from time import strftime, strptime
+from time import localtime, strftime
 
 try:
     from PyQt6 import QtCore, QtGui, QtWidgets
@@ -10,10 +9,22 @@ except ImportError:
     print("PyQt5 fallback (logviewer.py)")
     from PyQt5 import QtCore, QtGui, QtWidgets
 from generic import RightClickList, RightClickTree
-from parsetools import convertTags
 from convo import PesterText
+from scripts.log_format import (
+    EXPORT_EXTENSIONS,
+    LogLines,
+    export,
+    log_directory,
+    migrate_chum,
+    render_record,
+)
+from scripts.log_index import message_text
+from scripts.log_catalogue import catalogue
 
 _datadir = ostools.getDataDir()
+PchumLog = logging.getLogger("pchumLogger")
+
+PAGE_LINES = 200  # Lines of a log rendered at once, more are loaded on scroll.
 
 
 class PesterLogSearchInput(QtWidgets.QLineEdit):
@@ -26,8 +37,7 @@ class PesterLogSearchInput(QtWidgets.QLineEdit):
         if hasattr(self.parent(), "textArea"):
             if event.key() == QtCore.Qt.Key.Key_Return:
                 self.parent().logSearch(self.text())
-                if self.parent().textArea.find(self.text()):
-                    self.parent().textArea.ensureCursorVisible()
+                self.parent().findNext(self.text())
         else:
             self.parent().logSearch(self.text())
 
@@ -61,10 +71,7 @@ class PesterLogUserSelect(QtWidgets.QDialog):
 
         instructions = QtWidgets.QLabel("Pick a memo or chumhandle:")
 
-        if os.path.exists("{}/{}".format(self.logpath, self.handle)):
-            chumMemoList = os.listdir("{}/{}/".format(self.logpath, self.handle))
-        else:
-            chumMemoList = []
+        chumMemoList = catalogue(self.logpath, self.handle).chums()
         chumslist = config.chums()
         for c in chumslist:
             if not c in chumMemoList:
@@ -159,26 +166,23 @@ class PesterLogViewer(QtWidgets.QDialog):
         self.chum = chum
         self.convos = {}
         self.logpath = _datadir + "logs"
+        self.lines = None  # LogLines of the log that's shown.
+        self.loaded = 0  # How many of its lines are in the text area.
+        self.loading = False  # Whether loadMore() is adding lines.
 
         self.setStyleSheet(self.theme["main/defaultwindow/style"])
         self.setWindowTitle("Pesterlogs with " + self.chum)
 
-        self.format = "bbcode"
-        if os.path.exists(
-            "{}/{}/{}/{}".format(self.logpath, self.handle, chum, self.format)
-        ):
-            self.logList = os.listdir(
-                "{}/{}/{}/{}/".format(self.logpath, self.handle, self.chum, self.format)
-            )
-        else:
-            self.logList = []
-
-        if (
-            not os.path.exists(
-                "{}/{}/{}/{}".format(self.logpath, self.handle, chum, self.format)
-            )
-            or len(self.logList) == 0
-        ):
+        # Logs from before they were stored once are converted the first time.
+        try:
+            migrate_chum(self.logpath, self.handle, chum)
+        except OSError as e:
+            PchumLog.warning("Couldn't convert old logs with %s: %s", chum, e)
+        self.directory = log_directory(self.logpath, self.handle, chum)
+        self.logs = catalogue(self.logpath, self.handle).logs(chum)
+        self.logList = list(self.logs)
+
+        if len(self.logList) == 0:
             instructions = QtWidgets.QLabel("No Pesterlogs were found")
 
             self.ok = QtWidgets.QPushButton("CLOSE", self)
@@ -197,6 +201,7 @@ class PesterLogViewer(QtWidgets.QDialog):
 
             self.textArea = PesterLogText(theme, self.parent)
             self.textArea.setReadOnly(True)
+            self.textArea.verticalScrollBar().valueChanged[int].connect(self.scrolled)
             self.textArea.setFixedWidth(600)
             if "convo/scrollbar" in theme:
                 self.textArea.setStyleSheet(
@@ -245,15 +250,23 @@ class PesterLogViewer(QtWidgets.QDialog):
             last = ["", ""]
             # blackbrush = QtGui.QBrush(QtCore.Qt.GlobalColor.black)
             for i, l in enumerate(self.logList):
-                my = self.fileToMonthYear(l)
-                if my[0] != last[0]:
+                started = localtime(self.logs[l]["start"])
+                my = [strftime("%B", started), strftime("%Y", started)]
+                if my != last:
                     child_1 = QtWidgets.QTreeWidgetItem(["{} {}".format(my[0], my[1])])
                     # child_1.setForeground(0, blackbrush)
                     self.tree.addTopLevelItem(child_1)
                     if i == 0:
                         child_1.setExpanded(True)
-                child_1.addChild(QtWidgets.QTreeWidgetItem([self.fileToTime(l)]))
-                last = self.fileToMonthYear(l)
+                item = QtWidgets.QTreeWidgetItem([self.fileToTime(l)])
+                item.setData(0, QtCore.Qt.ItemDataRole.UserRole, l)
+                item.setToolTip(
+                    0,
+                    "%d lines, %d KiB"
+                    % (self.logs[l]["lines"], self.logs[l]["size"] // 1024),
+                )
+                child_1.addChild(item)
+                last = my
 
             self.hilight = PesterLogHighlighter(self.textArea)
             if len(self.logList) > 0:
@@ -271,10 +284,14 @@ class PesterLogViewer(QtWidgets.QDialog):
             layout_search.addWidget(self.search)
             layout_search.addWidget(self.find)
 
+            self.export = QtWidgets.QPushButton("EXPORT", self)
+            self.export.setFixedWidth(80)
+            self.export.clicked.connect(self.exportLog)
             self.ok = QtWidgets.QPushButton("CLOSE", self)
             self.ok.setFixedWidth(80)
             self.ok.clicked.connect(self.reject)
             layout_ok = QtWidgets.QHBoxLayout()
+            layout_ok.addWidget(self.export)
             layout_ok.addWidget(self.ok)
             layout_ok.setAlignment(self.ok, QtCore.Qt.AlignmentFlag.AlignRight)
 
@@ -294,63 +311,124 @@ class PesterLogViewer(QtWidgets.QDialog):
 
     @QtCore.pyqtSlot()
     def loadSelectedLog(self):
-        if len(self.tree.currentItem().text(0)) > len("September 2011"):
-            self.loadLog(self.timeToFile(self.tree.currentItem().text(0)))
+        fname = self.tree.currentItem().data(0, QtCore.Qt.ItemDataRole.UserRole)
+        if fname:  # Not a month.
+            self.loadLog(fname)
 
     def loadLog(self, fname: str):
-        fp = codecs.open(
-            "%s/%s/%s/%s/%s"
-            % (self.logpath, self.handle, self.chum, self.format, fname),
-            encoding="utf-8",
-            mode="r",
-        )
+        if self.lines is not None:
+            self.lines.close()
+            # Clearing moves the scrollbar, scrolled() mustn't load from it.
+            self.lines = None
         self.textArea.clear()
-        for line in fp:
-            cline = (
-                line.replace("\r\n", "")
-                .replace("[/color]", "</c>")
-                .replace("[url]", "")
-                .replace("[/url]", "")
-            )
-            cline = re.sub(r"\[color=(#.{6})]", r"<c=\1>", cline)
-            self.textArea.append(convertTags(cline))
-        textCur = self.textArea.textCursor()
-        # textCur.movePosition(1)
-        self.textArea.setTextCursor(textCur)
+        self.lines = LogLines("{}/{}".format(self.directory, fname))
+        self.loaded = 0
+        self.loadMore(PAGE_LINES)
+        # find() searches from the cursor, a new log is searched from the top.
+        self.textArea.moveCursor(QtGui.QTextCursor.MoveOperation.Start)
         self.instructions.setText(
             "Pesterlog with " + self.chum + " on " + self.fileToTime(fname)
         )
+        self.fname = fname
+
+    def loadMore(self, count):
+        """Render the next 'count' lines of the log."""
+        scrollbar = self.textArea.verticalScrollBar()
+        position = scrollbar.value()
+        cursor = self.textArea.textCursor()
+        start = self.loaded
+        stop = self.loaded = min(len(self.lines), start + count)
+        # Appending moves the scrollbar, scrolled() mustn't load more until it's back.
+        self.loading = True
+        try:
+            for record in self.lines.records(start, stop):
+                self.textArea.append(render_record(record))
+            # append() moves the cursor to the end, findNext() would skip
+            # every match in the lines that were just loaded.
+            self.textArea.setTextCursor(cursor)
+            # It also keeps a scrollbar at the bottom there.
+            scrollbar.setValue(position)
+        finally:
+            self.loading = False
+
+    @QtCore.pyqtSlot(int)
+    def scrolled(self, value):
+        if self.lines is None or self.loading or self.loaded >= len(self.lines):
+            return
+        scrollbar = self.textArea.verticalScrollBar()
+        if value >= scrollbar.maximum() - scrollbar.pageStep():
+            self.loadMore(PAGE_LINES)
+
+    def findNext(self, search):
+        """Select the next match for 'search', loading more of the log if it's further."""
+        if not search:
+            return
+        while not self.textArea.find(search):
+            line = self.nextMatchingLine(search)
+            if line is None:
+                return
+            self.loadMore(line - self.loaded + PAGE_LINES)
+        self.textArea.ensureCursorVisible()
+
+    def nextMatchingLine(self, search):
+        """Index of the first line that isn't loaded yet and contains 'search'."""
+        search = search.lower()
+        for start in range(self.loaded, len(self.lines), PAGE_LINES * 10):
+            records = self.lines.records(start, start + PAGE_LINES * 10)
+            for line, record in enumerate(records, start):
+                text = record.get("stamp", "") + message_text(record["msg"])
+                if search in text.lower():
+                    return line
+        return None
+
+    def done(self, result):
+        if self.lines is not None:
+            self.lines.close()
+            self.lines = None
+        QtWidgets.QDialog.done(self, result)
+
+    @QtCore.pyqtSlot()
+    def exportLog(self):
+        """Save the log that's shown as html, bbcode or plain text."""
+        filters = {
+            "HTML (*.html)": "html",
+            "BBCode (*.txt)": "bbcode",
+            "Plain text (*.txt)": "text",
+        }
+        name = self.fname[: -len(".jsonl")]
+        path, selected = QtWidgets.QFileDialog.getSaveFileName(
+            self,
+            "Export Pesterlog",
+            name + EXPORT_EXTENSIONS["html"],
+            ";;".join(filters),
+        )
+        if not path:
+            return
+        try:
+            export("{}/{}".format(self.directory, self.fname), filters[selected], path)
+        except OSError as e:
+            PchumLog.warning("Couldn't export %s: %s", self.fname, e)
+            QtWidgets.QMessageBox.warning(
+                self, "Export failed", "Couldn't export the log:\n%s" % e
+            )
 
     def logSearch(self, search):
         self.hilight.searchTerm = search
         self.hilight.rehighlight()
 
-    def fileToMonthYear(self, fname):
-        time = strptime(fname[-20:-4], "%Y-%m-%d.%H.%M")
-        # #pesterchum.online.2023-05-27.00.54.txt
-        #                    ^^^^^^^^^^^^^^^^
-        # Doesnt raise an exception if the memo name has one or more periods like the old one
-        # But also is not as dynamic. Could also be solved by a regex or counting how many periods are in there total,
-        # but this seemed like a simple approach, assuming the format doesnt change anytime soon, which seems unlikely :P
-        # Also doesnt fail if a memo contains ".txt" like the old way
-        # old fromat -> fname[(fname.index(".") + 1) : fname.index(".txt")], "%Y-%m-%d.%H.%M"
-        # ~ (lis)anne
-        return [strftime("%B", time), strftime("%Y", time)]
-
     def fileToTime(self, fname):
-        timestr = fname[-20:-4]
-        return strftime("%a %d %b %Y %H %M", strptime(timestr, "%Y-%m-%d.%H.%M"))
-
-    def timeToFile(self, time):
-        return self.chum + strftime(
-            ".%Y-%m-%d.%H.%M.txt", strptime(str(time), "%a %d %b %Y %H %M")
-        )
+        return strftime("%a %d %b %Y %H %M", localtime(self.logs[fname]["start"]))
 
 
 class PesterLogText(PesterText):
     def __init__(self, theme, parent=None):
         PesterText.__init__(self, theme, parent)
 
+    def append(self, text):
+        """Add a line right away, logs are paged by PesterLogViewer.loadMore()
+        instead of being batched and evicted like messages in a convo."""
+        QtWidgets.QTextEdit.append(self, text)
+
     def focusInEvent(self, event):
         QtWidgets.QTextEdit.focusInEvent(self, event)
 
@@ -22,7 +22,6 @@ from parsetools import (
     colorBegin,
     addTimeInitial,
     mecmd,
-    smiledict,
 )
 from logviewer import PesterLogViewer
 from scripts.services import BOTNAMES
@@ -308,7 +307,7 @@ class MemoText(PesterText):
             self.mainwindow = self.parent().mainwindow
         else:
             self.mainwindow = self.parent()
-        if isinstance(parent.parent, PesterTabWindow):
+        if isinstance(parent.parent(), PesterTabWindow):
             self.tabobject = parent.parent()
             self.hasTabs = True
         else:
@@ -318,12 +317,6 @@ class MemoText(PesterText):
         self.setMouseTracking(True)
         self.textSelected = False
         self.copyAvailable.connect(self.textReady)  # (bool yes)
-        self.urls = {}
-        for k in smiledict:
-            self.addAnimation(
-                QtCore.QUrl("smilies/%s" % (smiledict[k])),
-                "smilies/%s" % (smiledict[k]),
-            )
         # self.mainwindow.animationSetting[bool].connect(self.animateChanged)
 
     def initTheme(self, theme):
@@ -401,11 +394,7 @@ class MemoText(PesterText):
             lexmsg = lexMessage(msg)
         else:
             lexmsg = msg
-        if self.mainwindow.config.animations():
-            for m in self.urls:
-                if convertTags(lexmsg).find(self.urls[m].toString()) != -1:
-                    if m.state() == QtGui.QMovie.MovieState.NotRunning:
-                        m.start()
+        self.addImages(lexmsg)
         chumdb = window.chumdb
         if chum is not me:  # SO MUCH WH1T3SP4C3 >:]
             if isinstance(lexmsg[0], colorBegin):  # get color tag
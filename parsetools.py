@@ -1,5 +1,6 @@
 import logging
 import re
+import functools
 import collections
 from copy import copy
 from datetime import timedelta
@@ -51,6 +52,8 @@ _embedre = re.compile(
 
 quirkloader = ScriptQuirks()
 _functionre = None
+# Replacement string -> parse tree, see cachedRegexpFunctions.
+_regexp_function_cache = {}
 
 
 def loadQuirks():
@@ -59,12 +62,15 @@ def loadQuirks():
     quirkloader.loadAll()
     quirkloader.funcre()
     _functionre = re.compile(r"%s" % quirkloader.funcre())
+    _regexp_function_cache.clear()
 
 
 def reloadQuirkFunctions():
     quirkloader.loadAll()
     global _functionre
     _functionre = re.compile(r"%s" % quirkloader.funcre())
+    # Parse trees reference the old functions.
+    _regexp_function_cache.clear()
 
 
 def lexer(string, objlist):
@@ -342,29 +348,88 @@ def kxlexMsg(msg: str):
     return msg
 
 
+# The tokens that split a message up before anything else is looked for,
+# in order of preference: /me, <alt>, </alt>, <c=...> and </c>.
+# A color tag can't contain an alternian tag since those are split off first.
+_structural_re = re.compile(
+    r"(?P<mecmd>^(/me|PESTERCHUM:ME)(\S*))"
+    r"|(?P<altbegin><alt>)"
+    r"|(?P<altend></alt>)"
+    r"|(?P<colorbegin>(?i:<c=)((?:(?!</?alt>).)*?)>)"
+    r"|(?P<colorend>(?i:</c>))"
+)
+# Chunk type and the groups passed to it for every named group above.
+_structural_chunks = {
+    "mecmd": (mecmd, (2, 3)),
+    "altbegin": (alternianTagBegin, ()),
+    "altend": (alternianTagEnd, ()),
+    "colorbegin": (colorBegin, (7,)),
+    "colorend": (colorEnd, ()),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _fragment_lexers():
+    """Tokens looked for in the text between structural tokens, in order of preference.
+
+    Each entry is (chunk type, regex, substring a match requires), the substring
+    lets most fragments skip a pattern without running the regex at all.
+    These depend on what's around them (start of a fragment, whitespace) so they
+    can't be folded into one alternation without changing the result."""
+    return (
+        (embedlink, _embedre, "://"),
+        (imagelink, _imgre, "<"),
+        (hyperlink, _urlre, ":"),
+        (memolex, _memore, "#"),
+        (chumhandlelex, _handlere, "@"),
+        (smiley, _smilere, ":"),
+        (honker, _honk, ""),
+    )
+
+
+def _lex_fragment(fragment, lexers, level, lexed):
+    """Split 'fragment' with the lexers from 'level' on, appending to 'lexed'."""
+    for index in range(level, len(lexers)):
+        chunk, regexp, required = lexers[index]
+        if required not in fragment:
+            continue
+        lasti = 0
+        matched = False
+        for m in regexp.finditer(fragment):
+            start = m.start()
+            if lasti != start:
+                _lex_fragment(fragment[lasti:start], lexers, index + 1, lexed)
+            lexed.append(chunk(m.group(0), *m.groups()))
+            lasti = m.end()
+            matched = True
+        if matched:
+            if lasti < len(fragment):
+                _lex_fragment(fragment[lasti:], lexers, index + 1, lexed)
+            return
+    lexed.append(fragment)
+
+
 def lexMessage(string: str):
-    lexlist = [
-        (mecmd, _mecmdre),
-        (alternianTagBegin, _alternian_begin),
-        (alternianTagEnd, _alternian_end),
-        (colorBegin, _ctag_begin),
-        # (colorBegin, _gtag_begin),
-        (colorEnd, _ctag_end),
-        # karxi: Disabled this for now. No common versions of Pesterchum
-        # actually use it, save for Chumdroid...which shouldn't.
-        # When I change out parsers, I might add it back in.
-        ##(formatBegin, _format_begin), (formatEnd, _format_end),
-        (embedlink, _embedre),
-        (imagelink, _imgre),
-        (hyperlink, _urlre),
-        (memolex, _memore),
-        (chumhandlelex, _handlere),
-        (smiley, _smilere),
-        (honker, _honk),
-    ]
+    """Split a message into text and chunk objects in a single pass.
 
+    Gives the same result as running lexer() over every token type in order of
+    preference, but structural tags are found with one combined regex and the
+    remaining token types only run on fragments that could contain them."""
+    # karxi: formatBegin/formatEnd are disabled for now. No common versions of
+    # Pesterchum actually use it, save for Chumdroid...which shouldn't.
     string = string.replace("\n", " ").replace("\r", " ")
-    lexed = lexer(string, lexlist)
+    lexers = _fragment_lexers()
+    lexed = []
+    lasti = 0
+    for m in _structural_re.finditer(string):
+        start = m.start()
+        if lasti != start:
+            _lex_fragment(string[lasti:start], lexers, 0, lexed)
+        chunk, groups = _structural_chunks[m.lastgroup]
+        lexed.append(chunk(m.group(0), *[m.group(group) for group in groups]))
+        lasti = m.end()
+    if lasti < len(string):
+        _lex_fragment(string[lasti:], lexers, 0, lexed)
     return balance(lexed)
 
 
@@ -394,26 +459,43 @@ def balance(lexed):
     return balanced
 
 
+_html_escape = str.maketrans({"&": "&amp;", ">": "&gt;", "<": "&lt;"})
+
+
+def _render(lexed, format):
+    if format == "html":
+        return "".join(
+            o.translate(_html_escape) if isinstance(o, str) else o.convert(format)
+            for o in lexed
+        )
+    return "".join(o if isinstance(o, str) else o.convert(format) for o in lexed)
+
+
+def _images(lexed):
+    sources = []
+    for o in lexed:
+        if isinstance(o, smiley):
+            sources.append("smilies/%s" % (smiledict[o.string]))
+        elif isinstance(o, imagelink):
+            sources.append(o.img)
+    return tuple(dict.fromkeys(sources))
+
+
+def imageSources(lexed):
+    """The src of every <img> a message shows when converted to html, without
+    duplicates. Embeds aren't included, they're handled by embeds.manager."""
+    if isinstance(lexed, str):
+        lexed = lexMessage(lexed)
+    return _images(lexed)
+
+
 def convertTags(lexed, format="html"):
     if format not in ["html", "bbcode", "ctag", "text"]:
         raise ValueError("Color format not recognized")
 
     if isinstance(lexed, str):
         lexed = lexMessage(lexed)
-    escaped = ""
-    # firststr = True
-    for i, o in enumerate(lexed):
-        if isinstance(o, str):
-            if format == "html":
-                escaped += (
-                    o.replace("&", "&amp;").replace(">", "&gt;").replace("<", "&lt;")
-                )
-            else:
-                escaped += o
-        else:
-            escaped += o.convert(format)
-
-    return escaped
+    return _render(lexed, format)
 
 
 def _max_msg_len(mask=None, target=None, nick=None, ident=None):
@@ -1079,6 +1161,18 @@ def parseRegexpFunctions(to):
     return parsed
 
 
+def cachedRegexpFunctions(to):
+    """Same as parseRegexpFunctions(), but every replacement string is only parsed once.
+
+    Parse trees are stateless so they're shared, the cache is cleared when quirk
+    functions are (re)loaded."""
+    try:
+        return _regexp_function_cache[to]
+    except KeyError:
+        parsed = _regexp_function_cache[to] = parseRegexpFunctions(to)
+        return parsed
+
+
 def img2smiley(string: str):
     def imagerep(mo):
         return reverse_smiley[mo.group(1)]
@@ -10,6 +10,7 @@ import re
 import time
 import json
 import ctypes
+from ssl import SSLCertVerificationError
 
 # Set working directory
 if os.path.dirname(sys.argv[0]):
@@ -59,6 +60,7 @@ from parsetools import (
     themeChecker,
     ThemeException,
     loadQuirks,
+    smiledict,
 )
 from memos import PesterMemo, MemoTabWindow, TimeTracker
 from irc import PesterIRC
@@ -66,7 +68,9 @@ from logviewer import PesterLogUserSelect, PesterLogViewer
 from randomer import RandomHandler, RANDNICK
 from toast import PesterToastMachine, PesterToast
 from scripts.services import SERVICES, CUSTOMBOTS, BOTNAMES, translate_nickserv_msg
+from scripts.reconnect import SessionSnapshot, backoff_delay, RECONNECT_ATTEMPTS
 import embeds
+import imagecache
 
 try:
     from PyQt6 import QtCore, QtGui, QtWidgets, QtMultimedia
@@ -314,6 +318,10 @@ class chumArea(RightClickTree):
         self.mainwindow = parent
         theme = self.mainwindow.theme
         self.chums = chums
+        # handle -> chumListing, so finding a chum doesn't search the whole tree.
+        # Listings that were taken out of the tree stay until they're replaced,
+        # getChums() skips them.
+        self.listings = {}
         gTemp = self.mainwindow.config.getGroups()
         self.groups = [g[0] for g in gTemp]
         self.openGroups = [g[1] for g in gTemp]
@@ -585,19 +593,15 @@ class chumArea(RightClickTree):
             # self.topLevelItem(0).sortChildren(0, QtCore.Qt.SortOrder.AscendingOrder)
 
     def getChums(self, handle):
-        chums = self.findItems(
-            handle,
-            QtCore.Qt.MatchFlag.MatchExactly | QtCore.Qt.MatchFlag.MatchRecursive,
-        )
-        return chums
+        listing = self.listings.get(handle)
+        if listing is None or listing.treeWidget() is not self:
+            return []
+        return [listing]
 
     def showAllChums(self):
         for c in self.chums:
             chandle = c.handle
-            if not self.findItems(
-                chandle,
-                QtCore.Qt.MatchFlag.MatchExactly | QtCore.Qt.MatchFlag.MatchRecursive,
-            ):  # len is 0
+            if not self.getChums(chandle):  # len is 0
                 # if True:# For if it doesn't work at all :/
                 chumLabel = chumListing(c, self.mainwindow)
                 self.addItem(chumLabel)
@@ -715,10 +719,7 @@ class chumArea(RightClickTree):
                 if text.rfind(" (") != -1:
                     text = text[0 : text.rfind(" (")]
                 curgroups.append(text)
-            if not self.findItems(
-                chumLabel.handle,
-                QtCore.Qt.MatchFlag.MatchExactly | QtCore.Qt.MatchFlag.MatchRecursive,
-            ):
+            if not self.getChums(chumLabel.handle):
                 # if True:# For if it doesn't work at all :/
                 if chumLabel.chum.group not in curgroups:
                     child_1 = QtWidgets.QTreeWidgetItem(["%s" % (chumLabel.chum.group)])
@@ -769,29 +770,26 @@ class chumArea(RightClickTree):
                         self.topLevelItem(i).insertChild(bestj, chumLabel)
                     # sys.exit(0)
                     self.topLevelItem(i).addChild(chumLabel)
+                elif self.mainwindow.config.sortMethod() == 1:
+                    self.insertSorted(self.topLevelItem(i), chumLabel, self.moodKey)
                 else:  # All other sorting
-                    self.topLevelItem(i).addChild(chumLabel)
-                self.sort()
+                    self.insertSorted(self.topLevelItem(i), chumLabel, self.nameKey)
+                self.listings[chumLabel.handle] = chumLabel
                 if self.mainwindow.config.showOnlineNumbers():
                     self.showOnlineNumbers()
         else:  # usually means this is now the trollslum
-            if not self.findItems(
-                chumLabel.handle,
-                QtCore.Qt.MatchFlag.MatchExactly | QtCore.Qt.MatchFlag.MatchRecursive,
-            ):
+            if not self.getChums(chumLabel.handle):
                 # if True:# For if it doesn't work at all :/
-                self.topLevelItem(0).addChild(chumLabel)
-                self.topLevelItem(0).sortChildren(0, QtCore.Qt.SortOrder.AscendingOrder)
+                self.insertSorted(self.topLevelItem(0), chumLabel, self.nameKey)
+                self.listings[chumLabel.handle] = chumLabel
 
     def takeItem(self, chumLabel):
         r = None
         if not hasattr(chumLabel, "chum"):
             return r
-        for i in range(self.topLevelItemCount()):
-            for j in range(self.topLevelItem(i).childCount()):
-                if self.topLevelItem(i).child(j).text(0) == chumLabel.chum.handle:
-                    r = self.topLevelItem(i).takeChild(j)
-                    break
+        for listing in self.getChums(chumLabel.chum.handle):
+            group = listing.parent()
+            r = group.takeChild(group.indexOfChild(listing))
         if not self.mainwindow.config.showEmptyGroups():
             self.hideEmptyGroups()
         if self.mainwindow.config.showOnlineNumbers():
@@ -801,8 +799,11 @@ class chumArea(RightClickTree):
     def updateMood(self, handle, mood):
         hideoff = self.mainwindow.config.hideOfflineChums()
         chums = self.getChums(handle)
-        # Grab all the chums from the chumroll that matches the handle (duplicates are possible)
+        # Grab all the chums from the chumroll that matches the handle
         oldmood = None
+        moved = []  # Listings that have to move to their new mood's place.
+        offline = mood.name() == "offline"
+        recount = False  # Online numbers only change when someone signs on or off.
         if hideoff:
             if (
                 mood.name() != "offline"
@@ -818,23 +819,24 @@ class chumArea(RightClickTree):
             elif mood.name() == "offline" and len(chums) > 0:
                 for c in chums:
                     if hasattr(c, "mood"):
+                        recount = recount or c.chum.mood.name() != "offline"
                         c.setMood(mood)
+                        moved.append(c)
                     # self.takeItem(c)
                 chums = []
         for c in chums:
             # For each instance of the handle on the chumroll, change their displayed mood
             if hasattr(c, "mood"):
                 oldmood = c.mood
+                recount = recount or (c.chum.mood.name() == "offline") != offline
                 c.setMood(mood)
+                moved.append(c)
 
         if self.mainwindow.config.sortMethod() == 1:
-            # uh. uhmm. uhh. uhhhh.
-            for i in range(self.topLevelItemCount()):
-                saveCurrent = self.currentItem()
-                self.moodSort(i)
-                self.setCurrentItem(saveCurrent)
-            # yeah idk what this does ↑
-        if self.mainwindow.config.showOnlineNumbers():
+            # The rest of the group is still sorted, only these have to move.
+            for c in moved:
+                self.moveSorted(c, self.moodKey)
+        if recount and self.mainwindow.config.showOnlineNumbers():
             self.showOnlineNumbers()
         return oldmood
 
@@ -914,17 +916,55 @@ class chumArea(RightClickTree):
         while listing is not None:
             chums.append(self.topLevelItem(group).takeChild(0))
             listing = self.topLevelItem(group).child(0)
-        chums.sort(
-            key=lambda x: (
-                (999 if x.chum.mood.value() == 2 else x.chum.mood.value()),
-                x.chum.handle,
-            ),
-            reverse=False,
-        )
+        chums.sort(key=self.moodKey, reverse=False)
         for c in chums:
             self.topLevelItem(group).addChild(c)
         self.verticalScrollBar().setSliderPosition(scrollPos)
 
+    @staticmethod
+    def moodKey(listing):
+        # Offline chums go last.
+        mood = listing.chum.mood.value()
+        return (999 if mood == 2 else mood, listing.chum.handle)
+
+    @staticmethod
+    def nameKey(listing):
+        # Same order as chumListing.__lt__, which sortChildren() uses.
+        return listing.handle.lower()
+
+    def insertSorted(self, group, chumLabel, key):
+        """Insert 'chumLabel' into the already sorted children of 'group', at the
+        place binary search finds for it, rather than sorting the whole group."""
+        k = key(chumLabel)
+        lo = 0
+        hi = group.childCount()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if k < key(group.child(mid)):
+                hi = mid
+            else:
+                lo = mid + 1
+        group.insertChild(lo, chumLabel)
+
+    def moveSorted(self, chumLabel, key):
+        """Move 'chumLabel' to its place in its group after its key changed."""
+        group = chumLabel.parent()
+        if group is None:
+            return
+        i = group.indexOfChild(chumLabel)
+        k = key(chumLabel)
+        before = group.child(i - 1) if i > 0 else None
+        after = group.child(i + 1)
+        if (before is None or key(before) <= k) and (after is None or k <= key(after)):
+            return  # Still in place.
+        scrollPos = self.verticalScrollBar().sliderPosition()
+        saveCurrent = self.currentItem()
+        group.takeChild(i)
+        self.insertSorted(group, chumLabel, key)
+        if saveCurrent is not None:
+            self.setCurrentItem(saveCurrent)
+        self.verticalScrollBar().setSliderPosition(scrollPos)
+
     @QtCore.pyqtSlot()
     def activateChum(self):
         self.itemActivated.emit(self.currentItem(), 0)
@@ -943,6 +983,7 @@ class chumArea(RightClickTree):
         self.chums = [c for c in self.chums if c.handle != currentChum.handle]
         self.removeChumSignal.emit(self.currentItem().chum.handle)
         oldlist = self.takeItem(self.currentItem())
+        self.listings.pop(currentChum.handle, None)
         del oldlist
 
     @QtCore.pyqtSlot()
@@ -1096,12 +1137,13 @@ class trollSlum(chumArea):
         theme = self.mainwindow.theme
         self.setStyleSheet(theme["main/trollslum/chumroll/style"])
         self.chums = trolls
+        self.listings = {}  # See chumArea.__init__
         child_1 = QtWidgets.QTreeWidgetItem([""])
         self.addTopLevelItem(child_1)
         child_1.setExpanded(True)
         for c in self.chums:
             chandle = c.handle
-            if not self.findItems(chandle, QtCore.Qt.MatchFlag.MatchExactly):
+            if not self.getChums(chandle):
                 chumLabel = chumListing(c, self.mainwindow)
                 self.addItem(chumLabel)
 
@@ -1369,6 +1411,8 @@ class PesterWindow(MovingWindow):
         self.move(100, 100)
 
         embeds.manager.mainwindow = self  ## We gotta get a reference to the user profile from somewhere since its not global. oh well
+        # Decode the smilies once for every conversation and memo.
+        imagecache.cache.preload("smilies/%s" % (s) for s in smiledict.values())
 
         talk = QAction(self.theme["main/menus/client/talk"], self)
         self.talk = talk
@@ -1870,7 +1914,8 @@ class PesterWindow(MovingWindow):
             msg = "<c={}>{}</c>".format(systemColor.name(), msg)
         memo.addMessage(msg, handle)
         mentioned = False
-        m = convertTags(msg, "text")
+        text = convertTags(msg, "text")
+        m = text
         if m.find(":") <= 3:
             m = m[m.find(":") :]
         for search in self.userprofile.getMentions():
@@ -1892,7 +1937,7 @@ class PesterWindow(MovingWindow):
                     if (
                         self.honk
                         and self.honksound
-                        and re.search(r"\bhonk\b", convertTags(msg, "text"), re.I)
+                        and re.search(r"\bhonk\b", text, re.I)
                     ):
                         # TODO: I've got my eye on you, Gamzee.
                         self.honksound.play()
@@ -2371,8 +2416,12 @@ class PesterWindow(MovingWindow):
                 self.newMemo(memo, "i")
 
     def rejoin_channels(self):
+        # Channels from before a reconnect are already rejoined by the IRC thread.
+        irc = self.parent.irc
+        rejoined = irc.rejoined_channels if irc else set()
         for memo in self.memos.keys():
-            self.joinChannel.emit(memo)
+            if memo.casefold() not in rejoined:
+                self.joinChannel.emit(memo)
 
     @QtCore.pyqtSlot()
     def connected(self):
@@ -4171,6 +4220,9 @@ class MainProgram(QtCore.QObject):
         self.trayicon.messageClicked.connect(self.trayMessageClick)
 
         self.attempts = 0
+        # Set when a connection was lost, until we're connected again. Reconnects
+        # that fail are retried with backoff meanwhile, see restartIRC().
+        self.reconnecting = False
 
         self.irc = None  # Defined after gui chooser
 
@@ -4185,6 +4237,14 @@ class MainProgram(QtCore.QObject):
         if self.irc and self.irc.isRunning():
             PchumLog.debug("Calling exit() on IRC thread.")
             self.irc.exit()
+        if hasattr(self.widget, "chatlog"):
+            # Write out and sync queued log lines.
+            self.widget.chatlog.close()
+        if hasattr(self.widget, "config"):
+            # Write settings that are waiting for their save delay.
+            self.widget.config.flush()
+        if hasattr(self.widget, "chumdb"):
+            self.widget.chumdb.close()
 
     # def lastWindow(self):
     #    print("all windows closed")
@@ -4318,6 +4378,7 @@ class MainProgram(QtCore.QObject):
     @QtCore.pyqtSlot()
     def connected(self):
         self.attempts = 0
+        self.reconnecting = False
 
     @QtCore.pyqtSlot()
     def tryAgain(self):
@@ -4335,32 +4396,64 @@ class MainProgram(QtCore.QObject):
     def restartIRC(self, verify_hostname=True):
         if hasattr(self, "irc") and self.irc:
             stop = self.irc.stop_irc
+            dropped = self.irc.dropped
         else:
             stop = None
+            dropped = False
+        if dropped:
+            self.reconnecting = True
         if stop is None:
-            self.disconnectWidgets(self.irc, self.widget)
-            self.irc = PesterIRC(
-                self.widget,
-                self.widget.config.server(),
-                self.widget.config.port(),
-                self.widget.config.ssl(),
-                password=self.widget.config.password(),
-                verify_hostname=verify_hostname,
+            self.startIRC(verify_hostname)
+        elif (
+            self.reconnecting
+            and self.attempts < RECONNECT_ATTEMPTS
+            # The user is asked whether to connect anyway instead.
+            and not isinstance(stop, SSLCertVerificationError)
+        ):
+            # An established connection was lost, reconnect on our own with backoff.
+            delay = backoff_delay(self.attempts)
+            self.attempts += 1
+            PchumLog.warning(
+                "Connection lost (%s), reconnecting in %.1fs.", stop, delay
             )
-            self.connectWidgets(self.irc, self.widget)
-            self.irc.start()
-            if self.attempts == 1:
-                msg = "R3CONN3CT1NG"
-            elif self.attempts > 1:
-                msg = "R3CONN3CT1NG %d" % (self.attempts)
-            else:
-                msg = "CONN3CT1NG"
             self.reconnectok = False
-            self.showLoading(self.widget, msg)
+            self.showLoading(self.widget, "R3CONN3CT1NG %d" % (self.attempts))
+            QtCore.QTimer.singleShot(
+                int(delay * 1000), lambda: self.startIRC(verify_hostname)
+            )
         else:
+            self.reconnecting = False
             self.reconnectok = True
             self.showLoading(self.widget, "F41L3D: %s" % stop)
 
+    def startIRC(self, verify_hostname=True):
+        """Replace the IRC thread with a new one, carrying over the session state."""
+        session = SessionSnapshot(
+            channels=self.widget.memos.keys(),
+            convos=self.widget.convos.keys(),
+            mood_sync=self.irc.mood_sync if self.irc else None,
+        )
+        self.disconnectWidgets(self.irc, self.widget)
+        self.irc = PesterIRC(
+            self.widget,
+            self.widget.config.server(),
+            self.widget.config.port(),
+            self.widget.config.ssl(),
+            password=self.widget.config.password(),
+            verify_hostname=verify_hostname,
+            session=session,
+        )
+        self.connectWidgets(self.irc, self.widget)
+        self.irc.start()
+        if self.attempts == 1:
+            msg = "R3CONN3CT1NG"
+        elif self.attempts > 1:
+            msg = "R3CONN3CT1NG %d" % (self.attempts)
+        else:
+            msg = "CONN3CT1NG"
+        self.reconnectok = False
+        self.showLoading(self.widget, msg)
+
     def oppts(self, argv):
         options = {}
         # The parser and arguments are defined globally,
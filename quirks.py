@@ -7,7 +7,7 @@ import itertools
 
 import ostools
 from mispeller import mispeller
-from parsetools import parseRegexpFunctions, lexMessage, smiledict
+from parsetools import cachedRegexpFunctions, lexMessage, smiledict
 
 
 _datadir = ostools.getDataDir()
@@ -73,6 +73,13 @@ class PesterQuirk:
         # Overwrite (return string)
         raise NotImplementedError()
 
+    def _compiled(self, regex: str):
+        """Return 'regex' compiled, recompiled only when the quirk's regex changes."""
+        if getattr(self, "_compiled_source", None) != regex:
+            self._compiled_regex = re.compile(regex)
+            self._compiled_source = regex
+        return self._compiled_regex
+
     def __str__(self):
         # Overwrite (return string)
         return "UNKNOWN QUIRK"
@@ -133,8 +140,8 @@ class RegexpPesterQuirk(PesterQuirk):
         # the replace string
         to = self.quirk["to"]
         # I think this handles the regex functions like rainbow()
-        parse_tree = parseRegexpFunctions(to)
-        return re.sub(from_, parse_tree.expand, string)
+        parse_tree = cachedRegexpFunctions(to)
+        return self._compiled(from_).sub(parse_tree.expand, string)
 
     def __str__(self):
         return "REGEXP: {} REPLACED WITH {}".format(
@@ -166,10 +173,10 @@ class RandomPesterQuirk(PesterQuirk):
         # I believe this gets called for each match in the re.sub
         def randomrep(mo):
             choice = random.choice(self.quirk["randomlist"])
-            parse_tree = parseRegexpFunctions(choice)
+            parse_tree = cachedRegexpFunctions(choice)
             return parse_tree.expand(mo)
 
-        return re.sub(from_, randomrep, string)
+        return self._compiled(from_).sub(randomrep, string)
 
     def __str__(self):
         return "REGEXP: {} RANDOMLY REPLACED WITH {}".format(
@@ -187,7 +194,7 @@ class MispellerPesterQuirk(PesterQuirk):
         percentage = self.quirk["percentage"] / 100.0
         out = []
         # regex to avoid color tags
-        ctag = re.compile("(</?c=?.*?>)", re.I)
+        ctag = _ctagre
 
         # Split by space to get all words in given string
         for word in string.split(" "):
@@ -260,7 +267,7 @@ class GradientPesterQuirk(PesterQuirk):
             text = match.expand(template)
             return self._do_gradient(text)
 
-        return re.sub(regex, on_match, string)
+        return self._compiled(regex).sub(on_match, string)
 
     def __str__(self):
         return "REPLACE {} WITH\ngradient({}, {})".format(
@@ -268,12 +275,70 @@ class GradientPesterQuirk(PesterQuirk):
         )
 
 
+def split_excludes(string):
+    """Split 'string' around links, smilies, handles, memos and alternian text.
+
+    Returns a list with the excluded substrings at odd indices, the parts in
+    between (possibly empty) at even indices. Without exclusions that's [string]."""
+    excludes = sorted(
+        itertools.chain(
+            _urlre.finditer(string),
+            _smilere.finditer(string),
+            _handlere.finditer(string),
+            _memore.finditer(string),
+            _alternian.finditer(string),
+        ),
+        key=lambda exclude: exclude.start(),
+    )
+    if not excludes:
+        return [string]
+    # Recursion check, of overlapping matches the later one is kept.
+    # Strings like http://:3: require this.
+    kept = [excludes[0]]
+    for exclude in excludes[1:]:
+        if kept[-1].end() > exclude.start():
+            kept[-1] = exclude
+        else:
+            kept.append(exclude)
+    parts = []
+    after = 0
+    for exclude in kept:
+        parts.append(string[after : exclude.start()])
+        parts.append(exclude.group())
+        after = exclude.end()
+    parts.append(string[after:])
+    return parts
+
+
+class QuirkPipeline:
+    """A quirk list prepared for applying to messages.
+
+    Built by PesterQuirkCollection when it's first applied and rebuilt only when
+    its quirks change. Regular expressions and replacement parse trees are
+    compiled by the quirks themselves the first time they're used."""
+
+    def __init__(self, quirklist):
+        self.prefixes = [
+            quirk for quirk in quirklist if isinstance(quirk, PrefixPesterQuirk)
+        ]
+        # (quirk, whether links/smilies/handles/memos are excluded from it)
+        self.steps = []
+        for quirk in quirklist:
+            try:
+                checkstate = int(quirk.checkstate)
+            except Exception:
+                checkstate = 0
+            # Exclude option is checked
+            self.steps.append((quirk, checkstate == 2))
+
+
 # TODO: clean this up. its huge and really hard to read
 
 
 class PesterQuirkCollection:
     def __init__(self, quirklist):
         self.quirklist = []
+        self._pipeline = None
         for quirk in quirklist:
             self.addQuirk(quirk)
 
@@ -287,12 +352,17 @@ class PesterQuirkCollection:
             self.quirklist.append(PesterQuirkFactory(quirk))
         elif isinstance(quirk, PesterQuirk):
             self.quirklist.append(quirk)
+        self._pipeline = None
+
+    def pipeline(self):
+        """Return the QuirkPipeline for the current quirks."""
+        if self._pipeline is None:
+            self._pipeline = QuirkPipeline(self.quirklist)
+        return self._pipeline
 
     def apply(self, lexed, first=False, last=False):
-        prefixes = [
-            quirk for quirk in self.quirklist if isinstance(quirk, PrefixPesterQuirk)
-        ]
-        # suffix = [q for q in self.quirklist if q.type == "suffix"]
+        pipeline = self.pipeline()
+        prefixes = pipeline.prefixes
 
         newlist = []
         for idx, original in enumerate(lexed):
@@ -307,103 +377,40 @@ class PesterQuirkCollection:
                 continue
             is_last_string = idx == len(lexed) - 1
             string = original
-
-            for quirk in self.quirklist:
-                try:
-                    checkstate = int(quirk.checkstate)
-                except Exception:
-                    checkstate = 0
-
-                # Exclude option is checked
-                if checkstate == 2:
-                    # Check for substring that should be excluded.
-                    excludes = []
-                    # Return matches for links, smilies, handles, memos.
-                    # Chain the iterators and add to excludes list.
-                    matches = itertools.chain(
-                        re.finditer(_urlre, string),
-                        re.finditer(_smilere, string),
-                        re.finditer(_handlere, string),
-                        re.finditer(_memore, string),
-                        re.finditer(_alternian, string),
-                    )
-                    excludes.extend(matches)
-
-                    if excludes:
-                        # SORT !!!
-                        excludes.sort(key=lambda exclude: exclude.start())
-                        # Recursion check.
-                        # Strings like http://:3: require this.
-                        for n in range(0, len(excludes) - 1):
-                            if excludes[n].end() > excludes[n + 1].start():
-                                excludes.pop(n)
-                        # Seperate parts to be quirked.
-                        sendparts = []
-                        # Add string until start of exclude at index 0.
-                        until = excludes[0].start()
-                        sendparts.append(string[:until])
-                        # Add strings between excludes.
-                        for part in range(1, len(excludes)):
-                            after = excludes[part - 1].end()
-                            until = excludes[part].start()
-                            sendparts.append(string[after:until])
-                        # Add string after exclude at last index.
-                        after = excludes[-1].end()
-                        sendparts.append(string[after:])
-
-                        # Quirk to-be-quirked parts.
-                        recvparts = []
-                        for part in sendparts:
-                            # No split, apply like normal.
+            # Parts of 'string' split around excluded substrings, reused by the
+            # quirks with the exclude option for as long as the string is unchanged.
+            # A quirk can add a link or smiley that the next ones have to skip.
+            parts = None
+
+            for quirk, exclude in pipeline.steps:
+                if exclude:
+                    if parts is None:
+                        parts = split_excludes(string)
+                    if len(parts) > 1:
+                        # Quirk the parts between excluded substrings,
+                        # excluded substrings are at the odd indices.
+                        quirked_parts = parts.copy()
+                        for part in range(0, len(parts), 2):
                             if quirk.type in ("regexp", "random"):
-                                recvparts.append(
-                                    quirk.apply(
-                                        part,
-                                        first=(is_first_string),
-                                        last=is_last_string,
-                                    )
+                                quirked_parts[part] = quirk.apply(
+                                    parts[part],
+                                    first=is_first_string,
+                                    last=is_last_string,
                                 )
-                            elif quirk.type == "prefix" and is_first_string:
-                                recvparts.append(quirk.apply(part))
-                            elif quirk.type == "suffix" and is_last_string:
-                                recvparts.append(quirk.apply(part))
                             else:
-                                recvparts.append(quirk.apply(part))
-                        # Reconstruct and update string.
-                        string = ""
-                        # print("excludes: " + str(excludes))
-                        # print("sendparts: " + str(sendparts))
-                        # print("recvparts: " + str(recvparts))
-                        for part, exclude in enumerate(excludes):
-                            string += recvparts[part]
-                            string += exclude.group()
-                        string += recvparts[-1]
+                                quirked_parts[part] = quirk.apply(parts[part])
+                        quirked = "".join(quirked_parts)
                     else:
-                        # No split, apply like normal.
-                        if quirk.type not in ("prefix", "suffix"):
-                            if quirk.type in ("regexp", "random"):
-                                string = quirk.apply(
-                                    string, first=(is_first_string), last=is_last_string
-                                )
-                            else:
-                                string = quirk.apply(string)
-                        elif quirk.type == "prefix" and is_first_string:
-                            string = quirk.apply(string)
-                        elif quirk.type == "suffix" and is_last_string:
-                            string = quirk.apply(string)
+                        quirked = self._apply_quirk(
+                            quirk, string, is_first_string, is_last_string
+                        )
                 else:
-                    # No split, apply like normal.
-                    if quirk.type not in ("prefix", "suffix"):
-                        if quirk.type in ("regexp", "random"):
-                            string = quirk.apply(
-                                string, first=(is_first_string), last=is_last_string
-                            )
-                        else:
-                            string = quirk.apply(string)
-                    elif quirk.type == "prefix" and is_first_string:
-                        string = quirk.apply(string)
-                    elif quirk.type == "suffix" and is_last_string:
-                        string = quirk.apply(string)
+                    quirked = self._apply_quirk(
+                        quirk, string, is_first_string, is_last_string
+                    )
+                if quirked != string:
+                    string = quirked
+                    parts = None
             newlist.append(string)
 
         final = []
@@ -414,5 +421,16 @@ class PesterQuirkCollection:
                 final.append(item)
         return final
 
+    @staticmethod
+    def _apply_quirk(quirk, string, first, last):
+        """Apply a quirk to a whole string, prefixes and suffixes only at the ends."""
+        if quirk.type in ("regexp", "random"):
+            return quirk.apply(string, first=first, last=last)
+        if quirk.type == "prefix":
+            return quirk.apply(string) if first else string
+        if quirk.type == "suffix":
+            return quirk.apply(string) if last else string
+        return quirk.apply(string)
+
     def __iter__(self):
         yield from self.quirklist
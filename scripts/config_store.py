@@ -0,0 +1,276 @@
+"""Debounced, atomic saving of JSON files like pesterchum.js and chums.js.
+
+Changing a setting used to rewrite the whole file right away, changing a bunch
+of options at once rewrote it for every single one. These stores take changes
+right away but only write them once no more changes were made for 'delay'
+seconds, on a background thread. Files are written to a temporary file first and
+then renamed over the old one, so they're never left half-written.
+
+ConfigStore writes the whole file, for small files like pesterchum.js.
+JournalStore appends changed keys to a journal and only rewrites the whole file
+once the journal gets long, for files with many keys like chums.js. Until then
+the latest changes are only in the journal, chums.js.journal for chums.js, so
+it's also folded into the file when it's loaded and when Pesterchum closes."""
+
+import os
+import json
+import atexit
+import logging
+import threading
+
+PchumLog = logging.getLogger("pchumLogger")
+
+
+def write_atomic(path, text):
+    """Replace the file at 'path' with 'text', it's never left half-written."""
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as fp:
+        fp.write(text)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(temporary, path)
+
+
+class _BackgroundWriter:
+    """Writes changes on a thread once they stop for 'delay' seconds.
+
+    Subclasses record changes and call _changed() with self._condition held,
+    _take_pending() and _write() are called by the writer thread."""
+
+    def __init__(self, path, delay):
+        self.path = path
+        self.delay = delay
+        self._condition = threading.Condition()
+        self._changes = 0  # Counts changes, so the writer knows if it missed some.
+        self._written = 0  # Changes that are written.
+        self._flush_now = False
+        self._writer = None
+        atexit.register(self.flush)
+
+    @property
+    def dirty(self):
+        """True if there are changes that aren't written yet."""
+        return self._changes != self._written
+
+    def flush(self, timeout=5):
+        """Write pending changes now and wait until they're written."""
+        with self._condition:
+            if not self.dirty:
+                return True
+            self._flush_now = True
+            self._condition.notify_all()
+            return self._condition.wait_for(lambda: not self.dirty, timeout)
+
+    def _changed(self):
+        self._changes += 1
+        if self._writer is None:
+            self._writer = threading.Thread(
+                target=self._write_pending, name=type(self).__name__, daemon=True
+            )
+            self._writer.start()
+        self._condition.notify_all()
+
+    def _write_pending(self):
+        """Writer thread, writes what's pending after 'delay' seconds of no changes."""
+        with self._condition:
+            while True:
+                self._condition.wait_for(lambda: self.dirty)
+                # Restart the delay as long as there are new changes.
+                while not self._flush_now:
+                    changes = self._changes
+                    self._condition.wait(self.delay)
+                    if self._changes == changes:
+                        break
+                self._flush_now = False
+                changes = self._changes
+                pending = self._take_pending()
+                self._condition.release()
+                try:
+                    self._write(pending)
+                    written = True
+                except OSError as e:
+                    PchumLog.warning("Couldn't save %s: %s", self.path, e)
+                    written = False
+                finally:
+                    self._condition.acquire()
+                if written:
+                    self._written = changes
+                else:
+                    self._restore_pending(pending)
+                self._condition.notify_all()
+                if not written:
+                    # Try again after a while rather than spinning on the error.
+                    self._condition.wait(self.delay * 10)
+
+    def _take_pending(self):
+        raise NotImplementedError
+
+    def _restore_pending(self, pending):
+        """Put back changes that couldn't be written, newer ones take precedence."""
+
+    def _write(self, pending):
+        raise NotImplementedError
+
+
+class ConfigStore(_BackgroundWriter):
+    """Loads and saves a JSON file as a whole."""
+
+    def __init__(self, path, delay=0.5, indent=None):
+        super().__init__(path, delay)
+        self.indent = indent
+        self._pending = None  # Serialized data that still has to be written.
+        self._mtime = None  # mtime of the file when we last read or wrote it.
+
+    def load(self):
+        """Read the file, raises like open() and json.load() do."""
+        with open(self.path, encoding="utf-8") as fp:
+            data = json.load(fp)
+        self._mtime = self._current_mtime()
+        return data
+
+    def read(self):
+        """Read the file without remembering its mtime, for merging."""
+        with open(self.path, encoding="utf-8") as fp:
+            return json.load(fp)
+
+    def changed_on_disk(self):
+        """True if something else, like another client, wrote the file since we
+        last loaded or wrote it."""
+        mtime = self._current_mtime()
+        return mtime is not None and mtime != self._mtime
+
+    def save(self, data):
+        """Serialize 'data' now and write it once changes stop for a bit."""
+        text = json.dumps(data, indent=self.indent)
+        with self._condition:
+            self._pending = text
+            self._changed()
+
+    def _take_pending(self):
+        return self._pending
+
+    def _write(self, text):
+        write_atomic(self.path, text)
+        self._mtime = self._current_mtime()
+
+    def _current_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+
+class JournalStore(_BackgroundWriter):
+    """A JSON object saved as a snapshot file plus a journal of changed keys.
+
+    update() serializes only the changed value. Changes are appended to
+    <path>.journal as [key, value] lines, the snapshot is rewritten from
+    everything and the journal cleared once it has 'compact_after' lines, when
+    it's loaded and on close(). Lines that were only partially written when
+    Pesterchum crashed are ignored."""
+
+    def __init__(self, path, delay=1.0, compact_after=1000):
+        super().__init__(path, delay)
+        self.journal_path = path + ".journal"
+        self.compact_after = compact_after
+        self._pending = {}  # key -> serialized value, not written yet.
+        # key -> serialized value of everything, only used by the writer thread
+        # once it's started.
+        self._values = {}
+        self._journal_lines = 0
+        self._compact_requested = False
+
+    def load(self):
+        """Read the snapshot and replay the journal, returns the data."""
+        data = {}
+        try:
+            with open(self.path, encoding="utf-8") as fp:
+                data = json.load(fp)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            PchumLog.warning("Couldn't read %s, starting over: %s", self.path, e)
+        try:
+            with open(self.journal_path, encoding="utf-8") as journal:
+                for line in journal:
+                    try:
+                        key, value = json.loads(line)
+                    except (ValueError, TypeError):
+                        continue  # Partially written when Pesterchum crashed.
+                    data[key] = value
+                    self._journal_lines += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            PchumLog.warning("Couldn't read %s: %s", self.journal_path, e)
+        self._values = {key: json.dumps(value) for key, value in data.items()}
+        if self._journal_lines:
+            # So the file is up to date for older versions and editing it by hand.
+            try:
+                self._compact()
+            except OSError as e:
+                PchumLog.warning("Couldn't save %s: %s", self.path, e)
+        return data
+
+    def update(self, key, value):
+        """Serialize the new 'value' of 'key' now and save it once changes stop."""
+        text = json.dumps(value)
+        with self._condition:
+            self._pending[key] = text
+            self._changed()
+
+    def close(self, timeout=5):
+        """Write pending changes and fold the journal into the file."""
+        with self._condition:
+            self._compact_requested = True
+            self._changed()
+        return self.flush(timeout)
+
+    def _take_pending(self):
+        pending, self._pending = self._pending, {}
+        compact, self._compact_requested = self._compact_requested, False
+        return pending, compact
+
+    def _restore_pending(self, pending):
+        pending, compact = pending
+        for key, text in pending.items():
+            self._pending.setdefault(key, text)
+        self._compact_requested = self._compact_requested or compact
+
+    def _write(self, pending):
+        pending, compact = pending
+        self._values.update(pending)
+        if compact or self._journal_lines + len(pending) > self.compact_after:
+            if pending or self._journal_lines:
+                self._compact()
+            return
+        if not pending:
+            return
+        lines = "".join(
+            "[%s, %s]\n" % (json.dumps(key), text) for key, text in pending.items()
+        )
+        with open(self.journal_path, "ab+") as journal:
+            size = journal.seek(0, os.SEEK_END)
+            if size:
+                # Don't continue a partially written line.
+                journal.seek(size - 1)
+                if journal.read(1) != b"\n":
+                    lines = "\n" + lines
+            journal.write(lines.encode("utf-8"))
+            journal.flush()
+            os.fsync(journal.fileno())
+        self._journal_lines += len(pending)
+
+    def _compact(self):
+        """Write everything to the snapshot and clear the journal."""
+        write_atomic(
+            self.path,
+            "{%s}"
+            % ", ".join(
+                "%s: %s" % (json.dumps(key), text) for key, text in self._values.items()
+            ),
+        )
+        # If this fails the journal is replayed over the snapshot, which is fine.
+        with open(self.journal_path, "w", encoding="utf-8"):
+            pass
+        self._journal_lines = 0
@@ -0,0 +1,465 @@
+"""A small scriptable IRC server stand-in for exercising PesterIRC without a network.
+
+Speaks just enough of the protocol for the client: CAP, SASL PLAIN, METADATA,
+JOIN/PART, NAMES, LIST, MODE, PRIVMSG, NOTICE and TAGMSG. It's a development tool
+and not meant to be exposed to anything but localhost.
+
+Traffic the server sends to clients can be recorded to a file and replayed later,
+see FakeIRCd.replay(). Every line of a traffic file has the form
+    <seconds since start> <raw IRC line>
+'{nick}' in a line is replaced with the nick of the client it's replayed to.
+
+Run standalone with: python -m scripts.fake_ircd --port 6667
+"""
+
+import time
+import base64
+import asyncio
+import logging
+import argparse
+
+from scripts.irc_protocol import LineBuffer, parse_irc_message
+
+PchumLog = logging.getLogger("pchumLogger")
+
+SERVER_NAME = "fake.ircd"
+CAPABILITIES = (
+    "message-tags",
+    "draft/metadata-notify-2",
+    "pesterchum-tag",
+    "twitch.tv/membership",
+    "sasl",
+)
+
+
+def escape_tag_value(value):
+    """Escape a message tag value, the reverse of irc_protocol.unescape_tag_value()."""
+    return (
+        value.replace("\\", "\\\\")
+        .replace(";", "\\:")
+        .replace(" ", "\\s")
+        .replace("\r", "\\r")
+        .replace("\n", "\\n")
+    )
+
+
+class FakeClient:
+    """A client connected to FakeIRCd."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.nick = None
+        self.user = None
+        self.caps = set()
+        self.negotiating = False  # CAP negotiation blocks registration until END.
+        self.registered = False
+        self.sasl = False
+        self.account = None
+        self.channels = set()
+        self.subscriptions = set()  # Metadata keys we notify this client of.
+        self.metadata = {}
+
+    @property
+    def prefix(self):
+        return f"{self.nick}!{self.user or self.nick}@localhost"
+
+
+class FakeIRCd:
+    """Fake IRC server, one asyncio task per connected client.
+
+    'accounts' maps account names to passwords for SASL PLAIN, if it's None any
+    credentials are accepted. When 'record' is a path, everything sent to clients
+    is written to it in the traffic file format. 'latency' is how many seconds
+    the server waits before handling what a client sent, like a network round trip.
+    """
+
+    def __init__(
+        self, host="127.0.0.1", port=0, accounts=None, record=None, latency=0.0
+    ):
+        self.host = host
+        self.port = port  # 0 picks a free port, the real port is set by start().
+        self.accounts = accounts
+        self.latency = latency
+        self.clients = {}  # casefolded nick -> FakeClient
+        self.channels = {}  # casefolded channel -> [channel name, set of FakeClient]
+        self.topics = {}
+        self.received_lines = 0
+        self._server = None
+        self._record = open(record, "w", encoding="utf-8") if record else None
+        self._started = time.monotonic()
+        self.commands = {
+            "cap": self._cap,
+            "authenticate": self._authenticate,
+            "pass": self._ignore,
+            "nick": self._nick,
+            "user": self._user,
+            "ping": self._ping,
+            "pong": self._ignore,
+            "join": self._join,
+            "part": self._part,
+            "names": self._names,
+            "list": self._list,
+            "mode": self._mode,
+            "privmsg": self._message,
+            "notice": self._message,
+            "tagmsg": self._tagmsg,
+            "metadata": self._metadata,
+            "quit": self._quit,
+        }
+
+    async def start(self):
+        """Start listening, sets self.port to the port actually used."""
+        self._server = await asyncio.start_server(
+            self._handle_client, self.host, self.port
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._started = time.monotonic()
+
+    async def serve_forever(self):
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def stop(self):
+        """Stop listening and disconnect every client."""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for client in list(self.clients.values()):
+            client.writer.close()
+        if self._record:
+            self._record.close()
+            self._record = None
+
+    def send(self, client, line):
+        """Send one raw line to 'client', without the CRLF."""
+        if client.writer.is_closing():
+            return
+        client.writer.write(line.encode("utf-8", "replace") + b"\r\n")
+        if self._record:
+            offset = time.monotonic() - self._started
+            if client.nick:
+                line = line.replace(client.nick, "{nick}")
+            self._record.write(f"{offset:.6f} {line}\n")
+
+    def numeric(self, client, number, *params):
+        """Send a numeric reply, the last parameter is sent as trailing."""
+        middle = " ".join([client.nick or "*"] + list(params[:-1]))
+        self.send(client, f":{SERVER_NAME} {number} {middle} :{params[-1]}")
+
+    def find(self, nick):
+        return self.clients.get(nick.casefold())
+
+    async def replay(self, path, nick=None, speed=1.0):
+        """Replay a recorded traffic file to 'nick', or to every registered client.
+
+        'speed' scales the recorded timing, 2.0 is twice as fast, 0 sends everything
+        as fast as possible."""
+        start = time.monotonic()
+        with open(path, encoding="utf-8") as traffic:
+            for entry in traffic:
+                offset, _, line = entry.rstrip("\r\n").partition(" ")
+                if speed > 0:
+                    delay = float(offset) / speed - (time.monotonic() - start)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                if nick:
+                    targets = [self.find(nick)]
+                else:
+                    targets = [c for c in self.clients.values() if c.registered]
+                for client in targets:
+                    if client:
+                        self.send(client, line.replace("{nick}", client.nick))
+                for client in targets:
+                    if client:
+                        await client.writer.drain()
+
+    async def _handle_client(self, reader, writer):
+        client = FakeClient(writer)
+        line_buffer = LineBuffer()
+        try:
+            while data := await reader.read(65536):
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                for line in line_buffer.feed(data):
+                    self._handle_line(client, line)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._remove(client, "Connection closed")
+            writer.close()
+
+    def _handle_line(self, client, line):
+        self.received_lines += 1
+        message = parse_irc_message(line.decode("utf-8", "replace"))
+        if message is None:
+            return
+        handler = self.commands.get(message.command)
+        if handler is None:
+            if client.registered:
+                self.numeric(client, "421", message.command.upper(), "Unknown command")
+            return
+        if not client.registered and handler not in self._registration_handlers():
+            self.numeric(client, "451", "You have not registered")
+            return
+        handler(client, message)
+
+    def _registration_handlers(self):
+        return (
+            self._cap,
+            self._authenticate,
+            self._ignore,
+            self._nick,
+            self._user,
+            self._ping,
+            self._quit,
+        )
+
+    def _try_register(self, client):
+        if client.registered or client.negotiating or not (client.nick and client.user):
+            return
+        client.registered = True
+        self.numeric(client, "001", f"Welcome to the fake network {client.prefix}")
+        self.numeric(
+            client, "005", "METADATA", "CHANTYPES=#", "are supported by this server"
+        )
+        self.numeric(client, "376", "End of /MOTD command.")
+
+    def _remove(self, client, reason):
+        if client.nick and self.clients.get(client.nick.casefold()) is client:
+            del self.clients[client.nick.casefold()]
+            notified = set()
+            for key in list(client.channels):
+                notified.update(self.channels[key][1])
+                self._leave(client, key)
+            for other in notified - {client}:
+                self.send(other, f":{client.prefix} QUIT :{reason}")
+
+    def _leave(self, client, key):
+        client.channels.discard(key)
+        members = self.channels[key][1]
+        members.discard(client)
+        if not members:
+            del self.channels[key]
+
+    def _ignore(self, client, message):
+        pass
+
+    def _cap(self, client, message):
+        subcommand = message.params[0].upper() if message.params else ""
+        if subcommand == "LS":
+            client.negotiating = True
+            self.send(client, f":{SERVER_NAME} CAP * LS :{' '.join(CAPABILITIES)}")
+        elif subcommand == "REQ":
+            client.negotiating = True
+            requested = message.params[1].split()
+            reply = "ACK" if all(cap in CAPABILITIES for cap in requested) else "NAK"
+            if reply == "ACK":
+                client.caps.update(requested)
+            self.send(
+                client,
+                f":{SERVER_NAME} CAP {client.nick or '*'} {reply} :{' '.join(requested)}",
+            )
+        elif subcommand == "END":
+            client.negotiating = False
+            self._try_register(client)
+
+    def _authenticate(self, client, message):
+        token = message.params[0]
+        if not client.sasl:
+            if token.upper() != "PLAIN" or "sasl" not in client.caps:
+                self.numeric(client, "904", "SASL authentication failed")
+                return
+            client.sasl = True
+            self.send(client, "AUTHENTICATE +")
+            return
+        client.sasl = False
+        try:
+            _authzid, account, password = (
+                base64.b64decode(token).decode("utf-8").split("\0")
+            )
+        except ValueError:
+            self.numeric(client, "904", "SASL authentication failed")
+            return
+        if self.accounts is not None and self.accounts.get(account) != password:
+            self.numeric(client, "904", "SASL authentication failed")
+            return
+        client.account = account
+        self.numeric(
+            client, "900", client.prefix, account, f"You are now logged in as {account}"
+        )
+        self.numeric(client, "903", "SASL authentication successful")
+
+    def _nick(self, client, message):
+        nick = message.params[0]
+        other = self.find(nick)
+        if other is not None and other is not client:
+            self.numeric(client, "433", nick, "Nickname is already in use")
+            return
+        if client.nick and client.registered:
+            notified = {client}
+            for key in client.channels:
+                notified.update(self.channels[key][1])
+            for member in notified:
+                self.send(member, f":{client.prefix} NICK :{nick}")
+        if client.nick:
+            self.clients.pop(client.nick.casefold(), None)
+        client.nick = nick
+        self.clients[nick.casefold()] = client
+        self._try_register(client)
+
+    def _user(self, client, message):
+        client.user = message.params[0]
+        self._try_register(client)
+
+    def _ping(self, client, message):
+        token = message.params[0] if message.params else SERVER_NAME
+        self.send(client, f":{SERVER_NAME} PONG {SERVER_NAME} :{token}")
+
+    def _join(self, client, message):
+        for channel in message.params[0].split(","):
+            key = channel.casefold()
+            if key in client.channels:
+                continue
+            if key not in self.channels:
+                self.channels[key] = [channel, set()]
+            channel = self.channels[key][0]
+            client.channels.add(key)
+            self.channels[key][1].add(client)
+            for member in self.channels[key][1]:
+                self.send(member, f":{client.prefix} JOIN {channel}")
+            self._send_names(client, key)
+
+    def _part(self, client, message):
+        for channel in message.params[0].split(","):
+            key = channel.casefold()
+            if key not in client.channels:
+                self.numeric(client, "442", channel, "You're not on that channel")
+                continue
+            for member in self.channels[key][1]:
+                self.send(member, f":{client.prefix} PART {self.channels[key][0]}")
+            self._leave(client, key)
+
+    def _send_names(self, client, key):
+        channel, members = self.channels[key]
+        names = [member.nick for member in members]
+        # Keep replies well below the line length limit.
+        for start in range(0, len(names), 40):
+            self.numeric(
+                client, "353", "=", channel, " ".join(names[start : start + 40])
+            )
+        self.numeric(client, "366", channel, "End of /NAMES list.")
+
+    def _names(self, client, message):
+        for channel in message.params[0].split(","):
+            key = channel.casefold()
+            if key in self.channels:
+                self._send_names(client, key)
+            else:
+                self.numeric(client, "366", channel, "End of /NAMES list.")
+
+    def _list(self, client, message):
+        self.numeric(client, "321", "Channel", "Users  Name")
+        for key, (channel, members) in self.channels.items():
+            self.numeric(
+                client, "322", channel, str(len(members)), self.topics.get(key, "")
+            )
+        self.numeric(client, "323", "End of /LIST")
+
+    def _mode(self, client, message):
+        target = message.params[0]
+        if target.startswith("#"):
+            if target.casefold() in self.channels:
+                self.numeric(client, "324", target, "+nt", "")
+            else:
+                self.numeric(client, "403", target, "No such channel")
+        else:
+            self.numeric(client, "221", "+i")
+
+    def _route(self, client, target, line, tags=""):
+        """Send 'line' to 'target', a channel or nick. Returns False when unknown."""
+        if target.startswith("#"):
+            key = target.casefold()
+            if key not in client.channels:
+                self.numeric(client, "404", target, "Cannot send to channel")
+                return True
+            recipients = self.channels[key][1] - {client}
+        else:
+            recipient = self.find(target)
+            if recipient is None:
+                return False
+            recipients = (recipient,)
+        for recipient in recipients:
+            if not tags:
+                self.send(recipient, line)
+            elif "message-tags" in recipient.caps:
+                self.send(recipient, f"@{tags} {line}")
+        return True
+
+    def _message(self, client, message):
+        target, text = message.params[0], message.params[-1]
+        command = message.command.upper()
+        line = f":{client.prefix} {command} {target} :{text}"
+        if not self._route(client, target, line) and command == "PRIVMSG":
+            self.numeric(client, "401", target, "No such nick/channel")
+
+    def _tagmsg(self, client, message):
+        target = message.params[0]
+        # Only client tags are passed on.
+        tags = ";".join(
+            f"{key}={escape_tag_value(value)}" if value else key
+            for key, value in message.tags.items()
+            if key.startswith("+")
+        )
+        if tags:
+            self._route(client, target, f":{client.prefix} TAGMSG {target}", tags)
+
+    def _metadata(self, client, message):
+        target, subcommand = message.params[0], message.params[1].upper()
+        keys = message.params[2:]
+        if subcommand == "SUB":
+            client.subscriptions.update(key.casefold() for key in keys)
+            self.numeric(client, "770", *keys, "")
+        elif subcommand == "SET":
+            key, value = keys[0].casefold(), keys[1] if len(keys) > 1 else ""
+            client.metadata[key] = value
+            self.numeric(client, "761", client.nick, key, "*", value)
+            for other in self.clients.values():
+                if other is not client and key in other.subscriptions:
+                    self.send(
+                        other, f":{SERVER_NAME} METADATA {client.nick} {key} * :{value}"
+                    )
+        elif subcommand == "GET":
+            owner = self.find(target)
+            for key in keys:
+                if owner is None:
+                    self.numeric(client, "766", target, key, "No matching key")
+                elif key.casefold() not in owner.metadata:
+                    self.numeric(client, "766", owner.nick, key, "No matching key")
+                else:
+                    value = owner.metadata[key.casefold()]
+                    self.numeric(client, "761", owner.nick, key, "*", value)
+
+    def _quit(self, client, message):
+        reason = message.params[0] if message.params else "Quit"
+        self.send(client, f"ERROR :Closing link ({reason})")
+        self._remove(client, f"Quit: {reason}")
+        client.writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6667)
+    parser.add_argument("--record", help="record traffic sent to clients to a file")
+    args = parser.parse_args()
+    server = FakeIRCd(args.host, args.port, record=args.record)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
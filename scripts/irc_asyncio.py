@@ -0,0 +1,197 @@
+"""Optional asyncio-based transport for the IRC connection, used by irc.py.
+
+Reads, writes and keepalive pings are all driven by an asyncio event loop instead of
+a thread blocking on recv(). One loop, run in a daemon thread, is shared by every
+connection, but AsyncIRCConnection works on any running loop (e.g. a qasync one).
+"""
+
+import ssl
+import socket
+import asyncio
+import logging
+import threading
+
+from scripts.irc_protocol import LineBuffer
+from scripts.reconnect import backoff_delay
+
+PchumLog = logging.getLogger("pchumLogger")
+
+KEEPALIVE_INTERVAL = 45  # Seconds of silence before we PING the server ourselves.
+READ_TIMEOUT = 90  # Seconds of silence before the connection is considered dead.
+CONNECT_ATTEMPTS = 3  # Connection attempts before giving up.
+
+
+class IRCEventLoop:
+    """An asyncio event loop running forever in a daemon thread.
+
+    Use IRCEventLoop.shared() so all connections share one loop."""
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self._run, name="IRCEventLoop", daemon=True
+        )
+        self.thread.start()
+
+    @classmethod
+    def shared(cls):
+        """Return the process-wide loop, starting it if required."""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        """Schedule a coroutine on the loop, returns a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+
+class IRCProtocol(asyncio.Protocol):
+    """asyncio protocol that splits incoming data into lines and passes them on."""
+
+    def __init__(self, line_callback, loop):
+        self._line_callback = line_callback
+        self._loop = loop
+        self._line_buffer = LineBuffer()
+        self.transport = None
+        self.last_received = loop.time()
+        self.closed = loop.create_future()  # Result is the exception or None.
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.last_received = self._loop.time()
+        for line in self._line_buffer.feed(data):
+            self._line_callback(line)
+
+    def connection_lost(self, exc):
+        self.set_closed(exc)
+
+    def set_closed(self, exc=None):
+        """Mark the connection as closed, with an optional exception to raise."""
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+
+class AsyncIRCConnection:
+    """An IRC connection driven by asyncio.
+
+    Implements sendall(), fileno(), shutdown() and close() so it can stand in for
+    the socket used by SendIRC and PesterIRC. All of these are thread-safe."""
+
+    def __init__(self, server, port, ssl_context=None, line_callback=None):
+        self.server = server
+        self.port = port
+        self.ssl_context = ssl_context  # None for plaintext.
+        self.line_callback = line_callback
+        self._loop = None
+        self._loop_thread = None
+        self._transport = None
+        self._protocol = None
+        self._fileno = -1
+        self.connected = False  # Set once the connection has been opened.
+
+    async def run(self, on_connected=None):
+        """Connect, call 'on_connected', then handle the connection until it closes.
+
+        Raises the exception that ended the connection, if any."""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        await self._open()
+        keepalive = self._loop.create_task(self._keepalive())
+        try:
+            if on_connected:
+                on_connected()
+            exception = await self._protocol.closed
+        finally:
+            keepalive.cancel()
+            self._fileno = -1
+        if exception:
+            raise exception
+
+    async def _open(self):
+        """Open the connection, retrying with backoff on errors other than SSL ones."""
+        for attempt in range(CONNECT_ATTEMPTS):
+            PchumLog.info("Connecting to %s:%s (asyncio)", self.server, self.port)
+            try:
+                self._transport, self._protocol = await self._loop.create_connection(
+                    lambda: IRCProtocol(self._handle_line, self._loop),
+                    self.server,
+                    self.port,
+                    ssl=self.ssl_context,
+                    server_hostname=self.server if self.ssl_context else None,
+                )
+            except ssl.SSLError:
+                raise
+            except OSError as connect_exception:
+                if attempt == CONNECT_ATTEMPTS - 1:
+                    raise
+                delay = backoff_delay(attempt)
+                PchumLog.warning(
+                    "Connecting failed (%s), retrying in %.1fs.",
+                    connect_exception,
+                    delay,
+                )
+                await asyncio.sleep(delay)
+            else:
+                self._fileno = self._transport.get_extra_info("socket").fileno()
+                self.connected = True
+                return
+
+    def _handle_line(self, line):
+        if self.line_callback:
+            self.line_callback(line)
+
+    async def _keepalive(self):
+        """PING the server when it's quiet and drop the connection when it stays quiet."""
+        while True:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            idle = self._loop.time() - self._protocol.last_received
+            if idle >= READ_TIMEOUT:
+                self._protocol.set_closed(socket.timeout("timed out"))
+                self._transport.abort()
+                return
+            if idle >= KEEPALIVE_INTERVAL:
+                self._transport.write(b"PING :keepalive\r\n")
+
+    def _in_loop_thread(self):
+        return threading.get_ident() == self._loop_thread
+
+    def _call(self, function, *args):
+        """Run 'function' on the loop, directly if we're already on the loop thread."""
+        if self._in_loop_thread():
+            function(*args)
+        else:
+            self._loop.call_soon_threadsafe(function, *args)
+
+    def _write(self, data):
+        if not self._transport.is_closing():
+            self._transport.write(data)
+
+    def sendall(self, data):
+        """Queue 'data' for writing, raises ConnectionError when not connected."""
+        if self._transport is None or self._transport.is_closing():
+            raise ConnectionError("Connection is not open.")
+        self._call(self._write, bytes(data))
+
+    def fileno(self):
+        """Return the underlying socket's file descriptor, -1 if closed."""
+        return self._fileno
+
+    def shutdown(self, _how=None):
+        """Same as close(), buffered data is still flushed before closing."""
+        self.close()
+
+    def close(self):
+        """Close the connection after writing any buffered data."""
+        self._fileno = -1
+        if self._transport is not None:
+            self._call(self._transport.close)
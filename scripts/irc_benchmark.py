@@ -0,0 +1,700 @@
+"""Headless end-to-end benchmark for PesterIRC against scripts/fake_ircd.py.
+
+Messages are injected by the fake server with a timestamp and timed until
+PesterIRC emits messageReceived/memoReceived for them, so the measurement covers
+the socket, line splitting, parsing and dispatch. Reports messages per second,
+p50/p99 latency and, for soak runs, how much Python memory was allocated over time.
+
+    python -m scripts.irc_benchmark --messages 20000
+    python -m scripts.irc_benchmark --soak 600 --rate 200
+    python -m scripts.irc_benchmark --replay traffic.txt --speed 4
+    python -m scripts.irc_benchmark --reconnect 20
+
+--micro measures single parts against the implementation they replaced, on a
+burst of server lines, or on the lines of a traffic file given with --replay:
+
+    python -m scripts.irc_benchmark --micro reader
+    python -m scripts.irc_benchmark --micro parser
+
+--micro render times lexing and converting a memo scroll-back on its own:
+
+    python -m scripts.irc_benchmark --micro render
+
+--flood delivers bursts of memo lines to a conversation's text area, one line
+per event loop iteration, and counts repaints and the time the UI thread spent.
+Messages are added once per frame like in Pesterchum, and one by one to compare:
+
+    python -m scripts.irc_benchmark --flood 100 --burst 50
+
+Run it from the repository root, PyQt has to be installed."""
+
+import sys
+import time
+import socket
+import timeit
+import asyncio
+import argparse
+import selectors
+import threading
+import tracemalloc
+
+try:
+    from PyQt6 import QtCore, QtGui, QtWidgets
+except ImportError:
+    print("PyQt5 fallback (irc_benchmark.py)")
+    from PyQt5 import QtCore, QtGui, QtWidgets
+
+import quirks  # noqa: F401, has to be imported before parsetools (via irc).
+import embeds
+from irc import PesterIRC, RECV_SIZE
+from mood import Mood
+from dataobjs import PesterProfile
+from parsetools import lexMessage, convertTags, imageSources
+from scripts import lexer_compare, scrollback_soak
+from scripts.fake_ircd import FakeIRCd
+from scripts.irc_protocol import LineBuffer, parse_irc_message
+from scripts.irc_asyncio import IRCEventLoop
+from scripts.reconnect import SessionSnapshot
+
+HANDLE = "benchmarkTester"
+SENDER = "benchmarkSender"
+MEMO = "#benchmark"
+SCROLLBACK = 1000
+
+
+class HeadlessConfig:
+    def __init__(self, asyncio_transport):
+        self._asyncio_transport = asyncio_transport
+
+    def server(self):
+        return "127.0.0.1"
+
+    def asyncio_transport(self):
+        return self._asyncio_transport
+
+    def irc_compatibility_mode(self):
+        return False
+
+
+class HeadlessUserProfile:
+    def getAutoIdentify(self):
+        return False
+
+    def getNickServPass(self):
+        return ""
+
+
+class HeadlessRandomHandler:
+    randNick = "randomEncounter"
+
+    def setRunning(self, _on):
+        pass
+
+
+class HeadlessChumList:
+    chums = []
+
+
+class HeadlessWindow:
+    """The parts of PesterWindow that PesterIRC uses."""
+
+    def __init__(self, asyncio_transport=False):
+        self.config = HeadlessConfig(asyncio_transport)
+        self.userprofile = HeadlessUserProfile()
+        self.randhandler = HeadlessRandomHandler()
+        self.chumList = HeadlessChumList()
+        self.chumdb = None
+        self.convos = {}
+        self.modes = ""
+        self.sincerecv = 0
+        self._profile = PesterProfile(HANDLE, QtGui.QColor("black"), Mood("chummy"))
+
+    def profile(self):
+        return self._profile
+
+
+class LatencyRecorder(QtCore.QObject):
+    """Collects the latency of every benchmark message as it's emitted.
+
+    Slots are connected directly so they run on the IRC thread, at emission."""
+
+    def __init__(self, expected=0):
+        QtCore.QObject.__init__(self)
+        self.connected = threading.Event()
+        self.latencies = []
+        self.received = 0
+        self.expected = expected
+        self.last_received = None
+        self.done = threading.Event()
+
+    @QtCore.pyqtSlot()
+    def set_connected(self):
+        self.connected.set()
+
+    @QtCore.pyqtSlot(str, str)
+    def message(self, _handle, msg):
+        self._record(msg)
+
+    @QtCore.pyqtSlot(str, str, str)
+    def memo(self, _channel, _handle, msg):
+        self._record(msg)
+
+    def _record(self, msg):
+        now = time.perf_counter_ns()
+        self.received += 1
+        self.last_received = now
+        if msg.startswith("bench "):
+            self.latencies.append(now - int(msg.split(" ", 2)[2]))
+        if self.expected and self.received >= self.expected:
+            self.done.set()
+
+    def percentile(self, percent):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * percent / 100))
+        return ordered[index] / 1e6  # ms
+
+
+class Benchmark:
+    """Runs a fake server and a PesterIRC connected to it."""
+
+    def __init__(self, asyncio_transport=False, latency=0.0):
+        # Own loop so the server doesn't share one with the asyncio transport.
+        self.loop = IRCEventLoop()
+        self.server = FakeIRCd(latency=latency)
+        self.run(self.server.start())
+        self.window = HeadlessWindow(asyncio_transport)
+        self.recorder = LatencyRecorder()
+        self.irc = self._new_irc(SessionSnapshot(channels=[MEMO]))
+
+    def _new_irc(self, session):
+        direct = QtCore.Qt.ConnectionType.DirectConnection
+        irc = PesterIRC(
+            self.window,
+            "127.0.0.1",
+            self.server.port,
+            False,
+            session=session,
+        )
+        irc.connected.connect(self.recorder.set_connected, direct)
+        irc.messageReceived.connect(self.recorder.message, direct)
+        irc.memoReceived.connect(self.recorder.memo, direct)
+        return irc
+
+    def run(self, coroutine, timeout=None):
+        return self.loop.submit(coroutine).result(timeout)
+
+    def start(self):
+        """Connect and wait until we're registered and in the memo."""
+        started = time.perf_counter()
+        self.irc.start()
+        if not self.recorder.connected.wait(10):
+            raise RuntimeError("Didn't connect to the fake server.")
+        while not self.run(self._in_memo()):
+            time.sleep(0.01)
+        return time.perf_counter() - started
+
+    async def _in_memo(self):
+        client = self.server.find(HANDLE)
+        return client is not None and MEMO in client.channels
+
+    async def _inject(self, count, rate, memo_every):
+        """Send 'count' messages to the client, at 'rate' per second if set."""
+        client = self.server.find(HANDLE)
+        started = time.perf_counter()
+        for number in range(count):
+            if memo_every and number % memo_every == 0:
+                target = MEMO
+            else:
+                target = HANDLE
+            self.server.send(
+                client,
+                f":{SENDER}!{SENDER}@localhost PRIVMSG {target} "
+                f":bench {number} {time.perf_counter_ns()}",
+            )
+            if rate:
+                delay = (number + 1) / rate - (time.perf_counter() - started)
+                if delay > 0:
+                    await client.writer.drain()
+                    await asyncio.sleep(delay)
+            elif number % 256 == 0:
+                await client.writer.drain()
+        await client.writer.drain()
+
+    def reconnect(self, resume=True):
+        """Drop the connection from the server's side and time until a new
+        connection is registered and back in the memo.
+
+        With 'resume' the new connection gets a SessionSnapshot, like the one
+        MainProgram.startIRC() passes, otherwise it joins once it's connected, like
+        the main thread did before. Returns the seconds it took and the number of
+        lines the client sent meanwhile."""
+        old = self.irc
+        self.recorder.connected.clear()
+        sent_before = self.server.received_lines
+        started = time.perf_counter()
+        self.run(self._drop())
+        if not old.wait(10000) or not old.dropped:
+            raise RuntimeError("The connection didn't end as dropped.")
+        if resume:
+            session = SessionSnapshot(channels=[MEMO], mood_sync=old.mood_sync)
+        else:
+            session = SessionSnapshot()
+        self.irc = self._new_irc(session)
+        self.irc.start()
+        if not self.recorder.connected.wait(10):
+            raise RuntimeError("Didn't reconnect to the fake server.")
+        if not resume:
+            self.irc.join_channel(MEMO)
+        while not self.run(self._in_memo()):
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - started
+        return elapsed, self.server.received_lines - sent_before
+
+    async def _drop(self):
+        client = self.server.find(HANDLE)
+        client.writer.close()
+        # Wait until the server forgot about it, so the nick is free again.
+        while self.server.find(HANDLE) is client:
+            await asyncio.sleep(0.001)
+
+    def throughput(self, count, memo_every=10):
+        self.recorder.expected = self.recorder.received + count
+        self.recorder.done.clear()
+        started = time.perf_counter_ns()
+        self.run(self._inject(count, 0, memo_every))
+        self.recorder.done.wait(60)
+        elapsed = (self.recorder.last_received - started) / 1e9
+        return self.recorder.received / elapsed
+
+    def soak(self, seconds, rate, interval, memo_every=10):
+        """Send at a steady rate for 'seconds', printing memory use every 'interval'."""
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        future = self.loop.submit(self._inject(int(seconds * rate), rate, memo_every))
+        started = time.perf_counter()
+        while not future.done():
+            time.sleep(min(interval, 1.0))
+            elapsed = time.perf_counter() - started
+            if int(elapsed) % interval == 0:
+                current, peak = tracemalloc.get_traced_memory()
+                print(
+                    f"{elapsed:7.1f}s received {self.recorder.received:8d} "
+                    f"memory +{(current - baseline) / 1024:.1f} KiB "
+                    f"(peak +{(peak - baseline) / 1024:.1f} KiB)"
+                )
+        future.result()
+        time.sleep(0.5)
+        growth = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+        return growth
+
+    def replay(self, path, speed):
+        started = time.perf_counter()
+        self.run(self.server.replay(path, HANDLE, speed))
+        return time.perf_counter() - started
+
+    def stop(self):
+        self.irc.disconnect_irc()
+        self.irc.wait(5000)
+        self.run(self.server.stop())
+
+
+def synthetic_burst(count):
+    """Lines like the ones a server sends when joining a busy memo and listing
+    memos: NAMES and LIST replies, tagged messages and metadata notifications."""
+    lines = []
+    for number in range(count):
+        kind = number % 4
+        if kind == 0:
+            nicks = " ".join(f"@chum{number}x{i}" for i in range(40))
+            lines.append(f":fake.ircd 353 {HANDLE} = {MEMO} :{nicks}")
+        elif kind == 1:
+            lines.append(
+                f":fake.ircd 322 {HANDLE} #memo{number} {number % 97} "
+                f":[+nt] a memo about number {number}"
+            )
+        elif kind == 2:
+            lines.append(
+                f"@time=2024-01-01T00:00:00.000Z;+pesterchum=COLOR\\s>0,0,0 "
+                f":{SENDER}!{SENDER}@localhost PRIVMSG {HANDLE} "
+                f":<c=0,0,0>BS: hey, message number {number}</c>"
+            )
+        else:
+            lines.append(f":fake.ircd METADATA chum{number} mood * :{number % 23}")
+    return lines
+
+
+def traffic_lines(path):
+    """The raw lines of a traffic file, see FakeIRCd.replay()."""
+    with open(path, encoding="utf-8") as traffic:
+        return [
+            entry.rstrip("\r\n").partition(" ")[2].replace("{nick}", HANDLE)
+            for entry in traffic
+        ]
+
+
+def read_legacy(sock):
+    """The reader PesterIRC used before: recv(1024) into a bytes buffer that's
+    split again as a whole after every read. Returns the number of lines."""
+    lines = 0
+    buffer = b""
+    while True:
+        data = sock.recv(1024)
+        if not data:
+            return lines
+        buffer += data
+        split_buffer = buffer.split(b"\r\n")
+        buffer = b""
+        if split_buffer[-1]:
+            # Incomplete line, add it back to the buffer.
+            buffer = split_buffer.pop()
+        lines += sum(1 for line in split_buffer if line)
+
+
+def read_selector(sock):
+    """The reader of PesterIRC._conn_generator(). Returns the number of lines."""
+    lines = 0
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    line_buffer = LineBuffer()
+    view = memoryview(bytearray(RECV_SIZE))
+    try:
+        while True:
+            selector.select(timeout=10)
+            received = sock.recv_into(view)
+            if not received:
+                return lines
+            lines += len(line_buffer.feed(view[:received]))
+    finally:
+        selector.close()
+
+
+def time_reader(reader, data):
+    """Send 'data' over a loopback connection and time 'reader' reading all of it."""
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        sender = socket.create_connection(listener.getsockname())
+        receiver, _address = listener.accept()
+
+    def send():
+        with sender:
+            sender.sendall(data)
+
+    with receiver:
+        writer = threading.Thread(target=send)
+        started = time.perf_counter()
+        writer.start()
+        lines = reader(receiver)
+        elapsed = time.perf_counter() - started
+        writer.join()
+    return lines, elapsed
+
+
+def micro_reader(lines, repeat):
+    data = "".join(line + "\r\n" for line in lines).encode("utf-8") * repeat
+    print(f"Reading {len(data) / 1024 / 1024:.1f} MiB, {len(lines) * repeat} lines")
+    for name, reader in (("recv(1024)", read_legacy), ("selector", read_selector)):
+        count, elapsed = min(
+            (time_reader(reader, data) for _ in range(3)), key=lambda r: r[1]
+        )
+        print(
+            f"  {name:12s} {count / elapsed:10.0f} lines/s "
+            f"{len(data) / elapsed / 1024 / 1024:7.1f} MiB/s"
+        )
+
+
+def parse_legacy(line):
+    """parse_irc_line() before parse_irc_message() replaced it, tags stay raw."""
+    parts = line.split(" ")
+    tags = None
+    prefix = None
+    if parts[0].startswith(":"):
+        prefix = parts[0][1:]
+        command = parts[1]
+        args = parts[2:]
+    elif parts[0].startswith("@"):
+        tags = parts[0]  # IRCv3 message tag
+        prefix = parts[1][1:]
+        command = parts[2]
+        args = parts[3:]
+    else:
+        command = parts[0]
+        args = parts[1:]
+    command = command.casefold()
+
+    # If ':' is present the subsequent args are one parameter.
+    fused_args = []
+    for idx, arg in enumerate(args):
+        if arg.startswith(":"):
+            final_param = " ".join(args[idx:])
+            fused_args.append(final_param[1:])
+            break
+        fused_args.append(arg)
+
+    return tags, prefix, command, fused_args
+
+
+# Lines with an empty trailing parameter, which has to be kept.
+EMPTY_TRAILING = (
+    ":x PRIVMSG #c :",
+    ":srv 353 me = #c :",
+    ":srv 332 me #c :",
+    "@a=b :x TOPIC #c :",
+    "PING :",
+)
+
+
+def compare_parsers(lines):
+    """Print the lines parse_irc_message() reads differently than parse_legacy()."""
+    differing = 0
+    for line in (*EMPTY_TRAILING, *lines):
+        message = parse_irc_message(line)
+        parsed = (message.prefix, message.command, message.params) if message else None
+        if parsed != parse_legacy(line)[1:]:
+            differing += 1
+            print(f"  {line!r}\n    split       {parse_legacy(line)[1:]}")
+            print(f"    single scan {parsed}")
+    print(f"{differing} lines parse differently")
+
+
+def micro_parser(lines, repeat):
+    compare_parsers(lines)
+    lines = lines * repeat
+    print(f"Parsing {len(lines)} lines")
+    for name, parse in (
+        ("split", parse_legacy),
+        ("single scan", parse_irc_message),
+        # Tags are decoded on access, which only TAGMSG does.
+        ("+ tags", lambda line: parse_irc_message(line).tags),
+    ):
+        elapsed = min(timeit.repeat(lambda: list(map(parse, lines)), number=1))
+        print(f"  {name:12s} {len(lines) / elapsed:10.0f} lines/s")
+
+
+def memo_conversions(msg):
+    """What receiving a memo message converts it to.
+
+    MemoText.addMessage shows its images and html, PesterLog.log stores ctag and
+    newMemoMsg looks for mentions in the text of the unlexed message."""
+    lexmsg = lexMessage(msg)
+    imageSources(lexmsg)
+    convertTags(lexmsg)
+    convertTags(lexmsg, "ctag")
+    convertTags(msg, "text")
+    return lexmsg
+
+
+def micro_render(_lines, repeat):
+    """A memo scroll-back of SCROLLBACK messages from the lexer corpus, lexed and
+    converted to everything receiving a memo message converts it to."""
+    embeds.manager.mainwindow = lexer_compare.HeadlessWindow()
+    with open(lexer_compare.CORPUS, encoding="utf-8") as corpus:
+        messages = corpus.read().splitlines()
+    messages = (messages * (SCROLLBACK // len(messages) + 1))[:SCROLLBACK]
+    print(f"Receiving a scroll-back of {len(messages)} memo messages")
+    elapsed = min(
+        timeit.repeat(
+            lambda: [memo_conversions(msg) for msg in messages],
+            number=1,
+            repeat=repeat,
+        )
+    )
+    print(f"  {elapsed * 1000:7.2f} ms {elapsed / len(messages) * 1e6:6.2f} us/message")
+
+
+class PaintCounter(QtCore.QObject):
+    """Counts the paint events of a widget."""
+
+    def __init__(self, widget):
+        super().__init__(widget)
+        self.paints = 0
+        widget.installEventFilter(self)
+
+    def eventFilter(self, watched, event):
+        if event.type() == QtCore.QEvent.Type.Paint:
+            self.paints += 1
+        return False
+
+
+def flood(app, bursts, burst, gap, one_by_one):
+    """Deliver 'bursts' bursts of 'burst' lines 'gap' ms apart to a shown
+    PesterText, returns the repaints, the UI thread's CPU time and whether it
+    stayed at the bottom."""
+    text = scrollback_soak.text_area(2000)
+    text.window().show()
+    counter = PaintCounter(text.viewport())
+    messages = scrollback_soak.corpus_html()
+    loop = QtCore.QEventLoop()
+    lines = iter(range(bursts * burst))
+    following = [True]
+
+    def deliver():
+        number = next(lines, None)
+        if number is None:
+            # Let the last batch be added and painted.
+            QtCore.QTimer.singleShot(100, loop.quit)
+            return
+        text.append("%s %d" % (messages[number % len(messages)], number))
+        if one_by_one:
+            text.flushMessages()
+        scrollbar = text.verticalScrollBar()
+        if not text.pendingMessages and scrollbar.value() != scrollbar.maximum():
+            following[0] = False
+        # A new burst after 'gap' ms, the lines of a burst as fast as they come.
+        QtCore.QTimer.singleShot(gap if (number + 1) % burst == 0 else 0, deliver)
+
+    app.processEvents()
+    counter.paints = 0
+    started = time.thread_time()
+    QtCore.QTimer.singleShot(0, deliver)
+    loop.exec()
+    elapsed = time.thread_time() - started
+    text.window().close()
+    return counter.paints, elapsed, following[0]
+
+
+MICRO_BENCHMARKS = {
+    "reader": micro_reader,
+    "parser": micro_parser,
+    "render": micro_render,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument(
+        "--memo-every",
+        type=int,
+        default=10,
+        help="every Nth message goes to a memo instead of a DM",
+    )
+    parser.add_argument(
+        "--asyncio", action="store_true", help="use the asyncio transport"
+    )
+    parser.add_argument(
+        "--soak",
+        type=float,
+        metavar="SECONDS",
+        help="send at a steady rate and track memory growth",
+    )
+    parser.add_argument(
+        "--rate", type=float, default=100.0, help="messages per second for --soak"
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=10,
+        help="seconds between memory reports for --soak",
+    )
+    parser.add_argument("--replay", metavar="FILE", help="replay a traffic file")
+    parser.add_argument(
+        "--reconnect",
+        type=int,
+        metavar="TIMES",
+        help="measure the time to reconnect and rejoin after a dropped connection",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        metavar="MS",
+        help="round trip time the fake server simulates",
+    )
+    parser.add_argument(
+        "--micro",
+        choices=sorted(MICRO_BENCHMARKS),
+        action="append",
+        help="measure a single part instead, can be given more than once",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=20,
+        help="times the lines are repeated for --micro",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="replay speed, 0 is as fast as possible",
+    )
+    parser.add_argument(
+        "--flood",
+        type=int,
+        metavar="BURSTS",
+        help="measure adding bursts of lines to a conversation instead",
+    )
+    parser.add_argument("--burst", type=int, default=50, help="lines per burst")
+    parser.add_argument(
+        "--gap", type=int, default=20, help="ms between bursts for --flood"
+    )
+    args = parser.parse_args()
+
+    if args.flood:
+        app = QtWidgets.QApplication(sys.argv)
+        lines = args.flood * args.burst
+        print(f"Flooding {args.flood} bursts of {args.burst} lines")
+        for name, one_by_one in (("per frame", False), ("one by one", True)):
+            paints, elapsed, following = flood(
+                app, args.flood, args.burst, args.gap, one_by_one
+            )
+            print(
+                f"  {name:10s} {paints:5d} repaints, {elapsed:6.2f}s UI thread, "
+                f"{elapsed / lines * 1000:5.2f} ms/line, "
+                f"{'stayed' if following else 'did not stay'} at the bottom"
+            )
+        return
+
+    if args.micro:
+        if args.replay:
+            lines = traffic_lines(args.replay)
+        else:
+            lines = synthetic_burst(1000)
+        for name in args.micro:
+            MICRO_BENCHMARKS[name](lines, args.repeat)
+        return
+
+    _app = QtCore.QCoreApplication(sys.argv)
+    benchmark = Benchmark(args.asyncio, args.latency / 1000)
+    try:
+        print(f"Connected and joined in {benchmark.start() * 1000:.1f}ms")
+        if args.reconnect:
+            for resume in (False, True):
+                results = [benchmark.reconnect(resume) for _ in range(args.reconnect)]
+                times = sorted(elapsed for elapsed, _lines in results)
+                print(
+                    f"Reconnected and rejoined {'with' if resume else 'without'} "
+                    f"the session in {times[len(times) // 2] * 1000:.1f}ms "
+                    f"(median, max {times[-1] * 1000:.1f}ms), "
+                    f"{results[-1][1]} lines sent"
+                )
+            print("Not counting the backoff delay before reconnecting.")
+        elif args.replay:
+            elapsed = benchmark.replay(args.replay, args.speed)
+            print(
+                f"Replayed in {elapsed:.2f}s, "
+                f"{benchmark.recorder.received} messages emitted"
+            )
+        elif args.soak:
+            growth = benchmark.soak(
+                args.soak, args.rate, args.interval, args.memo_every
+            )
+            print(f"Memory growth: {growth / 1024:.1f} KiB")
+        else:
+            rate = benchmark.throughput(args.messages, args.memo_every)
+            print(f"{rate:.0f} messages/s")
+        recorder = benchmark.recorder
+        if recorder.latencies:
+            print(
+                f"Latency p50 {recorder.percentile(50):.3f}ms, "
+                f"p99 {recorder.percentile(99):.3f}ms "
+                f"over {len(recorder.latencies)} messages"
+            )
+    finally:
+        benchmark.stop()
+
+
+if __name__ == "__main__":
+    main()
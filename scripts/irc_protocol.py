@@ -1,21 +1,92 @@
 """IRC-related functions and classes to be imported by irc.py"""
 
 import ssl
+import sys
 import time
+import queue
 import base64
 import logging
+import contextlib
+import itertools
+import threading
+import collections
 
 PchumLog = logging.getLogger("pchumLogger")
 
+# Outgoing lines are paced with a token bucket, UnrealIRCd's default anti-flood
+# settings allow a bit over ten commands per second after a short burst.
+FLOOD_BURST = 20  # Lines that can be sent at once.
+FLOOD_RATE = 10.0  # Lines per second after the burst is spent.
+SEND_QUEUE_SIZE = 4096  # Maximum number of queued commands or pipelines.
+MAX_BATCH_BYTES = 8192  # Maximum number of bytes written with one sendall().
+
+PRIORITY_STOP = 0  # Wakes up the writer thread so it can stop.
+PRIORITY_URGENT = 1  # Wakes up the writer thread for PING/PONG, see _send_urgent().
+PRIORITY_NORMAL = 2
+_STOP = object()  # Queued by stop() in place of lines.
+
+
+class TokenBucket:
+    """Token bucket rate limiter, one token is one line."""
+
+    def __init__(self, rate=FLOOD_RATE, burst=FLOOD_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def take(self):
+        """Take a token, returns 0 on success or the seconds to wait for one."""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+
+def _ignore_failure(_exception):
+    """Default SendIRC.broken_callback, the writer already logged the failure."""
+
+
+def _count_lines(items):
+    """Number of lines in queued items, the stop item has none."""
+    return sum(len(lines) for _p, _s, lines, _q in items if lines is not _STOP)
+
 
 class SendIRC:
     """Provides functions for outgoing IRC commands.
 
     Functions are protocol-compliant but don't implement all valid uses of certain commands.
-    """
+
+    Commands are put in a bounded queue and written by a separate thread, which
+    coalesces queued lines into a single write and paces them with a TokenBucket.
+    PING and PONG aren't queued or paced, the writer sends them as soon as it's
+    done with its current write, even while it's waiting for flood control."""
 
     def __init__(self):
         self.socket = None  # INET socket connected with server.
+        # (priority, sequence, lines, time queued), a pipeline is one item.
+        self._queue = queue.PriorityQueue(SEND_QUEUE_SIZE)
+        self._sequence = itertools.count()  # Keeps lines of equal priority in order.
+        self._bucket = TokenBucket()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        # Called with the exception on the writer thread when writing fails,
+        # PesterIRC drops the connection so it's reconnected.
+        self.broken_callback = _ignore_failure
+        self._urgent = collections.deque()  # (line, time queued) of PING/PONG.
+        self._wakeup = threading.Event()  # Set when something is added to _urgent.
+        self._local = threading.local()  # Lines of a pipeline being collected.
+        self._stopped = False
+        self._unsent = 0  # Lines queued but not yet written or discarded.
+        self._unsent_condition = threading.Condition()
+        # Counters, see stats().
+        self.sent_lines = 0
+        self.sent_batches = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
 
     def _send(self, *args: str, text=None):
         """Send a command to the IRC server.
@@ -44,7 +115,221 @@ class SendIRC:
         outgoing_bytes = command.encode(encoding="utf-8", errors="replace")
 
         PchumLog.debug("Sending: %s", command)
-        self.socket.sendall(outgoing_bytes)
+        if args and args[0] in ("PING", "PONG"):
+            self._send_urgent(outgoing_bytes)
+            return
+        pipeline = getattr(self._local, "pipeline", None)
+        if pipeline is not None:
+            pipeline.append(outgoing_bytes)
+        else:
+            self._enqueue((outgoing_bytes,))
+
+    def _enqueue(self, lines):
+        """Queue lines for the writer thread to write together, starting it if required."""
+        if self._stopped:
+            raise ConnectionError("Sending was stopped.")
+        with self._unsent_condition:
+            self._unsent += len(lines)
+        try:
+            self._queue.put(
+                (PRIORITY_NORMAL, next(self._sequence), lines, time.monotonic()),
+                timeout=5,
+            )
+        except queue.Full as full:
+            self._mark_sent(len(lines))
+            raise ConnectionError("Send queue is full.") from full
+        self._start_writer()
+
+    def _send_urgent(self, outgoing_bytes):
+        """Have the writer send a line ahead of the queue and without flood control."""
+        if self._stopped:
+            raise ConnectionError("Sending was stopped.")
+        with self._unsent_condition:
+            self._unsent += 1
+        self._urgent.append((outgoing_bytes, time.monotonic()))
+        self._wakeup.set()
+        try:
+            # Wakes up the writer if it's waiting for the queue.
+            self._queue.put_nowait(
+                (PRIORITY_URGENT, next(self._sequence), (), time.monotonic())
+            )
+        except queue.Full:
+            pass  # It's busy and checks for urgent lines between writes.
+        self._start_writer()
+
+    def _start_writer(self):
+        # Both the main and the IRC thread send, only one writer may drain the queue.
+        with self._writer_lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(
+                    target=self._write_queue, name="SendIRC", daemon=True
+                )
+                self._writer.start()
+
+    def _mark_sent(self, count):
+        """Mark 'count' lines as no longer waiting, written or not."""
+        with self._unsent_condition:
+            self._unsent -= count
+            self._unsent_condition.notify_all()
+
+    def _write_queue(self):
+        """Writer thread, sends queued lines in batches until stopped."""
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < FLOOD_BURST:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if self._stopped or any(item[2] is _STOP for item in batch):
+                self._discard_queue(batch)
+                return
+            try:
+                self._write_urgent()
+                self._write_batch(batch)
+            except Exception as exception:
+                # Not just OSError, the socket can be closed and set to None under us.
+                PchumLog.warning("Send failed, discarding queue: %s", exception)
+                self._discard_queue([])
+                self._report_broken(exception)
+            finally:
+                self._mark_sent(_count_lines(batch))
+
+    def _report_broken(self, exception):
+        """Tell the connection that writing failed, unless it's being closed."""
+        if self._stopped:
+            return
+        try:
+            self.broken_callback(exception)
+        except Exception:
+            PchumLog.exception("Error while reporting a failed send.")
+
+    def _write_batch(self, batch):
+        """Write a batch of queued lines, waiting for flood control where needed."""
+        chunk = []
+        chunk_size = 0
+        for _priority, _sequence, lines, queued_at in batch:
+            for outgoing_bytes in lines:
+                wait = self._bucket.take()
+                if wait:
+                    self._write_chunk(chunk)
+                    chunk = []
+                    chunk_size = 0
+                    self._wait(wait)
+                    self._bucket.take()
+                if chunk_size + len(outgoing_bytes) > MAX_BATCH_BYTES:
+                    self._write_chunk(chunk)
+                    chunk = []
+                    chunk_size = 0
+                chunk.append((outgoing_bytes, queued_at))
+                chunk_size += len(outgoing_bytes)
+        self._write_chunk(chunk)
+
+    def _wait(self, seconds):
+        """Wait for flood control, sending urgent lines that come up meanwhile."""
+        deadline = time.monotonic() + seconds
+        while not self._stopped:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._wakeup.wait(remaining):
+                return
+            self._write_urgent()
+
+    def _write_urgent(self):
+        """Write the PING/PONG lines waiting in self._urgent."""
+        self._wakeup.clear()
+        chunk = []
+        while True:
+            try:
+                chunk.append(self._urgent.popleft())
+            except IndexError:
+                break
+        try:
+            self._write_chunk(chunk)
+        finally:
+            self._mark_sent(len(chunk))
+
+    def _write_chunk(self, chunk):
+        """Write lines to the socket with a single sendall() and update counters."""
+        if not chunk:
+            return
+        if self._urgent:
+            self._write_urgent()
+        connection = self.socket
+        if not connection:
+            raise ConnectionError("Socket is not connected.")
+        connection.sendall(b"".join(line for line, _queued_at in chunk))
+        now = time.monotonic()
+        for _line, queued_at in chunk:
+            latency = now - queued_at
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+        self.sent_lines += len(chunk)
+        self.sent_batches += 1
+
+    def _discard_queue(self, taken):
+        """Drop everything still queued, 'taken' are items already removed from the queue."""
+        discarded = _count_lines(taken)
+        while True:
+            try:
+                discarded += _count_lines([self._queue.get_nowait()])
+            except queue.Empty:
+                break
+        while True:
+            try:
+                self._urgent.popleft()
+            except IndexError:
+                break
+            discarded += 1
+        self._mark_sent(discarded)
+
+    @contextlib.contextmanager
+    def pipeline(self):
+        """Context manager, commands sent inside it by this thread are queued at
+        once when it exits, and written together.
+
+        Flood control still applies, so this is meant for a handful of lines."""
+        if getattr(self._local, "pipeline", None) is not None:
+            yield  # Nested, the outer pipeline queues everything.
+            return
+        lines = self._local.pipeline = []
+        try:
+            yield
+        finally:
+            self._local.pipeline = None
+            if lines:
+                self._enqueue(tuple(lines))
+
+    def flush(self, timeout=None):
+        """Wait until every queued line was written, returns False on timeout."""
+        with self._unsent_condition:
+            return self._unsent_condition.wait_for(
+                lambda: self._unsent <= 0, timeout=timeout
+            )
+
+    def stop(self):
+        """Stop the writer thread, lines that are still queued are discarded."""
+        self._stopped = True
+        if self._writer is None:
+            return
+        try:
+            # Wake up the writer, if the queue is full it'll see the flag anyway.
+            self._queue.put_nowait(
+                (PRIORITY_STOP, next(self._sequence), _STOP, time.monotonic())
+            )
+        except queue.Full:
+            pass
+
+    def stats(self):
+        """Return queue depth, sent line and batch counts, and latency in seconds."""
+        return {
+            "queue_depth": self._queue.qsize(),
+            "sent_lines": self.sent_lines,
+            "sent_batches": self.sent_batches,
+            "average_latency": (
+                self.total_latency / self.sent_lines if self.sent_lines else 0.0
+            ),
+            "max_latency": self.max_latency,
+        }
 
     def ping(self, token):
         """Send PING command to server to check for connectivity."""
@@ -120,11 +405,26 @@ class SendIRC:
     def join(self, channel, key=""):
         """Send JOIN command to join a channel/memo.
 
-        Keys or joining multiple channels is possible in the specification, but unused.
+        Keys are possible in the specification, but unused. See join_channels()
+        for joining multiple channels.
         """
         channel_and_key = " ".join([channel, key]).strip()
         self._send("JOIN", channel_and_key)
 
+    def join_channels(self, channels):
+        """Send JOIN for several channels, as few commands as the line length allows."""
+        joining = []
+        length = 0
+        for channel in channels:
+            if joining and length + len(channel) + 1 > 400:
+                self._send("JOIN", ",".join(joining))
+                joining = []
+                length = 0
+            joining.append(channel)
+            length += len(channel) + 1
+        if joining:
+            self._send("JOIN", ",".join(joining))
+
     def part(self, channel):
         """Send PART command to leave a channel/memo.
 
@@ -180,32 +480,197 @@ class SendIRC:
             self._send("AUTHENTICATE", text=sasl_string_base64)
 
 
-def parse_irc_line(line: str):
-    """Retrieves tags, prefix, command, and arguments from an unparsed IRC line."""
-    parts = line.split(" ")
-    tags = None
+class LineBuffer:
+    """Accumulates received bytes and splits them into complete IRC lines.
+
+    Only newly received bytes are scanned for line endings, and consumed
+    lines are dropped from the front of the buffer with a single deletion,
+    so large bursts don't cause the whole buffer to be re-split and copied."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scanned = 0  # Bytes already searched for line endings.
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def feed(self, data):
+        """Add received bytes and return a list of complete lines without '\\r\\n'."""
+        buffer = self._buffer
+        buffer += data
+        # Step back one byte in case '\r' and '\n' arrived in different chunks.
+        end = buffer.rfind(b"\r\n", max(self._scanned - 1, 0))
+        if end == -1:
+            self._scanned = len(buffer)
+            return []
+        # Everything before the last line ending is complete lines, split at once.
+        with memoryview(buffer) as view:
+            lines = view[:end].tobytes().split(b"\r\n")
+        del buffer[: end + 2]
+        self._scanned = len(buffer)
+        return lines
+
+    def clear(self):
+        """Discard any buffered partial line."""
+        self._buffer.clear()
+        self._scanned = 0
+
+
+_TAG_ESCAPES = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+_command_cache = {}  # Raw command -> (casefolded and interned command, numeric).
+
+
+class IRCMessage:
+    """A parsed IRC line.
+
+    'tags' is a dict of decoded IRCv3 message tags, 'prefix' is the raw source
+    which 'nick', 'user' and 'host' split up on access. 'command' is casefolded,
+    'numeric' is the command as an int for numeric replies and None otherwise.
+    Tags can be passed undecoded, as the raw string without the leading '@', they're
+    only decoded when 'tags' is used since most commands ignore them."""
+
+    __slots__ = ("_tags", "prefix", "command", "numeric", "params")
+
+    def __init__(self, tags, prefix, command, numeric, params):
+        self._tags = tags
+        self.prefix = prefix
+        self.command = command
+        self.numeric = numeric
+        self.params = params
+
+    @property
+    def tags(self):
+        if isinstance(self._tags, str):
+            self._tags = parse_tags(self._tags)
+        return self._tags
+
+    def _split_prefix(self):
+        """Return the prefix as a (nick, user, host) tuple, missing parts are None."""
+        if not self.prefix:
+            return None, None, None
+        nick, _, host = self.prefix.partition("@")
+        nick, _, user = nick.partition("!")
+        return nick, user or None, host or None
+
+    @property
+    def nick(self):
+        return self._split_prefix()[0]
+
+    @property
+    def user(self):
+        return self._split_prefix()[1]
+
+    @property
+    def host(self):
+        return self._split_prefix()[2]
+
+    def __repr__(self):
+        return (
+            f"IRCMessage(tags={self.tags!r}, prefix={self.prefix!r}, "
+            f"command={self.command!r}, params={self.params!r})"
+        )
+
+
+def unescape_tag_value(value: str):
+    """Decode an escaped IRCv3 message tag value.
+
+    See: https://ircv3.net/specs/extensions/message-tags.html#escaping-values"""
+    if "\\" not in value:
+        return value
+    unescaped = []
+    start = 0
+    while True:
+        backslash = value.find("\\", start)
+        if backslash == -1:
+            unescaped.append(value[start:])
+            break
+        unescaped.append(value[start:backslash])
+        escaped = value[backslash + 1 : backslash + 2]
+        # Unknown escapes drop the backslash, a trailing backslash is dropped.
+        unescaped.append(_TAG_ESCAPES.get(escaped, escaped))
+        start = backslash + 2
+    return "".join(unescaped)
+
+
+def parse_tags(raw_tags: str):
+    """Parse the tag part of a line, without the leading '@', into a dict."""
+    tags = {}
+    for tag in raw_tags.split(";"):
+        if not tag:
+            continue
+        equals = tag.find("=")
+        if equals == -1:
+            tags[tag] = ""
+        else:
+            tags[tag[:equals]] = unescape_tag_value(tag[equals + 1 :])
+    return tags
+
+
+def parse_irc_message(line: str):
+    """Parse an IRC line into an IRCMessage with a single left-to-right scan.
+
+    Returns None for lines without a command."""
+    position = 0
+    tags = ""
     prefix = None
-    if parts[0].startswith(":"):
-        prefix = parts[0][1:]
-        command = parts[1]
-        args = parts[2:]
-    elif parts[0].startswith("@"):
-        tags = parts[0]  # IRCv3 message tag
-        prefix = parts[1][1:]
-        command = parts[2]
-        args = parts[3:]
+    if line.startswith("@"):
+        end = line.find(" ")
+        if end == -1:
+            return None
+        tags = line[1:end]  # Decoded by IRCMessage.tags when needed.
+        position = end + 1
+        while line.startswith(" ", position):
+            position += 1
+    if line.startswith(":", position):
+        end = line.find(" ", position)
+        if end == -1:
+            return None
+        prefix = line[position + 1 : end]
+        position = end + 1
+        while line.startswith(" ", position):
+            position += 1
+
+    end = line.find(" ", position)
+    if end == -1:
+        end = len(line)
+    raw_command = line[position:end]
+    try:
+        command, numeric = _command_cache[raw_command]
+    except KeyError:
+        if not raw_command:
+            return None
+        command = sys.intern(raw_command.casefold())
+        numeric = int(command) if command.isdigit() else None
+        if len(_command_cache) < 256:
+            _command_cache[raw_command] = (command, numeric)
+
+    position = end + 1
+    if position >= len(line):
+        params = []
+    elif line[position] == ":":
+        # If ':' is present the rest of the line is one parameter.
+        params = [line[position + 1 :]]
     else:
-        command = parts[0]
-        args = parts[1:]
-    command = command.casefold()
-
-    # If ':' is present the subsequent args are one parameter.
-    fused_args = []
-    for idx, arg in enumerate(args):
-        if arg.startswith(":"):
-            final_param = " ".join(args[idx:])
-            fused_args.append(final_param[1:])
-            break
-        fused_args.append(arg)
+        trailing = line.find(" :", position)
+        if trailing == -1:
+            params = line[position:].split(" ")
+        else:
+            params = line[position:trailing].split(" ")
+        # Multiple spaces between parameters leave empty strings,
+        # an empty trailing parameter is still a parameter.
+        if "" in params:
+            params = [param for param in params if param]
+        if trailing != -1:
+            params.append(line[trailing + 2 :])
+
+    return IRCMessage(tags, prefix, command, numeric, params)
+
+
+def parse_irc_line(line: str):
+    """Retrieves tags, prefix, command, and arguments from an unparsed IRC line.
 
-    return tags, prefix, command, fused_args
+    Kept for compatibility, see parse_irc_message()."""
+    message = parse_irc_message(line)
+    if message is None:
+        return None, None, "", []
+    return message.tags, message.prefix, message.command, message.params
@@ -0,0 +1,193 @@
+"""Compare lexMessage against the regex cascade it replaced.
+
+Every message in the corpus (scripts/lexer_corpus.txt, one message per line)
+is lexed both ways and the chunks, the HTML and the BBCode output are compared.
+--random adds messages built from random sequences of tags, links, smileys and
+partial tags, which is where the two are most likely to disagree. Afterwards
+both are timed on the corpus.
+
+    python -m scripts.lexer_compare
+    python -m scripts.lexer_compare --random 60000 --seed 1
+
+Run it from the repository root, PyQt has to be installed. Exits with 1 if
+any message lexes differently."""
+
+import os
+import sys
+import random
+import timeit
+import argparse
+
+import quirks  # noqa: F401, has to be imported before parsetools.
+import embeds
+import parsetools
+from parsetools import (
+    mecmd,
+    alternianTagBegin,
+    alternianTagEnd,
+    colorBegin,
+    colorEnd,
+    embedlink,
+    imagelink,
+    hyperlink,
+    memolex,
+    chumhandlelex,
+    smiley,
+    honker,
+)
+
+CORPUS = os.path.join(os.path.dirname(__file__), "lexer_corpus.txt")
+
+# Pieces the random messages are made of.
+ATOMS = (
+    "/me",
+    "/mes",
+    "PESTERCHUM:ME",
+    "<alt>",
+    "</alt>",
+    "<alt",
+    "/alt>",
+    "<c=red>",
+    "<C=0,255,0>",
+    "<c=#ff00ff>",
+    "</c>",
+    "</C>",
+    "<c=",
+    "</c",
+    "<c=<alt>>",
+    "<",
+    ">",
+    "http://a.png",
+    "https://x.com/b.gif?q=1",
+    "http://a.pnghttp://b",
+    "ftp://f",
+    "magnet:?x",
+    "HTTP://Z",
+    "'",
+    "'/>",
+    "<img src='http://a/b.png' />",
+    '<IMG src="x"/>',
+    "#memo",
+    "@handle",
+    ":3:",
+    ":honk:",
+    ":amazed:",
+    ":amazedfirman:",
+    "honk",
+    "HONK",
+    "honks",
+    " ",
+    "  ",
+    "\t",
+    "\n",
+    "x",
+    "word",
+    ":",
+    ":/",
+    "#",
+    "@",
+    "a#b",
+    "é",
+    "İ",
+)
+
+
+class HeadlessUserProfile:
+    def getTrustedDomains(self):
+        return []
+
+
+class HeadlessWindow:
+    """The parts of PesterWindow that embedlink uses."""
+
+    userprofile = HeadlessUserProfile()
+
+
+def lex_cascade(string):
+    """lexMessage as it was, one lexer() pass over the message per token type."""
+    lexlist = [
+        (mecmd, parsetools._mecmdre),
+        (alternianTagBegin, parsetools._alternian_begin),
+        (alternianTagEnd, parsetools._alternian_end),
+        (colorBegin, parsetools._ctag_begin),
+        (colorEnd, parsetools._ctag_end),
+        (embedlink, parsetools._embedre),
+        (imagelink, parsetools._imgre),
+        (hyperlink, parsetools._urlre),
+        (memolex, parsetools._memore),
+        (chumhandlelex, parsetools._handlere),
+        (smiley, parsetools._smilere),
+        (honker, parsetools._honk),
+    ]
+    string = string.replace("\n", " ").replace("\r", " ")
+    return parsetools.balance(parsetools.lexer(string, lexlist))
+
+
+def summarize(lexed):
+    """What a lexed message consists of, in a form that can be compared.
+
+    The cascade leaves empty strings behind, they don't change the output."""
+    return [
+        (type(chunk).__name__, chunk if isinstance(chunk, str) else vars(chunk))
+        for chunk in lexed
+        if chunk != ""
+    ]
+
+
+def compare(string):
+    """Return a description of how the two lexers differ on 'string', if they do."""
+    old = lex_cascade(string)
+    new = parsetools.lexMessage(string)
+    if summarize(old) != summarize(new):
+        return f"chunks\n    old {summarize(old)}\n    new {summarize(new)}"
+    for format in ("html", "bbcode"):
+        expected = parsetools.convertTags(old, format)
+        rendered = parsetools.convertTags(new, format)
+        if expected != rendered:
+            return f"{format}\n    old {expected!r}\n    new {rendered!r}"
+    return None
+
+
+def random_messages(count, seed):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield "".join(rng.choice(ATOMS) for _ in range(rng.randint(0, 12)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--corpus", default=CORPUS, help="one message per line")
+    parser.add_argument(
+        "--random", type=int, default=0, help="also compare this many random messages"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--repeat", type=int, default=200, help="times the corpus is lexed when timing"
+    )
+    args = parser.parse_args()
+
+    embeds.manager.mainwindow = HeadlessWindow()
+    with open(args.corpus, encoding="utf-8") as corpus:
+        messages = corpus.read().splitlines()
+
+    compared = 0
+    mismatches = 0
+    for string in (*messages, *random_messages(args.random, args.seed)):
+        compared += 1
+        difference = compare(string)
+        if difference:
+            mismatches += 1
+            print(f"{string!r} differs in {difference}")
+    print(f"{mismatches} of {compared} messages lex differently")
+
+    count = len(messages) * args.repeat
+    for name, lex in (("cascade", lex_cascade), ("lexMessage", parsetools.lexMessage)):
+        elapsed = min(
+            timeit.repeat(lambda: list(map(lex, messages)), number=args.repeat)
+        )
+        print(f"  {name:12s} {elapsed / count * 1e6:6.2f} us/message")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
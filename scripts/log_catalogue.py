@@ -0,0 +1,210 @@
+"""A cached list of a profile's logs, so the log viewer doesn't have to scan for them.
+
+The catalogue of a handle is stored in logs/<handle>.catalogue.json:
+    {"mtime": <mtime of logs/<handle>>,
+     "chums": {<chum>: {"mtime": <mtime of logs/<handle>/<chum>/jsonl>,
+                        "logs": {<file name>: {"start": <unix time>,
+                                               "size": <bytes>,
+                                               "lines": <lines>}}}}}
+PesterLog adds logs as it starts them and updates their size and line count
+when it closes them. Logs made some other way, like by migrating old logs, are
+found when a directory's mtime doesn't match the catalogue anymore; then only
+that directory is listed again."""
+
+import os
+import time
+import logging
+
+from scripts.config_store import ConfigStore
+from scripts.log_format import LOG_FORMAT, log_directory, log_start
+
+PchumLog = logging.getLogger("pchumLogger")
+
+_catalogues = {}
+
+
+def catalogue(logpath, handle):
+    """The catalogue of 'handle', shared by everything that uses it."""
+    key = (logpath, handle)
+    if key not in _catalogues:
+        _catalogues[key] = LogCatalogue(logpath, handle)
+    return _catalogues[key]
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _valid(data):
+    """True if 'data' is laid out like a catalogue, see the top of this file."""
+    if not isinstance(data, dict) or "mtime" not in data:
+        return False
+    chums = data.get("chums")
+    if not isinstance(chums, dict):
+        return False
+    for entry in chums.values():
+        if not isinstance(entry, dict) or "mtime" not in entry:
+            return False
+        logs = entry.get("logs")
+        if not isinstance(logs, dict):
+            return False
+        if not all(isinstance(log, dict) for log in logs.values()):
+            return False
+    return True
+
+
+def count_lines(path):
+    """Count the complete lines in a file."""
+    lines = 0
+    with open(path, "rb") as log_file:
+        for block in iter(lambda: log_file.read(1 << 20), b""):
+            lines += block.count(b"\n")
+    return lines
+
+
+class LogCatalogue:
+    """Chums and logs of one handle, with each log's start time, size and lines.
+
+    Use catalogue() to get one, instances aren't meant to be shared between
+    threads and only one should write the file. Changes are saved in the
+    background once they stop for a bit, see ConfigStore."""
+
+    def __init__(self, logpath, handle):
+        self.logpath = logpath
+        self.handle = handle
+        self.path = "{}/{}.catalogue.json".format(logpath, handle)
+        self.store = ConfigStore(self.path)
+        self._data = {"mtime": None, "chums": {}}
+        try:
+            data = self.store.load()
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            PchumLog.warning("Rebuilding the log catalogue of %s: %s", handle, e)
+        else:
+            if _valid(data):
+                self._data = data
+            else:
+                PchumLog.warning(
+                    "Rebuilding the log catalogue of %s, it's malformed.", handle
+                )
+        # Logs that are still marked open weren't closed properly last time.
+        changed = False
+        for chum, entry in self._data["chums"].items():
+            for fname, log in entry["logs"].items():
+                if log.pop("open", False):
+                    self._count(chum, fname, log)
+                    changed = True
+        if changed:
+            self.save()
+
+    def chums(self):
+        """Names of the chums and memos there are logs of."""
+        handle_path = "{}/{}".format(self.logpath, self.handle)
+        mtime = _mtime(handle_path)
+        if mtime != self._data["mtime"]:
+            chums = self._data["chums"]
+            if mtime is None:
+                found = []
+            else:
+                found = [
+                    chum
+                    for chum in os.listdir(handle_path)
+                    if os.path.isdir("{}/{}".format(handle_path, chum))
+                ]
+            for chum in found:
+                chums.setdefault(chum, {"mtime": None, "logs": {}})
+            for chum in set(chums) - set(found):
+                # Logs PesterLog just started might not be on disk yet.
+                if not any(log.get("open") for log in chums[chum]["logs"].values()):
+                    del chums[chum]
+            self._data["mtime"] = mtime
+            self.save()
+        return list(self._data["chums"])
+
+    def logs(self, chum):
+        """The logs with 'chum' as {file name: {"start", "size", "lines"}}."""
+        directory = log_directory(self.logpath, self.handle, chum)
+        mtime = _mtime(directory)
+        if mtime is None and chum not in self._data["chums"]:
+            return {}
+        entry = self._data["chums"].setdefault(chum, {"mtime": None, "logs": {}})
+        if mtime != entry["mtime"]:
+            self._rescan(chum, entry, directory)
+            entry["mtime"] = mtime
+            self.save()
+        return entry["logs"]
+
+    def add_log(self, chum, fname):
+        """Add a log PesterLog is about to start, it's marked open until close_log()."""
+        entry = self._data["chums"].setdefault(chum, {"mtime": None, "logs": {}})
+        log = entry["logs"].get(fname)
+        if log is None:
+            log = entry["logs"][fname] = {
+                "start": int(time.mktime(log_start(fname))),
+                "size": 0,
+                "lines": 0,
+            }
+        log["open"] = True
+        self.save()
+
+    def close_log(self, chum, fname, size, lines):
+        """Add 'size' bytes and 'lines' lines PesterLog wrote to a log and unmark it.
+
+        Call save() afterwards, so closing many logs only saves once."""
+        entry = self._data["chums"].setdefault(chum, {"mtime": None, "logs": {}})
+        log = entry["logs"].setdefault(
+            fname,
+            {"start": int(time.mktime(log_start(fname))), "size": 0, "lines": 0},
+        )
+        log["size"] += size
+        log["lines"] += lines
+        log.pop("open", None)
+
+    def _rescan(self, chum, entry, directory):
+        """List a chum's log directory again, adding new logs and removing gone ones."""
+        try:
+            found = [
+                fname
+                for fname in os.listdir(directory)
+                if fname.endswith("." + LOG_FORMAT)
+            ]
+        except OSError:
+            found = []
+        logs = entry["logs"]
+        for fname in set(logs) - set(found):
+            if not logs[fname].get("open"):
+                del logs[fname]
+        for fname in found:
+            if fname in logs:
+                continue
+            try:
+                log = {"start": int(time.mktime(log_start(fname)))}
+            except ValueError:
+                continue
+            self._count(chum, fname, log)
+            logs[fname] = log
+
+    def _count(self, chum, fname, log):
+        path = "{}/{}".format(log_directory(self.logpath, self.handle, chum), fname)
+        try:
+            log["size"] = os.path.getsize(path)
+            log["lines"] = count_lines(path)
+        except OSError:
+            log["size"] = log["lines"] = 0
+
+    def save(self):
+        """Save the catalogue once changes stop for a bit, on a background thread."""
+        try:
+            os.makedirs(self.logpath, exist_ok=True)
+        except OSError as e:
+            PchumLog.warning("Couldn't save the log catalogue: %s", e)
+            return
+        self.store.save(self._data)
+
+    def flush(self):
+        """Write changes that weren't saved yet now."""
+        self.store.flush()
@@ -0,0 +1,346 @@
+"""The format Pesterchum stores chat logs in, and export/migration to the old formats.
+
+Logs are stored once, as JSON lines at
+    logs/<handle>/<chum or memo>/jsonl/<chum or memo>.<YYYY-MM-DD.HH.MM>.jsonl
+Every line is a record with the unix time of the message, the timestamp shown in
+front of it (empty if timestamps are disabled) and the message in ctag markup:
+    {"time": 1685145600, "stamp": "[00:54] ", "msg": "<c=0,0,0>CG: hi</c>"}
+html, bbcode and text are rendered from the records when they're needed, by
+PesterLogViewer and by the export command.
+
+Logs from before this format had a copy of every log per format, in
+logs/<handle>/<chum>/{bbcode,html,text}/; migrate() converts them from bbcode.
+
+    python -m scripts.log_format migrate [--remove]
+    python -m scripts.log_format export <log or directory> --format html -o out/
+
+Run it from the repository root, PyQt has to be installed."""
+
+import os
+import re
+import json
+import mmap
+import time
+import array
+import shutil
+import struct
+import logging
+import argparse
+import itertools
+
+import ostools
+
+PchumLog = logging.getLogger("pchumLogger")
+
+LOG_FORMAT = "jsonl"
+EXPORT_FORMATS = ("bbcode", "html", "text")
+OLD_FORMATS = ("bbcode", "html", "text")
+EXPORT_EXTENSIONS = {"bbcode": ".bbcode.txt", "html": ".html", "text": ".txt"}
+
+_old_stamp = re.compile(r"\[\d{1,2}:\d{2}(?::\d{2})?\] ")
+_old_color = re.compile(r"\[color=(#.{6})]")
+LINE_INDEX_SUFFIX = ".lines"  # Cached line offsets, see LogLines.
+_line_index_header = struct.Struct("<Q")
+
+_log_time = re.compile(r"\.(\d{4}-\d{2}-\d{2}\.\d{2}\.\d{2})\.[a-z]+$")
+
+
+def log_directory(logpath, handle, chum):
+    """Directory the logs of 'handle' with 'chum' (or a memo) are stored in."""
+    return "{}/{}/{}/{}".format(logpath, handle, chum, LOG_FORMAT)
+
+
+def log_filename(chum, log_time):
+    """Name of a log with 'chum' started at 'log_time' (YYYY-MM-DD.HH.MM)."""
+    return "{}.{}.{}".format(chum, log_time, LOG_FORMAT)
+
+
+def log_start(fname):
+    """The time a log was started, from its file name, as a struct_time."""
+    match = _log_time.search(fname)
+    if match is None:
+        raise ValueError("Not a log file name: %s" % fname)
+    return time.strptime(match.group(1), "%Y-%m-%d.%H.%M")
+
+
+def encode_record(msg, stamp="", timestamp=None):
+    """Encode a message in ctag markup as a log line."""
+    if timestamp is None:
+        timestamp = int(time.time())
+    record = {"time": timestamp, "stamp": stamp, "msg": msg}
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def read_records(path):
+    """Yield the records of the log at 'path', skipping lines that can't be read.
+
+    A line can be incomplete if Pesterchum crashed while it was written."""
+    with open(path, encoding="utf-8", errors="replace") as log_file:
+        yield from parse_records(log_file, path)
+
+
+def parse_records(lines, source="log"):
+    """Yield the records in an iterable of log lines, see read_records()."""
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        if not isinstance(record, dict) or "msg" not in record:
+            PchumLog.warning("Skipped an unreadable line in %s", source)
+            continue
+        yield record
+
+
+class LogLines:
+    """Random access to the lines of a log, without reading all of it.
+
+    The log is memory-mapped and the offset of every line is cached next to it
+    in <log>.lines, logs are only appended to so the cache is extended when the
+    log grew since. Lines written after the log was opened aren't included."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        if size:
+            self._map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+        else:
+            self._map = b""  # Empty files can't be mapped.
+        self._offsets = self._line_offsets(size)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def records(self, start, stop):
+        """Return the records of lines 'start' up to 'stop'."""
+        stop = min(stop, len(self))
+        if start >= stop:
+            return []
+        data = self._map[self._offsets[start] : self._offsets[stop] - 1]
+        return list(
+            parse_records(data.decode("utf-8", errors="replace").split("\n"), self.path)
+        )
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def _line_offsets(self, size):
+        """Offsets of every complete line, plus the end of the last one."""
+        offsets = array.array("Q", [0])
+        indexed = 0
+        cache_path = self.path + LINE_INDEX_SUFFIX
+        try:
+            with open(cache_path, "rb") as cache:
+                (cached_size,) = _line_index_header.unpack(
+                    cache.read(_line_index_header.size)
+                )
+                if cached_size <= size:
+                    offsets = array.array("Q")
+                    offsets.frombytes(cache.read())
+                    indexed = cached_size
+        except (OSError, struct.error, ValueError):
+            pass  # Missing or broken, it's rebuilt.
+        if indexed and (
+            not offsets
+            or offsets[-1] != indexed
+            or self._map[indexed - 1 : indexed] != b"\n"
+        ):
+            offsets, indexed = array.array("Q", [0]), 0
+        end = self._map.rfind(b"\n", indexed) + 1
+        if end > indexed:
+            lengths = map(len, self._map[indexed : end - 1].split(b"\n"))
+            # Skip the first offset, the cached ones end with it already.
+            new_offsets = itertools.accumulate(
+                (length + 1 for length in lengths), initial=indexed
+            )
+            offsets.extend(itertools.islice(new_offsets, 1, None))
+            try:
+                with open(cache_path, "wb") as cache:
+                    cache.write(_line_index_header.pack(end))
+                    offsets.tofile(cache)
+            except OSError as e:
+                PchumLog.warning("Couldn't cache line offsets of %s: %s", self.path, e)
+        return offsets
+
+
+def render_record(record, format="html"):
+    """Render a record's timestamp and message in 'format'."""
+    # Import here so migrating doesn't need the lexer.
+    from parsetools import convertTags
+
+    return record.get("stamp", "") + convertTags(record["msg"], format)
+
+
+def export(path, format, output):
+    """Write the log at 'path' to the file 'output' in 'format'."""
+    if format not in EXPORT_FORMATS:
+        raise ValueError("Can't export logs to '%s'" % format)
+    # Same line endings as the logs PesterLog wrote in every format before.
+    end = "<br />\r\n" if format == "html" else "\r\n"
+    lines = [render_record(record, format) + end for record in read_records(path)]
+    with open(output, "w", encoding="utf-8") as exported:
+        exported.writelines(lines)
+
+
+def bbcode_to_ctag(line):
+    """Convert a line of an old bbcode log to ctag markup, like the old log viewer."""
+    line = (
+        line.replace("\r\n", "")
+        .replace("\n", "")
+        .replace("[/color]", "</c>")
+        .replace("[url]", "")
+        .replace("[/url]", "")
+    )
+    return _old_color.sub(r"<c=\1>", line)
+
+
+def migrate_log(old_path, new_path):
+    """Convert an old bbcode log to a record log.
+
+    The time of every record is when the log was started, old logs only have the
+    time of day if timestamps were enabled and that's kept as the record's stamp."""
+    timestamp = int(time.mktime(log_start(old_path)))
+    lines = []
+    with open(old_path, encoding="utf-8", errors="replace") as old_file:
+        for line in old_file:
+            line = bbcode_to_ctag(line)
+            stamp = _old_stamp.match(line)
+            if stamp is not None:
+                lines.append(
+                    encode_record(line[stamp.end() :], stamp.group(0), timestamp)
+                )
+            else:
+                lines.append(encode_record(line, "", timestamp))
+    temporary = new_path + ".migrating"
+    with open(temporary, "w", encoding="utf-8") as new_file:
+        new_file.writelines(lines)
+    os.replace(temporary, new_path)
+
+
+def migrated_path(directory, chum, fname):
+    """Where the old log 'fname' is stored once converted, None if it's not a log."""
+    try:
+        log_time = time.strftime("%Y-%m-%d.%H.%M", log_start(fname))
+    except ValueError:
+        return None
+    return "{}/{}".format(directory, log_filename(chum, log_time))
+
+
+def remove_migrated(old_path, directory, chum):
+    """Delete the old format directory 'old_path' if every file in it was converted.
+
+    Otherwise it's kept, with a warning listing what wasn't converted."""
+    if not os.path.isdir(old_path):
+        return
+    left = []
+    for fname in sorted(os.listdir(old_path)):
+        new_path = migrated_path(directory, chum, fname)
+        if new_path is None or not os.path.exists(new_path):
+            left.append(fname)
+    if left:
+        PchumLog.warning(
+            "Kept %s, %d files in it weren't converted: %s",
+            old_path,
+            len(left),
+            ", ".join(left),
+        )
+        return
+    try:
+        shutil.rmtree(old_path)
+    except OSError as e:
+        PchumLog.warning("Couldn't remove %s: %s", old_path, e)
+
+
+def migrate_chum(logpath, handle, chum, remove=False):
+    """Convert the old logs of 'handle' with 'chum', returns how many were converted.
+
+    Logs that were converted already are skipped. With 'remove' each of the old
+    bbcode/html/text directories is deleted if everything in it was converted."""
+    chum_path = "{}/{}/{}".format(logpath, handle, chum)
+    bbcode_path = "{}/bbcode".format(chum_path)
+    if not os.path.isdir(bbcode_path):
+        return 0
+    directory = log_directory(logpath, handle, chum)
+    os.makedirs(directory, exist_ok=True)
+    converted = 0
+    for fname in os.listdir(bbcode_path):
+        if not fname.endswith(".txt"):
+            continue
+        new_path = migrated_path(directory, chum, fname)
+        if new_path is None:
+            PchumLog.warning("Not migrating %s/%s", bbcode_path, fname)
+            continue
+        if os.path.exists(new_path):
+            continue
+        try:
+            migrate_log("{}/{}".format(bbcode_path, fname), new_path)
+        except OSError as e:
+            PchumLog.warning("Couldn't migrate %s/%s: %s", bbcode_path, fname, e)
+            continue
+        converted += 1
+    if remove:
+        for format in OLD_FORMATS:
+            remove_migrated("{}/{}".format(chum_path, format), directory, chum)
+    return converted
+
+
+def migrate(logpath, remove=False):
+    """Convert every old log under 'logpath', returns how many were converted."""
+    converted = 0
+    if not os.path.isdir(logpath):
+        return 0
+    for handle in os.listdir(logpath):
+        if not os.path.isdir("{}/{}".format(logpath, handle)):
+            continue
+        for chum in os.listdir("{}/{}".format(logpath, handle)):
+            converted += migrate_chum(logpath, handle, chum, remove)
+    return converted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--logs",
+        default=ostools.getDataDir() + "logs",
+        help="log directory, the one in Pesterchum's data directory by default",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = commands.add_parser("migrate", help="convert old logs")
+    migrate_parser.add_argument(
+        "--remove",
+        action="store_true",
+        help="delete old bbcode/html/text directories once all their logs are converted",
+    )
+    export_parser = commands.add_parser("export", help="export logs")
+    export_parser.add_argument("path", help="a log, or a directory of logs")
+    export_parser.add_argument("--format", choices=EXPORT_FORMATS, default="html")
+    export_parser.add_argument("-o", "--output", default=".", help="output directory")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        print("Converted %d logs." % migrate(args.logs, args.remove))
+        return
+
+    import quirks  # noqa: F401, has to be imported before parsetools.
+
+    if os.path.isdir(args.path):
+        paths = [
+            os.path.join(args.path, fname)
+            for fname in sorted(os.listdir(args.path))
+            if fname.endswith("." + LOG_FORMAT)
+        ]
+    else:
+        paths = [args.path]
+    os.makedirs(args.output, exist_ok=True)
+    for path in paths:
+        fname = os.path.basename(path)[: -len(LOG_FORMAT) - 1]
+        output = os.path.join(args.output, fname + EXPORT_EXTENSIONS[args.format])
+        export(path, args.format, output)
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
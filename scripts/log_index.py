@@ -0,0 +1,252 @@
+"""Full-text search over chat logs, kept in an SQLite FTS5 index.
+
+PesterLog adds every message it logs to the index, see LogIndex.add(). Logs that
+were written before the index existed, or while Pesterchum wasn't running it, are
+added with update() or by rebuilding the index:
+
+    python -m scripts.log_index rebuild
+    python -m scripts.log_index search "some words" [--handle me]
+
+The index only stores the messages' text, colors and other markup are stripped."""
+
+import os
+import re
+import time
+import sqlite3
+import logging
+import argparse
+import collections
+
+import ostools
+from scripts.log_format import LOG_FORMAT, parse_records
+
+PchumLog = logging.getLogger("pchumLogger")
+
+COMMIT_INTERVAL = 1.0  # Seconds between committing messages added with add().
+COMMIT_ROWS = 500  # Or after this many messages, whichever comes first.
+
+SearchResult = collections.namedtuple(
+    "SearchResult", ["handle", "chum", "file", "time", "snippet"]
+)
+
+# ctag markup that the text format drops.
+_markup = re.compile(r"</?c(?:=[^>]*)?>|</?alt>", re.IGNORECASE)
+
+
+def message_text(msg):
+    """The searchable text of a message in ctag markup."""
+    return _markup.sub("", msg)
+
+
+def fts_query(search):
+    """Turn user input into an FTS5 query matching messages with every word in it.
+
+    Every word is quoted, so FTS5 syntax like AND, NEAR or * is matched literally."""
+    return " ".join('"%s"' % word.replace('"', '""') for word in search.split())
+
+
+class LogIndex:
+    """Full-text index of the logs under 'logpath', stored in 'path'.
+
+    Only used from the thread that made it, like the sqlite3 connection."""
+
+    def __init__(self, path, logpath):
+        self.logpath = logpath
+        self.db = sqlite3.connect(path)
+        # add() commits on the GUI thread. With WAL and synchronous=NORMAL a commit
+        # doesn't fsync, only checkpoints do. A crash of the system can lose the last
+        # commits, update() indexes them again from the logs.
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(
+                text, handle UNINDEXED, chum UNINDEXED, file UNINDEXED,
+                time UNINDEXED, tokenize = 'unicode61 remove_diacritics 2'
+            );
+            CREATE TABLE IF NOT EXISTS files(
+                path TEXT PRIMARY KEY, size INTEGER NOT NULL
+            );
+            """)
+        self._sizes = {}  # Log path -> bytes indexed, for logs add() was used on.
+        self._rows = []
+        self._last_commit = time.monotonic()
+
+    def add(self, handle, chum, path, record, msg, timestamp):
+        """Index 'msg', written to the log at 'path' as the line 'record'.
+
+        Messages are committed in batches, call commit() to do it right away."""
+        size = self._sizes.get(path)
+        if size is None:
+            size = self._indexed_size(path)
+            if size is None:
+                size = os.path.getsize(path) if os.path.exists(path) else 0
+        self._sizes[path] = size + len(record.encode("utf-8", errors="replace"))
+        self._rows.append(
+            (message_text(msg), handle, chum, os.path.basename(path), timestamp)
+        )
+        if (
+            len(self._rows) >= COMMIT_ROWS
+            or time.monotonic() - self._last_commit >= COMMIT_INTERVAL
+        ):
+            self.commit()
+
+    def commit(self):
+        """Write messages added with add() to the index."""
+        self._last_commit = time.monotonic()
+        if not self._rows:
+            return
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO messages(text, handle, chum, file, time) "
+                "VALUES (?, ?, ?, ?, ?)",
+                self._rows,
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO files(path, size) VALUES (?, ?)",
+                [(self._relative(path), size) for path, size in self._sizes.items()],
+            )
+        self._rows = []
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    def search(self, search, handle=None, chum=None, limit=100):
+        """Return SearchResults for messages with every word in 'search', best first."""
+        query = fts_query(search)
+        if not query:
+            return []
+        sql = (
+            "SELECT handle, chum, file, time, "
+            "snippet(messages, 0, '[', ']', '...', 12) FROM messages "
+            "WHERE messages MATCH ?"
+        )
+        parameters = [query]
+        if handle is not None:
+            sql += " AND handle = ?"
+            parameters.append(handle)
+        if chum is not None:
+            sql += " AND chum = ?"
+            parameters.append(chum)
+        sql += " ORDER BY rank LIMIT ?"
+        parameters.append(limit)
+        return [SearchResult(*row) for row in self.db.execute(sql, parameters)]
+
+    def update(self):
+        """Index logs and parts of logs that aren't indexed yet, returns the count."""
+        self.commit()
+        indexed = 0
+        if not os.path.isdir(self.logpath):
+            return 0
+        for handle in os.listdir(self.logpath):
+            handle_path = os.path.join(self.logpath, handle)
+            if not os.path.isdir(handle_path):
+                continue
+            for chum in os.listdir(handle_path):
+                directory = os.path.join(handle_path, chum, LOG_FORMAT)
+                if not os.path.isdir(directory):
+                    continue
+                for fname in os.listdir(directory):
+                    if fname.endswith("." + LOG_FORMAT):
+                        path = os.path.join(directory, fname)
+                        indexed += self._index_log(handle, chum, path)
+        return indexed
+
+    def rebuild(self):
+        """Clear the index and index every log again, returns the message count."""
+        self._rows = []
+        self._sizes = {}
+        with self.db:
+            self.db.execute("DELETE FROM messages")
+            self.db.execute("DELETE FROM files")
+        indexed = self.update()
+        self.db.execute("INSERT INTO messages(messages) VALUES ('optimize')")
+        self.db.commit()
+        return indexed
+
+    def _index_log(self, handle, chum, path):
+        """Index the part of a log after what's indexed already."""
+        size = os.path.getsize(path)
+        start = self._indexed_size(path) or 0
+        if start >= size:
+            return 0
+        fname = os.path.basename(path)
+        with open(path, "rb") as log_file:
+            log_file.seek(start)
+            data = log_file.read(size - start)
+        # Only index up to the last complete line, the rest might still be written.
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            return 0
+        rows = [
+            (message_text(record["msg"]), handle, chum, fname, record.get("time"))
+            for record in parse_records(
+                data[: end - 1].decode("utf-8", errors="replace").split("\n"), path
+            )
+        ]
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO messages(text, handle, chum, file, time) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO files(path, size) VALUES (?, ?)",
+                (self._relative(path), start + end),
+            )
+        self._sizes.pop(path, None)
+        return len(rows)
+
+    def _relative(self, path):
+        return os.path.relpath(path, self.logpath)
+
+    def _indexed_size(self, path):
+        row = self.db.execute(
+            "SELECT size FROM files WHERE path = ?", (self._relative(path),)
+        ).fetchone()
+        return row[0] if row else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--index",
+        default=ostools.getDataDir() + "log_index.sqlite",
+        help="index file, the one in Pesterchum's data directory by default",
+    )
+    parser.add_argument(
+        "--logs",
+        default=ostools.getDataDir() + "logs",
+        help="log directory, the one in Pesterchum's data directory by default",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("rebuild", help="index all logs again")
+    commands.add_parser("update", help="index logs that aren't indexed yet")
+    search_parser = commands.add_parser("search", help="search the index")
+    search_parser.add_argument("search")
+    search_parser.add_argument("--handle", help="only search this handle's logs")
+    search_parser.add_argument("--chum", help="only search logs with this chum")
+    search_parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    index = LogIndex(args.index, args.logs)
+    started = time.perf_counter()
+    if args.command == "search":
+        results = index.search(args.search, args.handle, args.chum, args.limit)
+        for result in results:
+            when = time.strftime("%Y-%m-%d %H:%M", time.localtime(result.time or 0))
+            print(f"{when} {result.handle}/{result.chum} {result.file}")
+            print(f"    {result.snippet}")
+        print(f"{len(results)} results", end="")
+    else:
+        if args.command == "rebuild":
+            indexed = index.rebuild()
+        else:
+            indexed = index.update()
+        print(f"Indexed {indexed} messages", end="")
+    print(f" in {time.perf_counter() - started:.3f}s")
+    index.close()
+
+
+if __name__ == "__main__":
+    main()
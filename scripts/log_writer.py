@@ -0,0 +1,391 @@
+"""Background writer for chat logs, used by PesterLog in user_profile.py.
+
+Log lines are queued by the GUI thread and written by a separate thread,
+which groups writes and decides when to fsync based on the durability setting:
+    "line"      fsync every file written to after every batch of writes.
+    "interval"  fsync written files every 'fsync_interval' seconds. Every batch is
+                first appended to a small write-ahead journal, lines lost when
+                Pesterchum crashes are restored from it on the next start.
+                Every LogWriter has its own journal and keeps it locked, so other
+                running instances leave it alone.
+                A crash of the system can lose the last 'fsync_interval' seconds.
+    "close"     only fsync when a file is closed.
+"""
+
+import os
+import json
+import time
+import queue
+import logging
+import itertools
+import threading
+import collections
+
+try:
+    import fcntl
+    import resource
+except ImportError:
+    # Windows
+    fcntl = None
+    resource = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+PchumLog = logging.getLogger("pchumLogger")
+
+DURABILITY_MODES = ("line", "interval", "close")
+MAX_BATCH = 256  # Maximum number of queued operations handled at once.
+
+
+def default_max_open():
+    """How many logs to keep open, a quarter of the file descriptor limit."""
+    if resource is None:
+        return 128  # The C runtime's default limit on Windows is 512.
+    soft, _hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return 1024
+    return max(8, min(soft // 4, 1024))
+
+
+_WRITE = 0
+_CLOSE = 1
+_STOP = 2
+
+_journal_numbers = itertools.count()
+
+
+def _lock(journal):
+    """Lock an open journal file, returns False if another process has it locked.
+
+    The lock is released when the file is closed, also when the process dies."""
+    try:
+        if fcntl is not None:
+            fcntl.flock(journal.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            journal.seek(0)
+            msvcrt.locking(journal.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+class LogWriter:
+    """Writes log files on a background thread.
+
+    Files are opened in append mode when they're written to and stay open until
+    close_file() or close() is called, or until they're the least recently written
+    of more than 'max_open' files. Those are synced and closed, and reopened if
+    they're written to again. Errors can't be shown from the writer thread,
+    they're kept until collected with take_errors().
+
+    The journal is 'journal_path' followed by the process ID and a number, every
+    journal next to it that isn't locked is recovered when a LogWriter starts."""
+
+    def __init__(
+        self,
+        journal_path,
+        durability="interval",
+        fsync_interval=1.0,
+        max_open=None,
+    ):
+        if durability not in DURABILITY_MODES:
+            PchumLog.warning("Unknown log durability '%s', using 'line'.", durability)
+            durability = "line"
+        self.journal_path = "%s.%d.%d" % (
+            journal_path,
+            os.getpid(),
+            next(_journal_numbers),
+        )
+        self.durability = durability
+        self.fsync_interval = fsync_interval
+        self._queue = queue.Queue()
+        self.max_open = max_open or default_max_open()
+        # path -> binary file object, least recently written first.
+        self._files = collections.OrderedDict()
+        self._dirty = set()  # Paths written to since their last fsync.
+        self._journal = None
+        self._errors = []
+        self._errors_lock = threading.Lock()
+        self._pending = 0  # Operations queued but not yet handled.
+        self._pending_bytes = 0
+        self._pending_condition = threading.Condition()
+        self._stopped = False
+        # Counters, see stats().
+        self.fsyncs = 0
+        self.evictions = 0
+        self.total_fsync_latency = 0.0
+        self.max_fsync_latency = 0.0
+        self.recover(journal_path)
+        if durability == "interval":
+            self._open_journal()
+        self._writer = threading.Thread(
+            target=self._write_queue, name="LogWriter", daemon=True
+        )
+        self._writer.start()
+
+    def write(self, path, text):
+        """Queue 'text' to be appended to the file at 'path'."""
+        data = text.encode("utf-8", errors="replace")
+        self._enqueue(_WRITE, path, data)
+
+    def close_file(self, path):
+        """Queue closing the file at 'path', it's fsynced first."""
+        self._enqueue(_CLOSE, path, b"")
+
+    def _enqueue(self, operation, path, data):
+        if self._stopped:
+            PchumLog.warning("Log write after the log writer was closed: %s", path)
+            return
+        with self._pending_condition:
+            self._pending += 1
+            self._pending_bytes += len(data)
+        self._queue.put((operation, path, data))
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far is handled, returns False on timeout."""
+        with self._pending_condition:
+            return self._pending_condition.wait_for(lambda: self._pending <= 0, timeout)
+
+    def close(self, timeout=10):
+        """Write everything that's queued, fsync and close all files and stop."""
+        if self._stopped:
+            return
+        self._enqueue(_STOP, None, b"")
+        self._stopped = True
+        self._writer.join(timeout)
+
+    def take_errors(self):
+        """Return and clear the list of (path, exception) for failed writes."""
+        with self._errors_lock:
+            errors = self._errors
+            self._errors = []
+        return errors
+
+    def stats(self):
+        """Return a dict of counters for debugging and benchmarking."""
+        return {
+            "queued_operations": self._pending,
+            "queued_bytes": self._pending_bytes,
+            "open_files": len(self._files),
+            "evictions": self.evictions,
+            "fsyncs": self.fsyncs,
+            "average_fsync_latency": (
+                self.total_fsync_latency / self.fsyncs if self.fsyncs else 0.0
+            ),
+            "max_fsync_latency": self.max_fsync_latency,
+        }
+
+    def _write_queue(self):
+        """Writer thread, handles queued operations in batches until stopped."""
+        next_fsync = time.monotonic() + self.fsync_interval
+        while True:
+            timeout = None
+            if self._dirty and self.durability == "interval":
+                timeout = max(0.0, next_fsync - time.monotonic())
+            try:
+                batch = [self._queue.get(timeout=timeout)]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = self._handle_batch(batch)
+            if self.durability == "line" or (
+                self.durability == "interval"
+                and self._dirty
+                and time.monotonic() >= next_fsync
+            ):
+                self._sync_dirty()
+                next_fsync = time.monotonic() + self.fsync_interval
+            if stop:
+                for path in list(self._files):
+                    self._close_file(path)
+                self._close_journal()
+                return
+
+    def _handle_batch(self, batch):
+        """Handle a batch of operations, returns True if a stop was requested."""
+        stop = False
+        handled_bytes = 0
+        writes = [item for item in batch if item[0] == _WRITE]
+        try:
+            if writes and self.durability == "interval":
+                self._journal_writes(writes)
+            for operation, path, data in batch:
+                handled_bytes += len(data)
+                if operation == _WRITE:
+                    self._write(path, data)
+                elif operation == _CLOSE:
+                    self._close_file(path)
+                else:
+                    stop = True
+        finally:
+            with self._pending_condition:
+                self._pending -= len(batch)
+                self._pending_bytes -= handled_bytes
+                self._pending_condition.notify_all()
+        return stop
+
+    def _write(self, path, data):
+        try:
+            log_file = self._files.get(path)
+            if log_file is None:
+                if len(self._files) >= self.max_open:
+                    self._close_file(next(iter(self._files)))
+                    self.evictions += 1
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                log_file = self._files[path] = open(path, "ab")
+            else:
+                self._files.move_to_end(path)
+            log_file.write(data)
+            self._dirty.add(path)
+        except OSError as write_error:
+            PchumLog.critical("Couldn't write log %s: %s", path, write_error)
+            with self._errors_lock:
+                self._errors.append((path, write_error))
+
+    def _fsync(self, log_file):
+        started = time.monotonic()
+        log_file.flush()
+        os.fsync(log_file.fileno())
+        latency = time.monotonic() - started
+        self.fsyncs += 1
+        self.total_fsync_latency += latency
+        self.max_fsync_latency = max(self.max_fsync_latency, latency)
+
+    def _sync_dirty(self):
+        """fsync every file written to since the last sync, then clear the journal."""
+        for path in self._dirty:
+            try:
+                self._fsync(self._files[path])
+            except (OSError, KeyError) as sync_error:
+                PchumLog.warning("Couldn't sync log %s: %s", path, sync_error)
+        self._dirty.clear()
+        if self._journal is not None:
+            self._journal.seek(0)
+            self._journal.truncate()
+
+    def _close_file(self, path):
+        log_file = self._files.pop(path, None)
+        if log_file is None:
+            return
+        try:
+            if path in self._dirty:
+                self._fsync(log_file)
+            log_file.close()
+        except OSError as close_error:
+            PchumLog.warning("Couldn't close log %s: %s", path, close_error)
+        self._dirty.discard(path)
+
+    def _journal_writes(self, writes):
+        """Append writes to the journal before they touch the logs.
+
+        The journal is flushed to the OS but not fsynced, it only has to outlive
+        Pesterchum, the logs are fsynced when the interval has passed and then
+        it's cleared. Every entry records the size the log had before the write,
+        so recovering is idempotent: writes that already made it to disk are skipped."""
+        if self._journal is None:
+            return
+        entries = []
+        sizes = {}
+        for _operation, path, data in writes:
+            if path not in sizes:
+                log_file = self._files.get(path)
+                if log_file is not None:
+                    sizes[path] = log_file.tell()
+                else:
+                    try:
+                        sizes[path] = os.path.getsize(path)
+                    except OSError:
+                        sizes[path] = 0
+            entry = {"path": path, "offset": sizes[path], "data": data.decode("utf-8")}
+            entries.append(json.dumps(entry) + "\n")
+            sizes[path] += len(data)
+        self._journal.write("".join(entries).encode("utf-8"))
+        self._journal.flush()
+
+    def _open_journal(self):
+        try:
+            self._journal = open(self.journal_path, "ab")
+        except OSError as open_error:
+            PchumLog.warning("Couldn't open log journal: %s", open_error)
+            return
+        if not _lock(self._journal):
+            PchumLog.warning("Couldn't lock log journal %s", self.journal_path)
+
+    def _close_journal(self):
+        if self._journal is None:
+            return
+        try:
+            # Cleared first, the file is only unlocked once it's closed.
+            self._journal.truncate(0)
+            self._journal.close()
+            os.remove(self.journal_path)
+        except FileNotFoundError:
+            pass  # Found unlocked and removed by another instance.
+        except OSError as remove_error:
+            PchumLog.warning("Couldn't remove log journal: %s", remove_error)
+        self._journal = None
+
+    def recover(self, journal_path):
+        """Replay the journals left behind by crashed instances, then remove them.
+
+        Those are 'journal_path' itself and every file starting with 'journal_path.'
+        that isn't locked, locked ones belong to a running instance."""
+        directory, name = os.path.split(journal_path)
+        try:
+            names = os.listdir(directory or ".")
+        except OSError as list_error:
+            PchumLog.warning("Couldn't look for log journals: %s", list_error)
+            return
+        for journal_name in names:
+            if journal_name == name or journal_name.startswith(name + "."):
+                self._recover_journal(os.path.join(directory, journal_name))
+
+    def _recover_journal(self, path):
+        try:
+            journal = open(path, "a+b")
+        except OSError as read_error:
+            PchumLog.warning("Couldn't read log journal: %s", read_error)
+            return
+        with journal:
+            if not _lock(journal):
+                return
+            journal.seek(0)
+            entries = journal.read().decode("utf-8", errors="replace").splitlines()
+            self._replay(entries)
+            journal.truncate(0)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as remove_error:
+            PchumLog.warning("Couldn't remove log journal: %s", remove_error)
+
+    @staticmethod
+    def _replay(entries):
+        recovered = 0
+        for line in entries:
+            try:
+                entry = json.loads(line)
+                path, offset = entry["path"], entry["offset"]
+                data = entry["data"].encode("utf-8")
+            except (ValueError, KeyError, TypeError):
+                continue  # Partially written entry.
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "ab") as log_file:
+                    size = log_file.seek(0, os.SEEK_END)
+                    if size >= offset + len(data):
+                        continue
+                    log_file.truncate(offset)
+                    log_file.write(data)
+                    recovered += 1
+            except OSError as recover_error:
+                PchumLog.warning("Couldn't recover log %s: %s", path, recover_error)
+        if recovered:
+            PchumLog.info("Recovered %d log lines from the journal.", recovered)
@@ -0,0 +1,142 @@
+"""Stress test for the pool of open logs in scripts/log_writer.py.
+
+Writes rounds of lines to more conversations than LogWriter keeps open, in
+every durability mode, and counts this process's open file descriptors while
+it does. Fails if more logs than 'max_open' (plus the journal) were open at
+once, if any were left open after close(), if a write failed or if a log is
+missing lines.
+
+    python -m scripts.log_writer_stress
+    python -m scripts.log_writer_stress --convos 3000 --rounds 3 --nofile 256
+
+Run it from the repository root. Descriptors are counted from /proc/self/fd or
+/dev/fd, so it doesn't run on Windows."""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+from scripts.log_format import log_directory, log_filename
+from scripts.log_writer import DURABILITY_MODES, LogWriter, default_max_open
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+HANDLE = "stressTester"
+LOG_TIME = "2024-01-01.00.00"
+
+
+def open_descriptors():
+    for fd_path in ("/proc/self/fd", "/dev/fd"):
+        if os.path.isdir(fd_path):
+            return len(os.listdir(fd_path))
+    raise OSError("Can't count open file descriptors on this system.")
+
+
+def stress(durability, logpath, convos, rounds, check_every):
+    """Write 'rounds' lines to 'convos' logs, returns a list of failures."""
+    failures = []
+    baseline = open_descriptors()
+    writer = LogWriter(os.path.join(logpath, "log_journal"), durability)
+    # The journal stays open alongside the logs with "interval".
+    allowed = writer.max_open + 1
+    paths = []
+    for number in range(convos):
+        chum = "chum%d" % number
+        directory = log_directory(logpath, HANDLE, chum)
+        paths.append(os.path.join(directory, log_filename(chum, LOG_TIME)))
+
+    peak = 0
+    started = time.perf_counter()
+    try:
+        for line in range(rounds):
+            for number, path in enumerate(paths):
+                writer.write(path, "line %d\n" % line)
+                if number % check_every == 0:
+                    writer.flush()
+                    peak = max(peak, open_descriptors() - baseline)
+        writer.flush()
+        peak = max(peak, open_descriptors() - baseline)
+    except OSError as e:
+        failures.append(f"{durability}: couldn't count descriptors: {e}")
+    stats = writer.stats()
+    writer.close()
+    errors = writer.take_errors()
+    elapsed = time.perf_counter() - started
+    left = open_descriptors() - baseline
+
+    print(
+        f"  {durability:8s} {convos * rounds / elapsed:8.0f} lines/s, "
+        f"at most {peak} of {allowed} open, {left} left after close, "
+        f"{stats['evictions']} evictions, {stats['fsyncs']} fsyncs"
+    )
+    if peak > allowed:
+        failures.append(f"{durability}: {peak} descriptors open, {allowed} allowed")
+    if left > 0:
+        failures.append(f"{durability}: {left} descriptors left open after close")
+    if errors:
+        failures.append(f"{durability}: {len(errors)} writes failed: {errors[0][1]}")
+    expected = "".join("line %d\n" % line for line in range(rounds))
+    for path in paths:
+        try:
+            with open(path, encoding="utf-8") as log_file:
+                complete = log_file.read() == expected
+        except OSError:
+            complete = False
+        if not complete:
+            failures.append(f"{durability}: {path} is missing lines")
+            break
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--convos", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument(
+        "--nofile",
+        type=int,
+        help="lower the file descriptor limit first, which lowers max_open",
+    )
+    parser.add_argument(
+        "--check-every",
+        type=int,
+        default=50,
+        metavar="LINES",
+        help="count the open descriptors every this many lines",
+    )
+    parser.add_argument("--durability", choices=DURABILITY_MODES, action="append")
+    args = parser.parse_args()
+
+    if args.nofile:
+        if resource is None:
+            parser.error("--nofile isn't supported on this system")
+        _soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (args.nofile, hard))
+    max_open = default_max_open()
+    if args.convos <= max_open:
+        print(f"Warning: {args.convos} convos fit in the pool of {max_open} logs.")
+    print(f"Writing {args.rounds} rounds to {args.convos} logs, {max_open} kept open")
+
+    failures = []
+    for durability in args.durability or DURABILITY_MODES:
+        logpath = tempfile.mkdtemp(prefix="pesterchum-logs-")
+        try:
+            failures += stress(
+                durability, logpath, args.convos, args.rounds, args.check_every
+            )
+        finally:
+            shutil.rmtree(logpath, ignore_errors=True)
+    for failure in failures:
+        print(failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""Keeps track of chum moods received from the server, used by irc.py.
+
+Moods are cached with a time-to-live so reconnecting or re-requesting a chumroll
+doesn't query moods that are already known, and lookups that are already waiting
+for a reply aren't sent again."""
+
+import time
+import threading
+
+MOOD_TTL = 300  # Seconds a mood stays valid without a subscription.
+SUBSCRIBED_MOOD_TTL = 3600  # Seconds a mood stays valid with METADATA SUB.
+INFLIGHT_TIMEOUT = 30  # Seconds before an unanswered lookup may be sent again.
+
+
+class MoodSync:
+    """Cache of known moods and in-flight mood lookups, keyed by casefolded handle.
+
+    Used by both the IRC thread, which receives moods, and the main thread,
+    which requests them, so every method holds self._lock."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._moods = {}  # handle -> (handle, mood index, time received)
+        self._inflight = {}  # handle -> time requested
+        # Set when the server confirmed our METADATA SUB for moods,
+        # changes are pushed to us so cached moods stay valid for longer.
+        self.subscribed = False
+
+    def ttl(self):
+        """Return how long a cached mood stays valid, in seconds."""
+        return SUBSCRIBED_MOOD_TTL if self.subscribed else MOOD_TTL
+
+    def plan(self, handles):
+        """Sort 'handles' into moods we already know and handles we need to query.
+
+        Returns a tuple of a list of (handle, mood index) pairs and a list of handles.
+        Handles that are returned for querying are marked as in-flight."""
+        now = time.monotonic()
+        ttl = self.ttl()
+        known = []
+        query = []
+        seen = set()
+        with self._lock:
+            for handle in handles:
+                key = handle.casefold()
+                if key in seen:
+                    continue
+                seen.add(key)
+                cached = self._moods.get(key)
+                if cached and now - cached[2] < ttl:
+                    known.append((handle, cached[1]))
+                    continue
+                requested = self._inflight.get(key)
+                if requested and now - requested < INFLIGHT_TIMEOUT:
+                    continue
+                self._inflight[key] = now
+                query.append(handle)
+        return known, query
+
+    def update(self, handle, mood):
+        """Store a mood index received from the server."""
+        key = handle.casefold()
+        with self._lock:
+            self._moods[key] = (handle, mood, time.monotonic())
+            self._inflight.pop(key, None)
+
+    def failed(self, handle):
+        """A lookup failed, allow it to be sent again."""
+        with self._lock:
+            self._inflight.pop(handle.casefold(), None)
+
+    def forget(self, handle):
+        """Drop what we know about 'handle', e.g. because they went offline."""
+        key = handle.casefold()
+        with self._lock:
+            self._moods.pop(key, None)
+            self._inflight.pop(key, None)
+
+    def reset_connection(self):
+        """Called for a new connection, lookups and the subscription didn't survive."""
+        with self._lock:
+            self._inflight.clear()
+            self.subscribed = False
@@ -0,0 +1,189 @@
+"""Compare PesterQuirkCollection.apply against applying the quirks one by one.
+
+apply() splits a message around links, smileys, handles and memos once and
+reuses that for every quirk with the exclude option until the message changes.
+This checks it against splitting again before every one of them, as quirks.py
+did before, on a few quirks known to add something that has to be excluded and
+on random quirk sets. Afterwards both are timed.
+
+    python -m scripts.quirk_compare
+    python -m scripts.quirk_compare --random 20000 --seed 1
+
+Run it from the repository root, PyQt has to be installed. Exits with 1 if
+any message is quirked differently."""
+
+import sys
+import random
+import timeit
+import argparse
+
+import quirks
+import embeds
+import parsetools
+from parsetools import convertTags, lexMessage
+
+from scripts import lexer_compare
+
+# (message, quirks, what the quirked message has to be)
+CASES = (
+    # The smiley the first quirk adds isn't quirked by the second.
+    (
+        "happy",
+        [
+            {"type": "regexp", "from": "happy", "to": ":rancorous:", "checkstate": 2},
+            {"type": "replace", "from": "o", "to": "0", "checkstate": 2},
+        ],
+        ":rancorous:",
+    ),
+    # Neither is the link.
+    (
+        "a happy cat",
+        [
+            {"type": "regexp", "from": "happy", "to": "http://a.b/x", "checkstate": 2},
+            {"type": "replace", "from": "a", "to": "A", "checkstate": 2},
+        ],
+        "A http://a.b/x cAt",
+    ),
+)
+
+WORDS = (
+    "happy",
+    "hello",
+    "http://foo.com/a",
+    "@handle",
+    "#memo",
+    ":3",
+    ":rancorous:",
+    "hi",
+    "that",
+    "the",
+    "<alt>x</alt>",
+    "<c=red>",
+    "</c>",
+    "aaa",
+    "http://:3:",
+)
+FROM = ("happy", "o", "e", "a", "s", r"\bhi\b", "(.)", "[aeiou]", "t", ":", "/")
+TO = (":rancorous:", "http://a.b/x", "0", "A", "3", "HI", r"\1\1", "*", ":3", "x")
+
+
+def apply_resplit(collection, lexed):
+    """PesterQuirkCollection.apply, splitting before every quirk with exclude."""
+    pipeline = collection.pipeline()
+    newlist = []
+    for idx, original in enumerate(lexed):
+        if not isinstance(original, str):
+            if idx == 0:
+                string = " "
+                for prefix_quirk in pipeline.prefixes:
+                    string += prefix_quirk.apply(string)
+                newlist.append(string)
+            newlist.append(original)
+            continue
+        first = idx == 0
+        last = idx == len(lexed) - 1
+        string = original
+        for quirk, exclude in pipeline.steps:
+            parts = quirks.split_excludes(string) if exclude else [string]
+            if len(parts) == 1:
+                string = collection._apply_quirk(quirk, string, first, last)
+                continue
+            for part in range(0, len(parts), 2):
+                if quirk.type in ("regexp", "random"):
+                    parts[part] = quirk.apply(parts[part], first=first, last=last)
+                else:
+                    parts[part] = quirk.apply(parts[part])
+            string = "".join(parts)
+        newlist.append(string)
+    final = []
+    for item in newlist:
+        if isinstance(item, str):
+            final.extend(lexMessage(item))
+        else:
+            final.append(item)
+    return final
+
+
+def quirked(apply, quirklist, msg):
+    collection = quirks.PesterQuirkCollection(quirklist)
+    return convertTags(apply(collection, lexMessage(msg)), "ctag")
+
+
+def random_cases(count, seed):
+    rng = random.Random(seed)
+    for _ in range(count):
+        quirklist = []
+        for _ in range(rng.randint(1, 6)):
+            quirk = {"type": rng.choice(("regexp", "replace", "prefix", "suffix"))}
+            quirk["checkstate"] = rng.choice((0, 2))
+            if quirk["type"] == "regexp":
+                quirk.update({"from": rng.choice(FROM), "to": rng.choice(TO)})
+            elif quirk["type"] == "replace":
+                quirk.update({"from": rng.choice(FROM[:5]), "to": rng.choice(TO)})
+            else:
+                quirk["value"] = rng.choice(("> ", "~"))
+            quirklist.append(quirk)
+        msg = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 8)))
+        yield msg, quirklist
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--random", type=int, default=5000, help="compare this many random quirk sets"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--repeat", type=int, default=20, help="times the messages are quirked"
+    )
+    args = parser.parse_args()
+
+    embeds.manager.mainwindow = lexer_compare.HeadlessWindow()
+    parsetools.loadQuirks()
+    mismatches = 0
+    for msg, quirklist, expected in CASES:
+        result = quirked(quirks.PesterQuirkCollection.apply, quirklist, msg)
+        if result != expected:
+            mismatches += 1
+            print(f"{msg!r} is quirked to {result!r}, expected {expected!r}")
+
+    cases = list(random_cases(args.random, args.seed))
+    for msg, quirklist in cases:
+        try:
+            expected = quirked(apply_resplit, quirklist, msg)
+        except IndexError:
+            # A group the 'from' regexp doesn't have, fails both ways.
+            continue
+        try:
+            result = quirked(quirks.PesterQuirkCollection.apply, quirklist, msg)
+        except IndexError as exception:
+            result = repr(exception)
+        if result != expected:
+            mismatches += 1
+            print(f"{msg!r} with {quirklist}\n    old {expected!r}\n    new {result!r}")
+    print(f"{mismatches} of {len(CASES) + len(cases)} messages quirked differently")
+
+    collections = [
+        (quirks.PesterQuirkCollection(quirklist), lexMessage(msg))
+        for msg, quirklist in cases[:500]
+    ]
+    for name, apply in (
+        ("resplit", apply_resplit),
+        ("apply", quirks.PesterQuirkCollection.apply),
+    ):
+
+        def quirk_all(apply=apply):
+            for collection, lexed in collections:
+                try:
+                    apply(collection, lexed)
+                except IndexError:
+                    pass
+
+        elapsed = min(timeit.repeat(quirk_all, number=args.repeat))
+        count = len(collections) * args.repeat
+        print(f"  {name:8s} {elapsed / count * 1e6:6.2f} us/message")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,26 @@
+"""Reconnect backoff and the session state carried over to a new connection."""
+
+import random
+
+from scripts.mood_sync import MoodSync
+
+RECONNECT_ATTEMPTS = 6  # Automatic reconnects after a drop before asking the user.
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """Return an exponential backoff delay in seconds with full jitter.
+
+    'attempt' starts at 0, the upper bound doubles with every attempt up to 'cap'."""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class SessionSnapshot:
+    """What was going on when the previous connection ended.
+
+    Passed to a new PesterIRC so it can rejoin channels right after registering
+    and only request what it doesn't already know."""
+
+    def __init__(self, channels=(), convos=(), mood_sync=None):
+        self.channels = list(channels)  # Memos/channels we were in.
+        self.convos = list(convos)  # Handles we had conversations open with.
+        self.mood_sync = mood_sync or MoodSync()  # Known moods, see mood_sync.py
@@ -0,0 +1,176 @@
+"""Soak test for the scrollback of conversations and memos, PesterText in convo.py.
+
+Appends --lines messages from the lexer corpus to a text area, a frame's worth
+at a time, and every --every lines reports how long appending took and the
+resident memory of the process. Past the scrollback limit the oldest messages
+are evicted from the document, evicted messages are only kept up to a multiple
+of the limit and the document is rebuilt once in a while to drop the formats of
+evicted text. So memory should level off instead of growing with the number of
+lines, the frames that rebuild the document are the worst ones.
+
+    python -m scripts.scrollback_soak
+    python -m scripts.scrollback_soak --lines 100000 --scrollback 500
+
+Run it from the repository root, PyQt has to be installed. It doesn't need a
+display. Memory is read from /proc/self/statm, where that's missing the peak
+is reported instead."""
+
+import os
+import sys
+import time
+import argparse
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt6 import QtWidgets
+
+import quirks  # noqa: F401, has to be imported before parsetools.
+import embeds
+from parsetools import convertTags, lexMessage
+
+from scripts import lexer_compare
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+class HeadlessTheme(dict):
+    """A theme without any entries, PesterText falls back to its defaults."""
+
+    def __missing__(self, key):
+        return ""
+
+    def __contains__(self, key):
+        return False
+
+
+class HeadlessConfig:
+    def __init__(self, scrollback_lines):
+        self.lines = scrollback_lines
+
+    def scrollback_lines(self):
+        return self.lines
+
+    def animations(self):
+        return False
+
+
+class HeadlessWindow(QtWidgets.QWidget):
+    """The parts of PesterWindow that PesterText uses."""
+
+    def __init__(self, scrollback_lines):
+        super().__init__()
+        self.config = HeadlessConfig(scrollback_lines)
+        self.userprofile = lexer_compare.HeadlessUserProfile()
+
+    def clearNewMessage(self):
+        """Called when the text area gets focus, once it's shown."""
+
+
+def text_area(scrollback_lines):
+    """A PesterText in a window that isn't shown."""
+    import convo  # Needs the QApplication.
+
+    window = HeadlessWindow(scrollback_lines)
+    embeds.manager.mainwindow = window
+    text = convo.PesterText(HeadlessTheme(), window)
+    text.resize(600, 400)
+    return text
+
+
+def corpus_html():
+    """The messages of the lexer corpus, converted like received ones."""
+    with open(lexer_compare.CORPUS, encoding="utf-8") as corpus:
+        messages = corpus.read().splitlines()
+    return [
+        '<span style="color:#000000">[12:00] %s</span>' % convertTags(lexMessage(msg))
+        for msg in messages
+    ]
+
+
+def resident_mib():
+    """Resident memory in MiB, and whether it's the peak rather than the current."""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20, False
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is None:
+        return float("nan"), False
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KiB on Linux, bytes on macOS.
+    return peak / (2**20 if sys.platform == "darwin" else 2**10), True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--lines", type=int, default=100000)
+    parser.add_argument(
+        "--scrollback",
+        type=int,
+        default=2000,
+        help="scrollback_lines setting, 0 keeps everything",
+    )
+    parser.add_argument(
+        "--every", type=int, default=10000, help="report every this many lines"
+    )
+    parser.add_argument(
+        "--frame", type=int, default=20, help="messages appended per frame"
+    )
+    args = parser.parse_args()
+
+    app = QtWidgets.QApplication([])
+    text = text_area(args.scrollback)
+    messages = corpus_html()
+    start_mib, peak = resident_mib()
+    print(
+        f"Appending {args.lines} lines, scrollback of {args.scrollback}, "
+        f"{args.frame} per frame"
+    )
+    print(
+        f"  {'lines':>7s} {'us/line':>8s} {'worst frame':>11s} "
+        f"{'peak RSS' if peak else 'RSS':>9s} {'shown':>6s} {'kept':>7s}"
+    )
+
+    appended = 0
+    period = 0.0
+    worst = 0.0
+    samples = []
+    while appended < args.lines:
+        count = min(args.frame, args.lines - appended)
+        started = time.perf_counter()
+        for number in range(appended, appended + count):
+            text.append("%s %d" % (messages[number % len(messages)], number))
+        text.flushMessages()
+        app.processEvents()
+        elapsed = time.perf_counter() - started
+        period += elapsed
+        worst = max(worst, elapsed)
+        previous = appended
+        appended += count
+        if appended // args.every > previous // args.every or appended == args.lines:
+            lines = appended - (samples[-1][0] if samples else 0)
+            mib, _peak = resident_mib()
+            samples.append((appended, mib))
+            print(
+                f"  {appended:7d} {period / lines * 1e6:8.1f} "
+                f"{worst * 1000:8.1f} ms {mib:6.1f} MiB "
+                f"{len(text.shownBlocks):6d} {len(text.scrollback):7d}"
+            )
+            period = 0.0
+            worst = 0.0
+
+    half = samples[len(samples) // 2][1]
+    print(
+        f"RSS {start_mib:.1f} MiB at the start, {half:.1f} MiB halfway, "
+        f"{samples[-1][1]:.1f} MiB at the end"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""Themes compiled to flat lookup tables, used by pesterTheme in user_profile.py.
+
+A theme's style.js is nested JSON and can inherit from another theme, which can
+inherit from another one again. Looking up "convo/systemMsgColor" used to walk
+the nested dicts of every theme in that chain. compile_theme() resolves a theme
+once into a dict of fully-qualified keys, with $path already substituted:
+    {"convo": {...}, "convo/systemMsgColor": "#646464", ...}
+Keys of the theme itself take precedence over the ones it inherits.
+
+Compiled themes are kept in memory and in style.js.cache next to the theme's
+style.js. Both are only used while the mtime and size of every style.js in the
+chain still match, so editing or reinstalling a theme is picked up right away."""
+
+import os
+import json
+import logging
+import collections
+from string import Template
+
+from scripts.config_store import write_atomic
+
+PchumLog = logging.getLogger("pchumLogger")
+
+CACHE_NAME = "style.js.cache"
+CACHE_VERSION = 1
+
+# style: the theme's own style.js, nested.
+# table: flattened keys of the theme and the themes it inherits from.
+# sources: [name, theme directory, [mtime, size] of style.js] of every theme in
+#          the chain, for checking if the compiled theme is still valid.
+CompiledTheme = collections.namedtuple("CompiledTheme", ["style", "table", "sources"])
+
+_compiled = {}  # Theme name -> CompiledTheme, see compile_theme().
+
+
+def _stat(path):
+    try:
+        stat = os.stat(path + "/style.js")
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _valid(sources, find_theme):
+    return all(
+        find_theme(name) == path and _stat(path) == stat for name, path, stat in sources
+    )
+
+
+def load_style(path):
+    """Load the style.js of the theme at 'path', substituting $path in its strings."""
+
+    def substitute_path(values):
+        for key, value in values.items():
+            if isinstance(value, str):
+                values[key] = Template(value).safe_substitute(path=path)
+            elif isinstance(value, list):
+                # For 'main/fonts', which is a list of file paths.
+                for index, item in enumerate(value):
+                    if isinstance(item, str):
+                        value[index] = Template(item).safe_substitute(path=path)
+        return values
+
+    try:
+        with open(path + "/style.js") as fp:
+            return json.load(fp, object_hook=substitute_path)
+    except OSError:
+        return {}
+
+
+def flatten(style, prefix="", table=None):
+    """Add every value in the nested dict 'style' to 'table' by its full key."""
+    if table is None:
+        table = {}
+    for key, value in style.items():
+        table[prefix + key] = value
+        if isinstance(value, dict):
+            flatten(value, prefix + key + "/", table)
+    return table
+
+
+def compile_theme(name, find_theme, _inheriting=()):
+    """Return the CompiledTheme of theme 'name'.
+
+    'find_theme' returns the directory of a theme by name, the compiled theme is
+    taken from memory or the cache file if none of its style.js files changed."""
+    compiled = _compiled.get(name)
+    if compiled is not None and _valid(compiled.sources, find_theme):
+        return compiled
+    path = find_theme(name)
+    compiled = _read_cache(name, path, find_theme)
+    if compiled is None:
+        style = load_style(path)
+        table = {}
+        sources = [[name, path, _stat(path)]]
+        parent = style.get("inherits")
+        if parent is not None and parent not in _inheriting:
+            inherited = compile_theme(parent, find_theme, _inheriting + (name,))
+            table.update(inherited.table)
+            sources += inherited.sources
+        flatten(style, table=table)
+        compiled = CompiledTheme(style, table, sources)
+        if os.path.basename(path) == name:  # Not a fallback for a missing theme.
+            _write_cache(path, compiled)
+    _compiled[name] = compiled
+    return compiled
+
+
+def _read_cache(name, path, find_theme):
+    try:
+        with open(os.path.join(path, CACHE_NAME), encoding="utf-8") as fp:
+            cache = json.load(fp)
+        if cache["version"] != CACHE_VERSION:
+            return None
+        compiled = CompiledTheme(cache["style"], cache["table"], cache["sources"])
+        if compiled.sources[0][0] != name or not _valid(compiled.sources, find_theme):
+            return None
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, IndexError, TypeError) as e:
+        PchumLog.debug("Ignoring the theme cache in %s: %s", path, e)
+        return None
+    return compiled
+
+
+def _write_cache(path, compiled):
+    cache = {"version": CACHE_VERSION}
+    cache.update(compiled._asdict())
+    try:
+        write_atomic(os.path.join(path, CACHE_NAME), json.dumps(cache))
+    except (OSError, TypeError, ValueError) as e:
+        # Themes installed somewhere read-only are compiled every start.
+        PchumLog.debug("Couldn't cache the theme in %s: %s", path, e)
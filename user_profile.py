@@ -4,11 +4,10 @@ import os
 import sys
 import json
 import re
-import codecs
 import shutil
 import zipfile
 import logging
-from string import Template
+import sqlite3
 from datetime import datetime
 from time import strftime
 
@@ -22,7 +21,13 @@ import quirks
 import ostools
 from mood import Mood
 from dataobjs import PesterProfile
-from parsetools import convertTags
+from parsetools import convertTags, lexMessage
+from scripts.log_writer import LogWriter
+from scripts.log_format import encode_record, log_directory, log_filename
+from scripts.log_index import LogIndex
+from scripts.log_catalogue import catalogue
+from scripts.config_store import ConfigStore, JournalStore
+from scripts.theme_cache import compile_theme
 
 _datadir = ostools.getDataDir()
 PchumLog = logging.getLogger("pchumLogger")
@@ -46,8 +51,21 @@ class PesterLog:
         global _datadir
         self.parent = parent
         self.handle = handle
-        self.convos = {}
+        self.convos = {}  # handle -> path of the log
+        self.written = {}  # handle -> [bytes, lines] written to the log
         self.logpath = _datadir + "logs"
+        self.catalogue = catalogue(self.logpath, handle)
+        self.writer = LogWriter(
+            _datadir + "log_journal",
+            parent.config.log_durability(),
+            parent.config.log_fsync_interval() / 1000,
+        )
+        try:
+            self.index = LogIndex(_datadir + "log_index.sqlite", self.logpath)
+        except sqlite3.Error as e:
+            # SQLite might be built without FTS5.
+            PchumLog.warning("Log search is unavailable: %s", e)
+            self.index = None
 
     def log(self, handle, msg):
         if self.parent.config.time12Format():
@@ -72,49 +90,45 @@ class PesterLog:
             return
         # watch out for illegal characters
         handle = re.sub(r'[<>:"/\\|?*]', "_", handle)
-        bbcodemsg = log_time + convertTags(msg, "bbcode")
-        html = log_time + convertTags(msg, "html") + "<br />"
-        msg = log_time + convertTags(msg, "text")
-        modes = {"bbcode": bbcodemsg, "html": html, "text": msg}
-        try:
-            if handle not in self.convos:
-                log_time = datetime.now().strftime("%Y-%m-%d.%H.%M")
-                self.convos[handle] = {}
-                for format, t in modes.items():
-                    if not os.path.exists(
-                        "{}/{}/{}/{}".format(self.logpath, self.handle, handle, format)
-                    ):
-                        os.makedirs(
-                            "{}/{}/{}/{}".format(
-                                self.logpath, self.handle, handle, format
-                            )
-                        )
-                    fp = codecs.open(
-                        "%s/%s/%s/%s/%s.%s.txt"
-                        % (self.logpath, self.handle, handle, format, handle, log_time),
-                        encoding="utf-8",
-                        mode="a",
-                    )
-                    self.convos[handle][format] = fp
-
-            for format, t in modes.items():
-                f = self.convos[handle][format]
-                f.write(t + "\r\n")
-                # flush + fsync force a write,
-                # makes sure logs are saved in the case of a crash.
-                f.flush()
-                os.fsync(f.fileno())
-
-            # This way the file descriptors are closed and reopened for every message,
-            # which is sub-optimal and definitely a performance drain but,
-            # otherwise we still run into the ulimit on platforms like MacOS fairly easily.
-            # if ostools.isOSX() == True:
-            #    for (format, t) in modes.items():
-            #        self.finish(handle)
-
-        except (OSError, KeyError, IndexError, ValueError) as e:
+        if isinstance(msg, str):
+            # Lex once, the lexed message caches the ctag conversion.
+            msg = lexMessage(msg)
+        # Stored once in ctag markup, see scripts/log_format.py for the format.
+        ctag = convertTags(msg, "ctag")
+        timestamp = int(datetime.now().timestamp())
+        record = encode_record(ctag, log_time, timestamp)
+        if handle not in self.convos:
+            log_time = datetime.now().strftime("%Y-%m-%d.%H.%M")
+            fname = log_filename(handle, log_time)
+            self.convos[handle] = "{}/{}".format(
+                log_directory(self.logpath, self.handle, handle), fname
+            )
+            self.written[handle] = [0, 0]
+            self.catalogue.add_log(handle, fname)
+        written = self.written[handle]
+        written[0] += len(record.encode("utf-8", errors="replace"))
+        written[1] += 1
+        # Writing and syncing happens on the writer's thread,
+        # errors from earlier writes are reported here.
+        self.writer.write(self.convos[handle], record)
+        self.report_errors()
+        if self.index is not None:
+            try:
+                self.index.add(
+                    self.handle, handle, self.convos[handle], record, ctag, timestamp
+                )
+            except sqlite3.Error as e:
+                PchumLog.warning("Couldn't add message to the log index: %s", e)
+
+    def report_errors(self):
+        reported = set()
+        for path, e in self.writer.take_errors():
+            # Logs are at <logpath>/<handle>/<chum>/jsonl/<file>
+            handle = os.path.basename(os.path.dirname(os.path.dirname(path)))
+            if handle in reported:
+                continue
+            reported.add(handle)
             # Catching this exception does not stop pchum from dying if we run out of file handles </3
-            PchumLog.critical(e)
             errmsg = QtWidgets.QMessageBox()
             errmsg.setIcon(QtWidgets.QMessageBox.Icon.Warning)
             errmsg.setText(
@@ -133,14 +147,30 @@ class PesterLog:
     def finish(self, handle):
         if handle not in self.convos:
             return
-        for f in list(self.convos[handle].values()):
-            f.close()
-        del self.convos[handle]
+        path = self.convos.pop(handle)
+        self.writer.close_file(path)
+        self.catalogue.close_log(
+            handle, os.path.basename(path), *self.written.pop(handle)
+        )
+        self.catalogue.save()
 
     def close(self):
-        for h in list(self.convos.keys()):
-            for f in list(self.convos[h].values()):
-                f.close()
+        """Write out everything that's queued and close all logs."""
+        self.writer.close()
+        for handle, path in self.convos.items():
+            self.catalogue.close_log(
+                handle, os.path.basename(path), *self.written[handle]
+            )
+        self.catalogue.save()
+        self.catalogue.flush()
+        self.convos = {}
+        self.written = {}
+        if self.index is not None:
+            try:
+                self.index.close()
+            except sqlite3.Error as e:
+                PchumLog.warning("Couldn't save the log index: %s", e)
+            self.index = None
 
 
 class userConfig:
@@ -159,9 +189,10 @@ class userConfig:
         self.NEWCONVO = 8
         self.INITIALS = 16
         self.filename = _datadir + "pesterchum.js"
+        # Changes are written in the background, shortly after the last one.
+        self.store = ConfigStore(self.filename)
         try:
-            with open(self.filename) as fp:
-                self.config = json.load(fp)
+            self.config = self.store.load()
         except json.decoder.JSONDecodeError as e:
             PchumLog.critical("ohno :(")
             PchumLog.critical("failed to load pesterchum.js")
@@ -201,13 +232,12 @@ with a backup from: <a href='%s'>%s</a></h3></html>"
 
         if not os.path.exists(self.logpath):
             os.makedirs(self.logpath)
+        self.groups_store = ConfigStore("%s/groups.js" % (self.logpath))
         try:
-            with open("%s/groups.js" % (self.logpath)) as fp:
-                self.groups = json.load(fp)
+            self.groups = self.groups_store.load()
         except (OSError, ValueError):
             self.groups = {}
-            with open("%s/groups.js" % (self.logpath), "w") as fp:
-                json.dump(self.groups, fp)
+            self.groups_store.save(self.groups)
 
         self.backup()
 
@@ -255,11 +285,18 @@ with a backup from: <a href='%s'>%s</a></h3></html>"
             self.set("chums", [])
         return self.config.get("chums", [])
 
-    def setChums(self, newchums):
-        with open(self.filename) as fp:
+    def savedChums(self):
+        """Our chums, or the ones in pesterchum.js if another client changed it."""
+        if self.store.changed_on_disk():
             # what if we have two clients open??
-            newconfig = json.load(fp)
-        oldchums = newconfig["chums"]
+            try:
+                return self.store.read().get("chums", [])
+            except (OSError, ValueError) as e:
+                PchumLog.warning("Couldn't read chums from pesterchum.js: %s", e)
+        return self.config.get("chums", [])
+
+    def setChums(self, newchums):
+        oldchums = self.savedChums()
         # Time to merge these two! :OOO
         for c in list(set(oldchums) - set(newchums)):
             newchums.append(c)
@@ -373,6 +410,23 @@ with a backup from: <a href='%s'>%s</a></h3></html>"
     def irc_compatibility_mode(self):
         return self.config.get("irc_compatibility_mode", False)
 
+    def asyncio_transport(self):
+        """Use the asyncio connection engine instead of a thread polling the socket."""
+        return self.config.get("asyncio_transport", False)
+
+    def log_durability(self):
+        """When logs are synced to disk: "line", "interval" or "close"."""
+        return self.config.get("log_durability", "interval")
+
+    def log_fsync_interval(self):
+        """Milliseconds between syncs with the "interval" log durability."""
+        return self.config.get("log_fsync_interval", 1000)
+
+    def scrollback_lines(self):
+        """Messages kept in a conversation or memo, older ones are shown again
+        when scrolling up. 0 keeps everything."""
+        return self.config.get("scrollback_lines", 2000)
+
     def theme_repo_url(self):
         return self.config.get(
             "theme_repo_url",
@@ -390,10 +444,7 @@ with a backup from: <a href='%s'>%s</a></h3></html>"
 
     def addChum(self, chum):
         if chum.handle not in self.chums():
-            with open(self.filename) as fp:
-                # what if we have two clients open??
-                newconfig = json.load(fp)
-            newchums = newconfig["chums"] + [chum.handle]
+            newchums = self.savedChums() + [chum.handle]
             self.set("chums", newchums)
 
     def removeChum(self, chum):
@@ -458,12 +509,7 @@ with a backup from: <a href='%s'>%s</a></h3></html>"
 
     def saveGroups(self, groups):
         self.groups["groups"] = groups
-        try:
-            jsonoutput = json.dumps(self.groups)
-        except ValueError as e:
-            raise e
-        with open("%s/groups.js" % (self.logpath), "w") as fp:
-            fp.write(jsonoutput)
+        self.groups_store.save(self.groups)
 
     def server(self):
         if hasattr(self.parent, "serverOverride"):
@@ -559,12 +605,12 @@ with a backup from: <a href='%s'>%s</a></h3></html>"
 
     def set(self, item, setting):
         self.config[item] = setting
-        try:
-            jsonoutput = json.dumps(self.config)
-        except ValueError as e:
-            raise e
-        with open(self.filename, "w") as fp:
-            fp.write(jsonoutput)
+        self.store.save(self.config)
+
+    def flush(self):
+        """Write changes to pesterchum.js and groups.js now."""
+        self.store.flush()
+        self.groups_store.flush()
 
     def availableThemes(self):
         themes = []
@@ -884,14 +930,10 @@ class PesterProfileDB(dict):
 
         if not os.path.exists(self.logpath):
             os.makedirs(self.logpath)
-        try:
-            with open("%s/chums.js" % (self.logpath)) as fp:
-                chumdict = json.load(fp)
-        except (OSError, ValueError):
-            # karxi: This code feels awfully familiar....
-            chumdict = {}
-            with open("%s/chums.js" % (self.logpath), "w") as fp:
-                json.dump(chumdict, fp)
+        # Changed profiles are journaled in the background,
+        # chums.js is only rewritten once in a while.
+        self.store = JournalStore("%s/chums.js" % (self.logpath))
+        chumdict = self.store.load()
 
         u = []
         for handle, c in chumdict.items():
@@ -918,13 +960,21 @@ class PesterProfileDB(dict):
         converted = dict(u)
         self.update(converted)
 
-    def save(self):
-        try:
-            with open("%s/chums.js" % (self.logpath), "w") as fp:
-                chumdict = dict([p.plaindict() for p in self.values()])
-                json.dump(chumdict, fp)
-        except Exception as e:
-            raise e
+    def save(self, handle=None):
+        """Save the profile of 'handle', or every profile."""
+        if handle is None:
+            for handle in self:
+                self.save(handle)
+            return
+        self.store.update(*self[handle].plaindict())
+
+    def flush(self):
+        """Write saved profiles now."""
+        self.store.flush()
+
+    def close(self):
+        """Write saved profiles and bring chums.js up to date, when quitting."""
+        self.store.close()
 
     def getColor(self, handle, default=None):
         if handle not in self:
@@ -935,6 +985,7 @@ class PesterProfileDB(dict):
     def setColor(self, handle, color):
         if handle in self:
             self[handle].color = color
+            self.save(handle)
         else:
             self[handle] = PesterProfile(handle, color)
 
@@ -947,9 +998,9 @@ class PesterProfileDB(dict):
     def setGroup(self, handle, theGroup):
         if handle in self:
             self[handle].group = theGroup
+            self.save(handle)
         else:
             self[handle] = PesterProfile(handle, group=theGroup)
-        self.save()
 
     def getNotes(self, handle, default=""):
         if handle not in self:
@@ -960,108 +1011,59 @@ class PesterProfileDB(dict):
     def setNotes(self, handle, notes):
         if handle in self:
             self[handle].notes = notes
+            self.save(handle)
         else:
             self[handle] = PesterProfile(handle, notes=notes)
-        self.save()
 
     def __setitem__(self, key, val):
         dict.__setitem__(self, key, val)
-        self.save()
+        self.save(key)
+
+
+def theme_path(name):
+    """Directory of the theme 'name', the default theme's if it isn't installed."""
+    possiblepaths = (
+        _datadir + "themes/%s" % (name),
+        "themes/%s" % (name),
+        _datadir + "themes/pesterchum",
+        "themes/pesterchum",
+    )
+    for p in possiblepaths:
+        if os.path.exists(p):
+            return p
+    return "themes/pesterchum"
 
 
 class pesterTheme(dict):
-    def __init__(self, name, default=False):
-        possiblepaths = (
-            _datadir + "themes/%s" % (name),
-            "themes/%s" % (name),
-            _datadir + "themes/pesterchum",
-            "themes/pesterchum",
-        )
-        self.path = "themes/pesterchum"
-        for p in possiblepaths:
-            if os.path.exists(p):
-                self.path = p
-                break
+    """A theme's style.js, values are looked up by keys like "convo/systemMsgColor".
+
+    Keys the theme doesn't have are taken from the theme it inherits from, and
+    then from the default theme. Lookups use the flat table compile_theme() built
+    when the theme was loaded."""
 
+    def __init__(self, name, default=False):
+        self.path = theme_path(name)
         self.name = name
-        try:
-            with open(self.path + "/style.js") as fp:
-                theme = json.load(fp, object_hook=self.pathHook)
-        except OSError:
-            theme = json.loads("{}")
-        self.update(theme)
-        if "inherits" in self:
-            self.inheritedTheme = pesterTheme(self["inherits"])
-        if not default:
-            self.defaultTheme = pesterTheme("pesterchum", default=True)
+        compiled = compile_theme(name, theme_path)
+        self.update(compiled.style)
+        # get() and has_key() don't fall back to the default theme.
+        self.inheritedTable = compiled.table
+        if default:
+            self.table = self.inheritedTable
+        else:
+            self.table = dict(compile_theme("pesterchum", theme_path).table)
+            self.table.update(self.inheritedTable)
 
     def __getitem__(self, key):
-        keys = key.split("/")
-        try:
-            v = super().__getitem__(keys.pop(0))
-        except KeyError as e:
-            if hasattr(self, "inheritedTheme"):
-                return self.inheritedTheme[key]
-            elif hasattr(self, "defaultTheme"):
-                return self.defaultTheme[key]
-            else:
-                raise e
-        for k in keys:
-            try:
-                v = v[k]
-            except KeyError as e:
-                if hasattr(self, "inheritedTheme"):
-                    return self.inheritedTheme[key]
-                elif hasattr(self, "defaultTheme"):
-                    return self.defaultTheme[key]
-                else:
-                    raise e
-        return v
-
-    def pathHook(self, dict):
-        # This converts strings containing $path into the proper paths
-        # Honestly ive never even seen this Template stuff before. very funky!
-        for key, value in dict.items():
-            if isinstance(value, str):
-                templ = Template(value)
-                dict[key] = templ.safe_substitute(path=self.path)
-            elif isinstance(value, list):
-                # ~lisanne : for dealing with 'main/fonts' which is an array which contains filepaths with $
-                # probably good to have for future additions
-                for idx, item in enumerate(value):
-                    item = value[idx]
-                    if isinstance(item, str):
-                        # not very DRY of me >:3c
-                        templ = Template(item)
-                        value[idx] = templ.safe_substitute(path=self.path)
-        return dict
+        return self.table[key]
 
     def get(self, key, default):
-        keys = key.split("/")
-        try:
-            v = super().__getitem__(keys.pop(0))
-            for k in keys:
-                v = v[k]
-            return default if v is None else v
-        except KeyError:
-            if hasattr(self, "inheritedTheme"):
-                return self.inheritedTheme.get(key, default)
-            else:
-                return default
+        v = self.inheritedTable.get(key)
+        return default if v is None else v
 
     def __contains__(self, key):
         # Allows for `"thing/other/thing" in theme` checking
         return self.has_key(key)
 
     def has_key(self, key):
-        keys = key.split("/")
-        try:
-            v = super().__getitem__(keys.pop(0))
-            for k in keys:
-                v = v[k]
-            return v is not None
-        except KeyError:
-            if hasattr(self, "inheritedTheme"):
-                return key in self.inheritedTheme
-            else:
-                return False
+        return self.inheritedTable.get(key) is not None